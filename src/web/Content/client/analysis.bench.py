@@ -0,0 +1,125 @@
+import argparse
+import random
+import string
+import time
+import analysis
+
+class LinearTriageEngine(analysis.StackTriageEngine):
+    #the rule matching used before the rules were compiled, kept as the baseline.  each frame rebuilds the list of 
+    #expressions for its buckets and evaluates them one at a time
+    def find_matching_rule(self, frame):
+        if frame.strFrame in self.dictExactFrame:
+            return self.dictExactFrame[frame.strFrame]
+        if frame.strModule in self.dictExactModule:
+            ruleIdx = _find_indexof_first_match(frame.strRoutine, [rule.strRoutine for rule in self.dictExactModule[frame.strModule]])
+            if ruleIdx >= 0:
+                return self.dictExactModule[frame.strModule][ruleIdx]
+        if frame.strRoutine in self.dictExactRoutine:
+            ruleIdx = _find_indexof_first_match(frame.strModule, [rule.strModule for rule in self.dictExactRoutine[frame.strRoutine]])
+            if ruleIdx >= 0:
+                return self.dictExactRoutine[frame.strRoutine][ruleIdx]
+        ruleIdx = _find_indexof_first_match(frame.strFrame, [rule.strFrame for rule in self.lstWildRules])
+        if ruleIdx >= 0:
+            return self.lstWildRules[ruleIdx]
+        return None
+
+def _find_indexof_first_match(str, lstExpr):
+    for i, expr in enumerate(lstExpr):
+        if _is_wildcard_match(str, expr):
+            return i
+    return -1
+
+def _is_wildcard_match(str, expr):
+    splitOnWild = string.split(expr, "*")
+    if len(splitOnWild) == 1:
+        return str == expr
+    if not str.startswith(splitOnWild[0]):
+        return False
+    findStartIdx = len(splitOnWild[0])
+    for token in splitOnWild[1:-1]:
+        matchIdx = string.find(str, token, findStartIdx)
+        if matchIdx == -1:
+            return False
+        findStartIdx = matchIdx + len(token)
+    return len(str) - findStartIdx >= len(splitOnWild[-1]) and str.endswith(splitOnWild[-1])
+
+def _name(rand, prefix):
+    return prefix + ''.join(rand.choice(string.ascii_letters) for i in range(rand.randint(4, 12)))
+
+def _create_rules(rand, count, lstModule, lstRoutine):
+    lstTriage = [ ]
+    for i in range(count):
+        module = rand.choice(lstModule)
+        routine = rand.choice(lstRoutine)
+        kind = rand.randint(0, 3)
+        if kind == 0:
+            frame = module + '!' + routine
+        elif kind == 1:
+            frame = module + '!' + routine[:rand.randint(1, len(routine))] + '*'
+        elif kind == 2:
+            frame = '*!' + routine
+        else:
+            frame = module[:rand.randint(1, len(module))] + '*!*' + routine[-rand.randint(1, len(routine)):]
+        lstTriage.append(frame + '=' + _name(rand, 'followup'))
+    return [ analysis.StackTriageRule(s) for s in lstTriage ]
+
+def _create_stacks(rand, count, depth, lstModule, lstRoutine):
+    return [[ analysis.DbgFrame.FromStrs('0x0', rand.choice(lstModule), rand.choice(lstRoutine) + '(int)') for i in range(depth) ] for j in range(count) ]
+
+def _best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the stack triage rule matching over synthetic rules and stacks')
+
+    parser.add_argument('--rules', type=int, nargs='+', default=[ 100, 1000, 5000 ], help='the number of rules in each benchmarked rule set')
+
+    parser.add_argument('--stacks', type=int, default=200, help='the number of stacks triaged for each rule set')
+
+    parser.add_argument('--depth', type=int, default=40, help='the number of frames in each stack')
+
+    parser.add_argument('--repeat', type=int, default=3, help='the number of times each benchmark is run, the best time is reported')
+
+    parser.add_argument('--seed', type=int, default=0, help='the seed used to generate the rules and stacks')
+
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    lstModule = [ _name(rand, 'lib') + '.so' for i in range(20) ]
+    lstRoutine = [ _name(rand, '') + '::' + _name(rand, '') for i in range(2000) ]
+    lstStack = _create_stacks(rand, args.stacks, args.depth, lstModule, lstRoutine)
+
+    print '%-8s %12s %12s %12s %12s'%('rules', 'load', 'linear', 'compiled', 'memoized')
+
+    for count in args.rules:
+        lstRule = _create_rules(rand, count, lstModule, lstRoutine)
+
+        linear = LinearTriageEngine()
+        linear.load_rules(lstRule)
+        compiled = analysis.StackTriageEngine()
+        load = _best_time(lambda: compiled.load_rules(lstRule), 1)
+
+        #the compiled engine must blame the same frames as the linear scan
+        for stack in lstStack:
+            assert linear.triage_stack(stack) == compiled.triage_stack(stack)
+
+        def triage(engine, clear):
+            for stack in lstStack:
+                if clear:
+                    engine.dictMemo.clear()
+                engine.triage_stack(stack)
+
+        linearTime = _best_time(lambda: triage(linear, False), args.repeat)
+        compiledTime = _best_time(lambda: triage(compiled, True), args.repeat)
+        memoTime = _best_time(lambda: triage(compiled, False), args.repeat)
+
+        print '%-8d %10.1fms %10.1fms %10.1fms %10.1fms'%(count, load * 1000, linearTime * 1000, compiledTime * 1000, memoTime * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,21 @@
 # The .NET Foundation licenses this file to you under the MIT license.
 # See the LICENSE file in the project root for more information.
 
-import lldb
+#lldb is only available when loaded by the debugger, the triage engine can also be used offline without it
+try:
+    import lldb
+except ImportError:
+    lldb = None
 import shlex
 import argparse
 import os
 import threading
 import string
 import json
+import re
+import sys
+import collections
+import multiprocessing
 
 class DbgEngine(threading.local):
 
@@ -159,20 +167,7 @@ def analyze(debugger, command, result, internal_dict):
 
     eng.analyze(dictProps);
         
-    if 'STOP_REASON' in dictProps:
-        dictProps['FAILURE_HASH'] = dictProps['STOP_REASON']
-
-    if 'FOLLOW_UP' in dictProps and dictProps['FOLLOW_UP'] == 'heap_corruption':
-        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_HEAPCORRUPT'
-    
-    if ('FOLLOW_UP' not in dictProps or dictProps['FOLLOW_UP'] <> 'heap_corruption') and 'LAST_EXCEPTION_TYPE' in dictProps:
-        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_' + dictProps['LAST_EXCEPTION_TYPE']
-
-    if 'CORRUPT_ROOT_FRAME' in dictProps:
-        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_' + dictProps['CORRUPT_ROOT_FRAME']
-    elif 'FAULT_SYMBOL' in dictProps:
-        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_' + dictProps['FAULT_SYMBOL']
-
+    compute_failure_hash(dictProps)
 
     if '-o' in dictArgs:
         with open(dictArgs['-o'], 'w') as f:
@@ -190,6 +185,22 @@ def analyze(debugger, command, result, internal_dict):
     debugger.SetAsync(bAsync)
 
 
+## composes the FAILURE_HASH property from the stop reason, exception and triaged fault symbol in dictProps
+def compute_failure_hash(dictProps):
+    if 'STOP_REASON' in dictProps:
+        dictProps['FAILURE_HASH'] = dictProps['STOP_REASON']
+
+    if 'FOLLOW_UP' in dictProps and dictProps['FOLLOW_UP'] == 'heap_corruption':
+        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_HEAPCORRUPT'
+    
+    if ('FOLLOW_UP' not in dictProps or dictProps['FOLLOW_UP'] <> 'heap_corruption') and 'LAST_EXCEPTION_TYPE' in dictProps:
+        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_' + dictProps['LAST_EXCEPTION_TYPE']
+
+    if 'CORRUPT_ROOT_FRAME' in dictProps:
+        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_' + dictProps['CORRUPT_ROOT_FRAME']
+    elif 'FAULT_SYMBOL' in dictProps:
+        dictProps['FAILURE_HASH'] = dictProps['FAILURE_HASH'] + '_' + dictProps['FAULT_SYMBOL']
+
 def btm(debugger, command, result, internal_dict):
     bAsync = debugger.GetAsync()
     debugger.SetAsync(False)
@@ -224,12 +235,18 @@ class AnalysisEngine(object):
         self.analyzers.append(analyzer)
 
 class SosInterpreter(object):
+    #ip2md and DumpClass output for the current target keyed by command, the same method descs and classes are resolved
+    #for many frames across threads.  the output contains addresses only valid for the target so it is only kept until 
+    #the target changes
+    s_commands = { }
+    s_target = None
+
     def ip2md(self, strIp):
-        strOut = self.run_command("ip2md " + strIp)
+        strOut = self.run_cached_command("ip2md " + strIp)
         return strOut
     
     def dumpclass(self, strClassPtr):
-        strOut = self.run_command("sos DumpClass " + strClassPtr)
+        strOut = self.run_cached_command("sos DumpClass " + strClassPtr)
         return strOut
 
     def pe(self, bNested = False):
@@ -246,21 +263,40 @@ class SosInterpreter(object):
         return clrstackOut
 
     def get_symbol(self, strIp):
-        strRoutine='UNKNOWN'
-        strModule='UNKNOWN'
+        strModule, strRoutine = self.get_managed_frame_info(strIp)
+        if strRoutine is None:
+            return 'UNKNOWN!UNKNOWN'
+        return (strModule or 'UNKNOWN') + '!' + strRoutine.split('(')[0]
+
+    ## resolves the module and full routine name of the managed method at the specified ip
+    ## returns - tuple (strModule, strRoutine), either of which is None if it couldn't be resolved
+    def get_managed_frame_info(self, strIp):
+        strModule = None
+        strRoutine = None
         ip2mdOut = self.ip2md(strIp)
         ip2mdProps = _str_to_dict(ip2mdOut)
+        _dbg_write(str(ip2mdProps))
         if 'Method Name' in ip2mdProps: 
-            strRoutine = ip2mdProps['Method Name'].split('(')[0]
+            strRoutine = ip2mdProps['Method Name']
             if 'Class' in ip2mdProps:
                 classPtr = ip2mdProps['Class']
                 if classPtr is not None and classPtr <> '':
                     classOut = self.dumpclass(classPtr)
                     classProps = _str_to_dict(classOut)
+                    _dbg_write(str(classProps))
                     if 'File' in  classProps:
                         strFile = classProps['File']
                         strModule = string.rsplit(string.rsplit(strFile, '.', 1)[0], '/', 1)[1] 
-        return strModule + '!' + strRoutine
+        return strModule, strRoutine
+
+    ## runs a command whose output only depends on the target, returning the output of a previous run on the target
+    def run_cached_command(self, strCmd):
+        if SosInterpreter.s_target is None or not SosInterpreter.s_target == g_dbg.target:
+            SosInterpreter.s_commands = { }
+            SosInterpreter.s_target = g_dbg.target
+        if strCmd not in SosInterpreter.s_commands:
+            SosInterpreter.s_commands[strCmd] = self.run_command(strCmd)
+        return SosInterpreter.s_commands[strCmd]
 
     def run_command(self, strCmd):
         strOut = ""
@@ -305,6 +341,12 @@ class DbgFrame(object):
         frame.__populate_frame_strs(strIp, strModule, strRoutine)
         return frame
 
+    ## creates a frame from its module!routine string as stored in the FAULT_STACK property
+    @staticmethod
+    def FromStr(strFullFrame):
+        splitOnBang = string.split(strFullFrame, '!', 1)
+        return DbgFrame.FromStrs(None, splitOnBang[0], splitOnBang[1] if len(splitOnBang) > 1 else None)
+
     @staticmethod
     def FromStrs(strIp, strModule, strFullRoutine):
         frame = DbgFrame()
@@ -329,23 +371,7 @@ class DbgFrame(object):
     @staticmethod
     def __tryget_managed_frame_info(strIp):
         sos = SosInterpreter()     
-        strModule = None
-        strRoutine = None
-        ip2mdOut = sos.ip2md(strIp)
-        ip2mdProps = _str_to_dict(ip2mdOut)
-        _dbg_write(str(ip2mdProps))
-        if 'Method Name' in ip2mdProps: 
-            strRoutine = ip2mdProps['Method Name']
-            if 'Class' in ip2mdProps:
-                classPtr = ip2mdProps['Class']
-                if classPtr is not None and classPtr <> '':
-                    classOut = sos.dumpclass(classPtr)
-                    classProps = _str_to_dict(classOut)
-                    _dbg_write(str(classProps))
-                    if 'File' in  classProps:
-                        strFile = classProps['File']
-                        strModule = string.rsplit(string.rsplit(strFile, '.', 1)[0], '/', 1)[1] 
-        return strModule, strRoutine
+        return sos.get_managed_frame_info(strIp)
 
 class DbgThread(object):
     def __init__(self, sbThread):
@@ -400,12 +426,40 @@ class StackTriageRule(object):
         self.bExactFrame = self.bExactModule and self.bExactRoutine
 
 
+class WildcardMatcher(object):
+    ## matches a string against an ordered list of wildcard expressions, where * matches any sequence of characters.  the 
+    ## expressions are compiled into combined regular expressions whose alternation is tried in order, so a single match
+    ## finds the first matching expression.  python's re only supports 100 groups per expression so the expressions are 
+    ## compiled in chunks
+    s_chunksize = 90
+
+    def __init__(self, lstExpr):
+        self.lstRegex = [ ]
+        for i in range(0, len(lstExpr), WildcardMatcher.s_chunksize):
+            lstAlt = ['(' + '.*'.join([re.escape(s) for s in string.split(expr, "*")]) + r'\Z)' for expr in lstExpr[i:i + WildcardMatcher.s_chunksize]]
+            self.lstRegex.append((i, re.compile('|'.join(lstAlt), re.DOTALL)))
+
+    ## finds the index of the first expression matching the specified string, or -1 if none match
+    def find_indexof_first_match(self, str):
+        for offset, regex in self.lstRegex:
+            match = regex.match(str)
+            if match is not None:
+                return offset + match.lastindex - 1
+        return -1
+
 class StackTriageEngine(object):
+    #the number of distinct frames whose matching rule is remembered
+    s_maxmemo = 1024 * 64
+
     def __init__(self):
         self.dictExactFrame = { }
         self.dictExactModule = { }
         self.dictExactRoutine = { }
         self.lstWildRules = [ ]
+        self.dictModuleMatchers = { }
+        self.dictRoutineMatchers = { }
+        self.wildMatcher = WildcardMatcher([ ])
+        self.dictMemo = { }
 
     ## loads the specified rules into the triage engine
     ## lstRules - a list of rules to be added to the current triage engine
@@ -420,6 +474,7 @@ class StackTriageEngine(object):
             else:
                 self.lstWildRules.append(r);
         self.sort_rules()
+        self.compile_rules()
 
     ## finds the blame symbol for the specified stack
     ## lstFrame - list of frames in the stack to triage
@@ -432,75 +487,40 @@ class StackTriageEngine(object):
                 return (frame, rule)
         return None
     
-    ## finds the first rule matching the specified frame.  If no rules match None is returned
+    ## finds the first rule matching the specified frame.  If no rules match None is returned.  the same frames recur 
+    ## across stacks so the matching rule is remembered for each frame
     ## frame - the frame to find matching rules for
     def find_matching_rule(self, frame):
-        #initialze rule to none to return if no matching rules are found
-        rule = None
+        if frame.strFrame in self.dictMemo:
+            return self.dictMemo[frame.strFrame]
+        rule = self.__find_matching_rule(frame.strFrame, frame.strModule, frame.strRoutine)
+        if len(self.dictMemo) >= StackTriageEngine.s_maxmemo:
+            self.dictMemo.clear()
+        self.dictMemo[frame.strFrame] = rule
+        return rule
+
+    ## private - finds the first rule matching the specified frame.  exact frame rules take precedence over rules with an
+    ##           exact module, which take precedence over rules with an exact routine, wildcard rules are only matched 
+    ##           when no other rule matches
+    def __find_matching_rule(self, strFrame, strModule, strRoutine):
         #check if frame matches exact rule
-        if(frame.strFrame in self.dictExactFrame):
-            rule = self.dictExactFrame[frame.strFrame];
+        if strFrame in self.dictExactFrame:
+            return self.dictExactFrame[strFrame]
         #check if frame matches rule with an exact module
-        if (rule is None and frame.strModule in self.dictExactModule):
-            ruleIdx = self.__find_indexof_first_match(frame.strRoutine, [rule.strRoutine for rule in self.dictExactModule[frame.strModule]])
-            if (ruleIdx >= 0):
-                rule = self.dictExactModule[frame.strModule][ruleIdx]
+        if strModule in self.dictModuleMatchers:
+            ruleIdx = self.dictModuleMatchers[strModule].find_indexof_first_match(strRoutine)
+            if ruleIdx >= 0:
+                return self.dictExactModule[strModule][ruleIdx]
         #check if frame matches rule with an exact routine
-        if (rule is None and frame.strRoutine in self.dictExactRoutine):
-            ruleIdx = self.__find_indexof_first_match(frame.strRoutine, [rule.strModule for rule in self.dictExactRoutine[frame.strRoutine]])
-            if (ruleIdx >= 0):
-                rule = self.dictExactModule[frame.strModule][ruleIdx]
+        if strRoutine in self.dictRoutineMatchers:
+            ruleIdx = self.dictRoutineMatchers[strRoutine].find_indexof_first_match(strModule)
+            if ruleIdx >= 0:
+                return self.dictExactRoutine[strRoutine][ruleIdx]
         #check if frame matches wildcard rule
-        ruleIdx = self.__find_indexof_first_match(frame.strRoutine, [rule.strFrame for rule in self.lstWildRules])
-        if (ruleIdx >= 0):
-                rule = self.lstWildRules[ruleIdx]
-        return rule
-
-    ## private - finds the index of the first wildcard expression matching the specified string
-    ##           str - string to find a matching expression
-    ##           lstExpr - a list of expression to evaluate against the specified string
-    def __find_indexof_first_match(self, str, lstExpr):
-        for i, expr in enumerate(lstExpr):
-            if self.__is_wildcard_match(str, expr):
-                return i;
-        return -1;
-    
-    ## private - determins if the specified string matches the speicified wild card expression
-    ##           str - string to evaluage against the wild card expression
-    ##           expr - wildcard expression using * to match any
-    ##           returns - true if the specified string matches the given expression otherwise false
-    def __is_wildcard_match(self, str, expr):
-        match = False
-        
-        splitOnWild = string.split(expr, "*")
-        
-        findStartIdx = 0
-
-        #if the expr doesn't start with * verify the start of the string
-        if splitOnWild[0] <> "":
-            if str.startswith(splitOnWild[0]):
-                searchStartIdx = len(splitOnWild[0]);
-            else:
-                return False
-
-        #match all the interior search strings
-        for i in range(1, len(splitOnWild) - 1):
-            #ignore "" as this corresponds to a ** in the triage string so we move to the next token
-            if splitOnWild[i] <> "":
-                matchIdx = string.find(str, splitOnWild[i], findStartIdx)
-                #if the token was not found return false
-                if  matchIdx == -1:
-                        return False
-                findStartIdx = matchIdx + len(splitOnWild[i])
-
-        #if the expr doesn't end with * verify the end of the string
-        if splitOnWild[len(splitOnWild) - 1] <> "":
-            if not str.endswith(splitOnWild[len(splitOnWild) - 1]):
-                return False
-
-        #if we haven't returned yet all the search strings were found
-        return True
-
+        ruleIdx = self.wildMatcher.find_indexof_first_match(strFrame)
+        if ruleIdx >= 0:
+            return self.lstWildRules[ruleIdx]
+        return None
 
     ## private - sorts all engine rules based of the order they should be evaluated.  In this case by their length ignoring wildcard symbols
     def sort_rules(self):
@@ -512,6 +532,14 @@ class StackTriageEngine(object):
         
         self.lstWildRules = sorted(self.lstWildRules, key=lambda rule: len(rule.strModule.strip("*")))
 
+    ## private - compiles the sorted rules of each bucket into matchers, the remembered matches are discarded as they may
+    ##           no longer be the first matching rule
+    def compile_rules(self):
+        self.dictModuleMatchers = dict([(key, WildcardMatcher([rule.strRoutine for rule in lst])) for key, lst in self.dictExactModule.iteritems()])
+        self.dictRoutineMatchers = dict([(key, WildcardMatcher([rule.strModule for rule in lst])) for key, lst in self.dictExactRoutine.iteritems()])
+        self.wildMatcher = WildcardMatcher([rule.strFrame for rule in self.lstWildRules])
+        self.dictMemo = { }
+
     ## private - adds item to the specified multi-dictionary.  if the key doesn't exist creates a list value for the item
     def add_to_multidict(self, dict, key, val):
         if key in dict:
@@ -520,6 +548,10 @@ class StackTriageEngine(object):
             dict[key] = [ val ]
 
 class StackTriageAnalyzer(AnalysisEngine):
+    #engines loaded from each triage ini keyed by its absolute path, a debugger which triages many dumps only parses the
+    #rules again when the ini changes
+    s_engines = { }
+
     def __init__(self):
         self.stackTriageEng = StackTriageEngine()
         self.bLoaded = False
@@ -537,8 +569,13 @@ class StackTriageAnalyzer(AnalysisEngine):
         dictProps["FAULT_THREAD"] = str(g_dbg.target.GetProcess().GetSelectedThread())
         dictProps["FAULT_STACK"] = "\n".join([str(f) for f in lstFrame])
 
+        self.triage_frames(dictProps, lstFrame)
+
+    ## sets the FAULT_SYMBOL and FOLLOW_UP properties from the triage of the specified stack
+    def triage_frames(self, dictProps, lstFrame):
         #triage with the triage engine
         tplFrameRule = self.stackTriageEng.triage_stack(lstFrame)
+        dictProps.pop("FOLLOW_UP", None)
         
         #if a tuple was returned 
         if tplFrameRule is not None:
@@ -558,9 +595,21 @@ class StackTriageAnalyzer(AnalysisEngine):
         if '-i' in dictArgs:
             triageIni = dictArgs['-i']
 
-        self.load_rules_from_file(triageIni, rules)
+        strKey = os.path.abspath(triageIni)
+        mtime = os.path.getmtime(triageIni)
 
-        self.stackTriageEng.load_rules(rules)
+        if strKey in StackTriageAnalyzer.s_engines and StackTriageAnalyzer.s_engines[strKey][0] == mtime:
+            self.stackTriageEng = StackTriageAnalyzer.s_engines[strKey][1]
+        else:
+            self.load_rules_from_file(triageIni, rules)
+
+            self.stackTriageEng = StackTriageEngine()
+
+            self.stackTriageEng.load_rules(rules)
+
+            StackTriageAnalyzer.s_engines[strKey] = (mtime, self.stackTriageEng)
+
+        self.bLoaded = True
 
     def load_rules_from_file(self, strPath, lstRules):
         with open(strPath) as f:
@@ -652,3 +701,141 @@ class AllThreadsAnalyzer(AnalysisEngine):
             lstThread.append(DbgThread(t))
 
         dictProps['ALL_THREADS'] = json.dumps([t.ToDictionary() for t in lstThread])
+
+## re-triages the properties captured by a previous analyze using only the stored FAULT_STACK, so the fault symbol, 
+## follow up and failure hash reflect the currently loaded rules.  properties which can only be found with a debugger
+## are kept from the previous analysis
+## analyzer - StackTriageAnalyzer with the triage engine loaded
+## dictProps - the stored properties, updated in place
+def retriage_props(analyzer, dictProps):
+    if 'FAULT_STACK' not in dictProps:
+        return dictProps
+
+    lstFrame = [DbgFrame.FromStr(s) for s in string.split(dictProps['FAULT_STACK'], '\n') if s <> '']
+    analyzer.triage_frames(dictProps, lstFrame)
+
+    #the corrupt root is only found when the stack is triaged as heap corruption
+    if dictProps.get('FOLLOW_UP') <> 'heap_corruption':
+        for key in ['CORRUPT_ROOT_THREAD', 'CORRUPT_ROOT_FRAME_PC', 'CORRUPT_ROOT_FRAME']:
+            dictProps.pop(key, None)
+
+    dictProps.pop('FAILURE_HASH', None)
+    if 'STOP_REASON' in dictProps:
+        compute_failure_hash(dictProps)
+    return dictProps
+
+#the triage analyzer of a batch worker process, loaded once by _batch_init
+g_batchAnalyzer = None
+
+def _batch_init(strIni):
+    global g_batchAnalyzer
+    g_batchAnalyzer = StackTriageAnalyzer()
+    g_batchAnalyzer.load_triage_engine({ '-i': strIni })
+
+## private - re-triages a chunk of records, each either a json line or an already parsed dictionary, and returns the 
+##           json lines of the records to output
+def _batch_triage_chunk(args):
+    lstRecord, bChanged = args
+    lstOut = [ ]
+    for record in lstRecord:
+        dictProps = json.loads(record) if isinstance(record, basestring) else record
+        strPrevHash = dictProps.get('FAILURE_HASH')
+        retriage_props(g_batchAnalyzer, dictProps)
+        if not bChanged or dictProps.get('FAILURE_HASH') <> strPrevHash:
+            lstOut.append(json.dumps(dictProps) + '\n')
+    return ''.join(lstOut)
+
+## private - enumerates the records of a json or jsonl property file.  jsonl lines are yielded unparsed so parsing is
+##           done by the worker processes
+def _batch_read_records(f):
+    firstLine = f.readline()
+    while firstLine <> '' and firstLine.strip() == '':
+        firstLine = f.readline()
+    
+    #a json file holds either a single properties object or a list of them, otherwise the file is jsonl
+    strFirst = firstLine.strip()
+    if strFirst.startswith('[') or (strFirst.startswith('{') and not strFirst.endswith('}')):
+        records = json.loads(firstLine + f.read())
+        for dictProps in (records if isinstance(records, list) else [ records ]):
+            yield dictProps
+        return
+
+    if strFirst <> '':
+        yield firstLine
+    for line in f:
+        if line.strip() <> '':
+            yield line
+
+def _batch_chunks(inputs, nChunkSize):
+    lstChunk = [ ]
+    for strPath in inputs:
+        f = sys.stdin if strPath == '-' else open(strPath)
+        try:
+            for record in _batch_read_records(f):
+                lstChunk.append(record)
+                if len(lstChunk) >= nChunkSize:
+                    yield lstChunk
+                    lstChunk = [ ]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    if len(lstChunk) > 0:
+        yield lstChunk
+
+## re-triages the stored properties in the specified json or jsonl files across multiple processes without a debugger,
+## streaming the updated properties to the output as jsonl in the order they were read
+## strIni - path to the triage rules
+## inputs - paths of the json or jsonl property files to re-triage, - reads stdin
+## output - file the updated properties are written to
+## nProcesses - the number of worker processes, 1 triages in process
+## nChunkSize - the number of records sent to a worker at a time
+## bChanged - only output the records whose FAILURE_HASH changed
+def batch_triage(strIni, inputs, output, nProcesses = None, nChunkSize = 1000, bChanged = False):
+    nProcesses = nProcesses or multiprocessing.cpu_count()
+    chunks = ((lstChunk, bChanged) for lstChunk in _batch_chunks(inputs, nChunkSize))
+
+    if nProcesses == 1:
+        _batch_init(strIni)
+        for args in chunks:
+            output.write(_batch_triage_chunk(args))
+        return
+
+    pool = multiprocessing.Pool(nProcesses, _batch_init, (strIni,))
+    try:
+        #a bounded number of chunks are in flight so the input is read no faster than it is triaged
+        pending = collections.deque()
+        for args in chunks:
+            pending.append(pool.apply_async(_batch_triage_chunk, (args,)))
+            if len(pending) >= nProcesses * 2:
+                output.write(pending.popleft().get())
+        while len(pending) > 0:
+            output.write(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _parse_batch_args(argv):
+    parser = argparse.ArgumentParser(description='re-triages the FAULT_STACK of stored dump properties against the triage rules without a debugger, writing the updated properties as jsonl')
+
+    parser.add_argument('inputs', type=str, nargs='*', default=[ '-' ], help='json or jsonl files of dump properties, reads stdin if none are specified')
+
+    parser.add_argument('-i', '--ini', type=str, default='triage.ini', help='path to the triage rules')
+
+    parser.add_argument('-o', '--output', type=str, default=None, help='path the updated properties are written to, stdout if not specified')
+
+    parser.add_argument('--processes', type=int, default=None, help='the number of worker processes, defaults to the number of cpus')
+
+    parser.add_argument('--chunksize', type=int, default=1000, help='the number of records sent to a worker process at a time')
+
+    parser.add_argument('--changed', default=False, action='store_true', help='only output records whose FAILURE_HASH changed')
+
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = _parse_batch_args(sys.argv[1:])
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        batch_triage(args.ini, args.inputs, output, args.processes, args.chunksize, args.changed)
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,159 @@
+import unittest
+import analysis
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+
+class analysis_testcase(unittest.TestCase):
+
+    def create_engine(self, lstTriage):
+        engine = analysis.StackTriageEngine()
+        engine.load_rules([analysis.StackTriageRule(s) for s in lstTriage])
+        return engine
+
+    def frame(self, strModule, strRoutine):
+        return analysis.DbgFrame.FromStrs('0x0', strModule, strRoutine)
+
+class test_analysis_wildcardmatcher(analysis_testcase):
+
+    def test_first_match(self):
+        matcher = analysis.WildcardMatcher([ 'foo', 'f*', '*', 'a.b*c' ])
+        self.assertEqual(0, matcher.find_indexof_first_match('foo'))
+        self.assertEqual(1, matcher.find_indexof_first_match('foobar'))
+        self.assertEqual(2, matcher.find_indexof_first_match('bar'))
+        self.assertEqual(2, matcher.find_indexof_first_match(''))
+        self.assertEqual(0, analysis.WildcardMatcher([ 'a.b*c' ]).find_indexof_first_match('a.bxxc'))
+        self.assertEqual(-1, analysis.WildcardMatcher([ 'a.b*c' ]).find_indexof_first_match('axbc'))
+        self.assertEqual(-1, analysis.WildcardMatcher([ 'a*b*a' ]).find_indexof_first_match('aba' + 'b'))
+        self.assertEqual(0, analysis.WildcardMatcher([ 'a*b*a' ]).find_indexof_first_match('aba'))
+        self.assertEqual(-1, analysis.WildcardMatcher([ ]).find_indexof_first_match('foo'))
+
+    def test_many_expressions(self):
+        #more expressions than groups supported in a single regular expression
+        lstExpr = [ 'routine%d(*'%i for i in range(1000) ]
+        matcher = analysis.WildcardMatcher(lstExpr)
+        for i in [ 0, 89, 90, 99, 100, 101, 500, 999 ]:
+            self.assertEqual(i, matcher.find_indexof_first_match('routine%d(int)'%i))
+        self.assertEqual(1, matcher.find_indexof_first_match('routine1()'))
+        self.assertEqual(-1, matcher.find_indexof_first_match('other'))
+
+class test_analysis_stacktriageengine(analysis_testcase):
+
+    def test_precedence(self):
+        engine = self.create_engine([ 'lib*!*=wild', '*!Abort=routine', 'libfoo.so!Ab*=module', 'libfoo.so!Abort=frame' ])
+        self.assertEqual('frame', engine.find_matching_rule(self.frame('libfoo.so', 'Abort')).strFollowup)
+        self.assertEqual('module', engine.find_matching_rule(self.frame('libfoo.so', 'Abandon')).strFollowup)
+        self.assertEqual('routine', engine.find_matching_rule(self.frame('libbar.so', 'Abort')).strFollowup)
+        self.assertEqual('wild', engine.find_matching_rule(self.frame('libbar.so', 'Run')).strFollowup)
+        self.assertIsNone(engine.find_matching_rule(self.frame('app', 'Run')))
+
+    def test_rule_order_in_bucket(self):
+        #rules within a bucket are evaluated in order of their length ignoring wildcards
+        engine = self.create_engine([ 'libfoo.so!Abort*=abort', 'libfoo.so!A*=a', 'libfoo.so!Abort::Now=now' ])
+        self.assertEqual('a', engine.find_matching_rule(self.frame('libfoo.so', 'Abort::Later')).strFollowup)
+        self.assertEqual('now', engine.find_matching_rule(self.frame('libfoo.so', 'Abort::Now(int)')).strFollowup)
+        self.assertIsNone(engine.find_matching_rule(self.frame('libfoo.so', 'Run')))
+
+    def test_triage_stack(self):
+        engine = self.create_engine([ 'libc.so.6!*=ignore', 'libcoreclr.so!PROCAbort=ignore', 'libcoreclr.so*=coreclr' ])
+        lstFrame = [ self.frame('libc.so.6', 'abort'), self.frame('libcoreclr.so', 'PROCAbort()'), self.frame(None, None), self.frame('libcoreclr.so', 'EEPolicy::Fail(int)') ]
+        frame, rule = engine.triage_stack(lstFrame)
+        self.assertEqual('libcoreclr.so!EEPolicy::Fail', frame.strFrame)
+        self.assertEqual('coreclr', rule.strFollowup)
+        self.assertIsNone(engine.triage_stack([ self.frame('libc.so.6', 'abort') ]))
+
+    def test_memo(self):
+        engine = self.create_engine([ 'libfoo.so!*=foo' ])
+        frame = self.frame('libfoo.so', 'Run')
+        self.assertEqual('foo', engine.find_matching_rule(frame).strFollowup)
+        self.assertIn(frame.strFrame, engine.dictMemo)
+        #loading more rules discards the remembered matches
+        engine.load_rules([ analysis.StackTriageRule('libfoo.so!Run=run') ])
+        self.assertEqual('run', engine.find_matching_rule(frame).strFollowup)
+
+class test_analysis_batchtriage(analysis_testcase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.ini = os.path.join(self.tempdir, 'triage.ini')
+        with open(self.ini, 'w') as f:
+            f.write(';ignored frames\nlibc.so.6!*=ignore\nlibcoreclr.so!HandleFatalError=ignore\nlibcoreclr.so!gc_heap::*=heap_corruption\nlibfoo.so*=foo\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def props(self, i):
+        #stored properties of a previous analysis, the heap corruption of odd records was already triaged
+        lstFrame = [ 'libc.so.6!abort', 'libcoreclr.so!HandleFatalError(int)', 'libfoo.so!Run%d(char*)'%i if i % 2 == 0 else 'libcoreclr.so!gc_heap::mark(int)' ]
+        return { 'id': i, 'STOP_REASON': 'SIGABRT', 'FAULT_STACK': '\n'.join(lstFrame), 'FAULT_SYMBOL': 'libc.so.6!abort', 'CORRUPT_ROOT_FRAME': 'app!Main', 'FAILURE_HASH': 'SIGABRT_HEAPCORRUPT_app!Main' }
+
+    def test_from_str(self):
+        frame = analysis.DbgFrame.FromStr('libfoo.so!ns::Run(char*)')
+        self.assertEqual('libfoo.so', frame.strModule)
+        self.assertEqual('ns::Run', frame.strRoutine)
+        self.assertEqual('libfoo.so!ns::Run(char*)', str(frame))
+        self.assertEqual('UNKNOWN!UNKNOWN', analysis.DbgFrame.FromStr('UNKNOWN!UNKNOWN').strFrame)
+        self.assertEqual('UNKNOWN!UNKNOWN', analysis.DbgFrame.FromStr('<unknown>').strFrame)
+
+    def test_compute_failure_hash(self):
+        dictProps = { 'STOP_REASON': 'SIGSEGV', 'LAST_EXCEPTION_TYPE': 'System.Exception', 'FAULT_SYMBOL': 'libfoo.so!Run' }
+        analysis.compute_failure_hash(dictProps)
+        self.assertEqual('SIGSEGV_System.Exception_libfoo.so!Run', dictProps['FAILURE_HASH'])
+        dictProps = { 'STOP_REASON': 'SIGSEGV', 'LAST_EXCEPTION_TYPE': 'System.Exception', 'FOLLOW_UP': 'heap_corruption', 'CORRUPT_ROOT_FRAME': 'app!Main', 'FAULT_SYMBOL': 'libfoo.so!Run' }
+        analysis.compute_failure_hash(dictProps)
+        self.assertEqual('SIGSEGV_HEAPCORRUPT_app!Main', dictProps['FAILURE_HASH'])
+
+    def test_retriage_props(self):
+        analyzer = analysis.StackTriageAnalyzer()
+        analyzer.load_triage_engine({ '-i': self.ini })
+        dictProps = analysis.retriage_props(analyzer, self.props(0))
+        self.assertEqual('libfoo.so!Run0', dictProps['FAULT_SYMBOL'])
+        self.assertEqual('foo', dictProps['FOLLOW_UP'])
+        self.assertNotIn('CORRUPT_ROOT_FRAME', dictProps)
+        self.assertEqual('SIGABRT_libfoo.so!Run0', dictProps['FAILURE_HASH'])
+        #the corrupt root found by the debugger is kept for heap corruption
+        dictProps = analysis.retriage_props(analyzer, self.props(1))
+        self.assertEqual('heap_corruption', dictProps['FOLLOW_UP'])
+        self.assertEqual('SIGABRT_HEAPCORRUPT_app!Main', dictProps['FAILURE_HASH'])
+        self.assertEqual({ 'id': 2 }, analysis.retriage_props(analyzer, { 'id': 2 }))
+
+    def test_engine_cache(self):
+        lstAnalyzer = [ analysis.StackTriageAnalyzer() for i in range(3) ]
+        lstAnalyzer[0].load_triage_engine({ '-i': self.ini })
+        lstAnalyzer[1].load_triage_engine({ '-i': self.ini })
+        self.assertIs(lstAnalyzer[0].stackTriageEng, lstAnalyzer[1].stackTriageEng)
+
+        #the rules are loaded again once the ini changes
+        with open(self.ini, 'w') as f:
+            f.write('libfoo.so*=bar\n')
+        os.utime(self.ini, (0, os.path.getmtime(self.ini) + 10))
+        lstAnalyzer[2].load_triage_engine({ '-i': self.ini })
+        self.assertIsNot(lstAnalyzer[0].stackTriageEng, lstAnalyzer[2].stackTriageEng)
+        self.assertEqual('bar', lstAnalyzer[2].stackTriageEng.find_matching_rule(analysis.DbgFrame.FromStr('libfoo.so!Run')).strFollowup)
+
+    def test_batch_triage(self):
+        jsonl = os.path.join(self.tempdir, 'props.jsonl')
+        with open(jsonl, 'w') as f:
+            for i in range(0, 500):
+                f.write(json.dumps(self.props(i)) + '\n')
+        jsonPath = os.path.join(self.tempdir, 'props.json')
+        with open(jsonPath, 'w') as f:
+            json.dump([ self.props(i) for i in range(500, 510) ], f, indent=4)
+
+        for nProcesses in [ 1, 3 ]:
+            output = StringIO.StringIO()
+            analysis.batch_triage(self.ini, [ jsonl, jsonPath ], output, nProcesses, nChunkSize=7)
+            lstProps = [ json.loads(line) for line in output.getvalue().splitlines() ]
+            self.assertEqual(range(0, 510), [ p['id'] for p in lstProps ])
+            for p in lstProps:
+                self.assertEqual('SIGABRT_libfoo.so!Run%d'%p['id'] if p['id'] % 2 == 0 else 'SIGABRT_HEAPCORRUPT_app!Main', p['FAILURE_HASH'])
+
+        #only the records whose failure hash changed
+        output = StringIO.StringIO()
+        analysis.batch_triage(self.ini, [ jsonl ], output, 2, bChanged=True)
+        self.assertEqual(range(0, 500, 2), [ json.loads(line)['id'] for line in output.getvalue().splitlines() ])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -7,28 +7,66 @@
 
 import argparse
 import os
-import zipfile
 import string
 import platform
 import getpass 
-import urllib    
-import urllib2
 import time
 import json
-import requests
-import tempfile
 import hashlib  
 import zlib
-import gzip
 import threading
-import multiprocessing
 import datetime
 import copy
 import stat
-import subprocess
 import sys
 import errno
 import shutil
+import socket
+import importlib
+import struct
+import collections
+import math
+import mmap
+import bisect
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import scandir
+except ImportError:
+    scandir = None
+
+class _LazyModule(object):
+    #stands in for a module until one of its attributes is first used.  the modules which are slow to import and only used
+    #by some commands are loaded this way so that -h, config and the commands forwarded to the daemon start quickly
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attr)
+        except AttributeError:
+            #submodules such as multiprocessing.pool aren't attributes of their package until they are imported
+            return importlib.import_module('%s.%s'%(self._name, attr))
+
+requests = _LazyModule('requests')
+urllib = _LazyModule('urllib')
+zipfile = _LazyModule('zipfile')
+tempfile = _LazyModule('tempfile')
+multiprocessing = _LazyModule('multiprocessing')
+subprocess = _LazyModule('subprocess')
+SocketServer = _LazyModule('SocketServer')
 
 def _json_format(obj):
     return json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': '))
@@ -88,40 +126,559 @@ class Output:
             Output.s_lock.release()
         return result == 'y'
 
+def _deflate_block(args):
+    #compresses one block of a parallel gzip stream to raw deflate data. every block except the last is ended with a sync flush
+    #rather than a final block so that the compressed blocks can simply be concatenated in order to form a single deflate stream
+    buf, level, last = args
+    compobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compobj.compress(buf) + compobj.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class TokenBucket:
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._tokens = self._rate
+        self._stamp = time.time()
+        self._prioritywaiters = 0
+        self._condvar = threading.Condition(threading.Lock())
+
+    def consume(self, count, priority = False):
+        #blocks until the bucket has tokens, the consumer can then take more tokens than are available so a request larger 
+        #than the bucket isn't starved, the debt delays the following consumers instead.  normal consumers also wait while 
+        #priority consumers are waiting so the priority consumers get the available rate
+        self._condvar.acquire()
+        if priority:
+            self._prioritywaiters += 1
+        try:
+            while True:
+                now = time.time()
+                self._tokens = min(self._rate, self._tokens + (now - self._stamp) * self._rate)
+                self._stamp = now
+                if self._tokens > 0 and (priority or self._prioritywaiters == 0):
+                    self._tokens -= count
+                    return
+                self._condvar.wait(max(-self._tokens / self._rate, 0.01))
+        finally:
+            if priority:
+                self._prioritywaiters -= 1
+                self._condvar.notify_all()
+            self._condvar.release()
+
+class TransferScheduler:
+    #global limits in bytes per second shared by all the transfer workers, a limit of None is unlimited.  while a limit is 
+    #saturated transfers of files larger than s_prioritythreshold take precedence over smaller files.  the priority is set
+    #per thread by the worker processing the transfer
+    s_upload = None
+    s_download = None
+    s_diskread = None
+    s_prioritythreshold = 1024 * 1024 * 64
+    s_local = threading.local()
+
+    @staticmethod
+    def Configure(uploadrate, downloadrate, diskreadrate):
+        TransferScheduler.s_upload = TokenBucket(uploadrate) if uploadrate else None
+        TransferScheduler.s_download = TokenBucket(downloadrate) if downloadrate else None
+        TransferScheduler.s_diskread = TokenBucket(diskreadrate) if diskreadrate else None
+
+    @staticmethod
+    def SetPriority(size):
+        TransferScheduler.s_local.priority = size >= TransferScheduler.s_prioritythreshold
+
+    @staticmethod
+    def Upload(count):
+        TransferScheduler._consume(TransferScheduler.s_upload, count)
+
+    @staticmethod
+    def Download(count):
+        TransferScheduler._consume(TransferScheduler.s_download, count)
+
+    @staticmethod
+    def DiskRead(count):
+        TransferScheduler._consume(TransferScheduler.s_diskread, count)
+
+    @staticmethod
+    def ThrottleUpload(body):
+        #wraps a request body so it is limited by the upload rate as it is sent
+        if TransferScheduler.s_upload is None:
+            return body
+        if hasattr(body, 'read'):
+            return _ThrottledReader(body)
+        return TransferScheduler._iter_throttled(body)
+
+    @staticmethod
+    def _iter_throttled(iterable):
+        for buf in iterable:
+            TransferScheduler.Upload(len(buf))
+            yield buf
+
+    @staticmethod
+    def _consume(bucket, count):
+        if bucket is not None and count > 0:
+            bucket.consume(count, getattr(TransferScheduler.s_local, 'priority', False))
+
+class _ThrottledReader:
+    def __init__(self, file):
+        self._file = file
+        #requests reads the length of the body from len so the content length is still sent
+        self.len = os.fstat(file.fileno()).st_size - file.tell()
+
+    def read(self, size = -1):
+        buf = self._file.read(size)
+        TransferScheduler.Upload(len(buf))
+        return buf
+
+    def __iter__(self):
+        buf = self.read(1024 * 64)
+        while len(buf) > 0:
+            yield buf
+            buf = self.read(1024 * 64)
+
+class GzipCodec:
+    #gzip is the codec understood by every version of the service, the none codec is gzip at level 0 which stores the
+    #content without compressing it while remaining readable by the service
+    def __init__(self, name, level = None):
+        self.name = name
+        self.magic = '\x1f\x8b'
+        self._level = level
+
+    def available(self):
+        return True
+
+    def compressobj(self):
+        level = FileUtils.s_compresslevel if self._level is None else self._level
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressobj(self):
+        return _GzipDecompressor()
+
+class ZstdCodec:
+    def __init__(self):
+        self.name = 'zstd'
+        self.magic = '\x28\xb5\x2f\xfd'
+
+    def available(self):
+        return zstandard is not None
+
+    def compressobj(self):
+        #threads=-1 compresses on all the available cores
+        return zstandard.ZstdCompressor(level=FileUtils.s_zstdlevel, threads=-1).compressobj()
+
+    def decompressobj(self):
+        return _FlushlessDecompressor(zstandard.ZstdDecompressor().decompressobj())
+
+class Lz4Codec:
+    def __init__(self):
+        self.name = 'lz4'
+        self.magic = '\x04\x22\x4d\x18'
+
+    def available(self):
+        return lz4 is not None
+
+    def compressobj(self):
+        return _Lz4Compressor()
+
+    def decompressobj(self):
+        return _FlushlessDecompressor(lz4.frame.LZ4FrameDecompressor())
+
+class _GzipDecompressor:
+    #decompresses a stream of one or more concatenated gzip members
+    def __init__(self):
+        self._decompobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, buf):
+        out = [ ]
+        while len(buf) > 0:
+            out.append(self._decompobj.decompress(buf))
+            #any data following the end of a gzip member is the start of the next member
+            buf = self._decompobj.unused_data
+            if len(buf) > 0:
+                self._decompobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return ''.join(out)
+
+    def flush(self):
+        return self._decompobj.flush()
+
+class _FlushlessDecompressor:
+    def __init__(self, decompobj):
+        self._decompobj = decompobj
+
+    def decompress(self, buf):
+        return self._decompobj.decompress(buf)
+
+    def flush(self):
+        return ''
+
+class _Lz4Compressor:
+    def __init__(self):
+        self._compobj = lz4.frame.LZ4FrameCompressor()
+        self._header = self._compobj.begin()
+
+    def compress(self, buf):
+        compbuf = self._header + self._compobj.compress(buf)
+        self._header = ''
+        return compbuf
+
+    def flush(self):
+        compbuf = self._header + self._compobj.flush()
+        self._header = ''
+        return compbuf
+
+class _SparseReader:
+    #reads a file skipping over its holes, which read as zeros without touching the disk.  the holes are found with SEEK_DATA
+    #and SEEK_HOLE where the platform and filesystem support them, otherwise the whole file is read
+    s_seekdata = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+    s_seekhole = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
+
+    def __init__(self, file):
+        self._file = file
+        self._fd = file.fileno()
+        self._size = os.fstat(self._fd).st_size
+        self._pos = 0
+        self._datastart = 0
+        self._dataend = 0
+        self._findholes = _SparseReader.s_seekdata is not None
+
+    def read(self, size):
+        pieces = [ ]
+        remaining = min(size, self._size - self._pos)
+        while remaining > 0:
+            if self._pos >= self._dataend:
+                self._datastart, self._dataend = self._find_data(self._pos)
+            if self._pos < self._datastart:
+                count = min(remaining, self._datastart - self._pos)
+                pieces.append(FileUtils._zeros(count))
+            else:
+                os.lseek(self._fd, self._pos, os.SEEK_SET)
+                buf = os.read(self._fd, min(remaining, self._dataend - self._pos))
+                #the file was truncated while it was being read
+                if len(buf) == 0:
+                    break
+                count = len(buf)
+                TransferScheduler.DiskRead(count)
+                pieces.append(buf)
+            self._pos += count
+            remaining -= count
+        return pieces[0] if len(pieces) == 1 else ''.join(pieces)
+
+    def readinto(self, buf):
+        #fills buf with the following content of the file without allocating, returns the number of bytes read
+        view = memoryview(buf)
+        filled = 0
+        remaining = min(len(view), self._size - self._pos)
+        while remaining > 0:
+            if self._pos >= self._dataend:
+                self._datastart, self._dataend = self._find_data(self._pos)
+            if self._pos < self._datastart:
+                count = min(remaining, self._datastart - self._pos)
+                view[filled:filled + count] = FileUtils._zeros(count)
+            else:
+                self._file.seek(self._pos)
+                count = self._file.readinto(view[filled:filled + min(remaining, self._dataend - self._pos)])
+                if count == 0:
+                    break
+                TransferScheduler.DiskRead(count)
+            self._pos += count
+            filled += count
+            remaining -= count
+        return filled
+
+    def iter_blocks(self, blocksize):
+        #yields the content of the file as read only buffers over a single block which is reused for every read, so each 
+        #block must be consumed before the next one is read
+        buf = bytearray(blocksize)
+        count = self.readinto(buf)
+        while count > 0:
+            yield buffer(buf, 0, count)
+            count = self.readinto(buf)
+
+    def _find_data(self, pos):
+        #returns the extent (start, end) of the data at or following pos
+        if not self._findholes:
+            return (pos, self._size)
+        try:
+            start = os.lseek(self._fd, pos, _SparseReader.s_seekdata)
+        except OSError as e:
+            #ENXIO means there's no data after pos, any other error means holes aren't supported by the filesystem
+            if e.errno == errno.ENXIO:
+                return (self._size, self._size)
+            self._findholes = False
+            return (pos, self._size)
+        return (start, min(self._size, os.lseek(self._fd, start, _SparseReader.s_seekhole)))
+
+class _SparseWriter:
+    #writes blocks of zeros as holes by seeking over them rather than writing them.  finish must be called once all the
+    #content has been written so that a trailing hole extends the file to its full size
+    def __init__(self, file):
+        self._file = file
+
+    def write(self, buf):
+        BLOCKSIZE = 1024 * 64
+        for i in range(0, len(buf), BLOCKSIZE):
+            block = buf[i:i + BLOCKSIZE]
+            if block == FileUtils._zeros(len(block)):
+                self._file.seek(len(block), os.SEEK_CUR)
+            else:
+                self._file.write(block)
+
+    def finish(self):
+        self._file.truncate(self._file.tell())
+
 class FileUtils:
+    s_compresslevel = 9
+    s_zstdlevel = 3
+    s_parallelblocksize = 1024 * 1024
+    s_parallelthreshold = 1024 * 1024 * 64
+    s_compresspool = None
+    s_compresspoollock = threading.Lock()
+    s_zeros = { }
+    s_deflatedzeros = { }
+    s_codecs = dict((c.name, c) for c in [ GzipCodec('gzip'), GzipCodec('none', 0), ZstdCodec(), Lz4Codec() ])
+    #the errors raised by the codecs when decompressing corrupt content
+    s_codecerrors = (zlib.error, ValueError, RuntimeError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+    s_hashblocksize = 1024 * 1024
+    s_treeleafsize = 1024 * 1024 * 4
+    s_hashpool = None
+    s_hashpoollock = threading.Lock()
+    s_hashlocal = threading.local()
+    s_walkthreads = 16
+    s_walkpool = None
+    s_walkpoollock = threading.Lock()
+    s_entropythreshold = 7.5
+    s_entropysamples = 4
+    s_entropysamplesize = 1024 * 16
 
     @staticmethod
-    def _hash_and_compress(inpath, outpath):     
+    def _hash_and_compress(inpath, outpath, codec = 'gzip'):     
         FileUtils._ensure_parent_dir(outpath)
-        with gzip.open(outpath, 'wb') as fComp:
-            with open(inpath, 'rb') as fDecomp:
-                BLOCKSIZE = 1024 * 8
-                compsize = 0
-                hash = hashlib.sha1()
-                buf = fDecomp.read(BLOCKSIZE)
-                while len(buf) > 0:
-                    hash.update(buf)
-                    fComp.write(buf)       
-                    buf = fDecomp.read(BLOCKSIZE)
-                fComp.flush() 
-                return hash.hexdigest() 
+        hash = hashlib.sha1()
+        with open(outpath, 'wb') as fComp:
+            for buf in FileUtils._iter_compress(inpath, hash, codec):
+                fComp.write(buf)
+        return hash.hexdigest() 
 
     @staticmethod
-    def _hash_and_decompress(inpath, outpath):
+    def _hash_and_decompress(inpath, outpath, sparse = False):
+        #if sparse is specified runs of zeros are written as holes in the decompressed file
         FileUtils._ensure_parent_dir(outpath)
-        with gzip.open(inpath, 'rb') as fComp:
-            with open(outpath, 'wb') as fDecomp:
-                BLOCKSIZE = 1024 * 8
-                compsize = 0
+        FileUtils._unlink_existing(outpath)
+        with open(inpath, 'rb') as fComp:
+            with open(outpath, 'wb') as fOut:
+                fDecomp = _SparseWriter(fOut) if sparse else fOut
                 hash = hashlib.sha1()
-                buf = fComp.read(BLOCKSIZE)
-                while len(buf) > 0:
-                    hash.update(buf)
-                    fDecomp.write(buf)       
-                    buf = fComp.read(BLOCKSIZE)
-                fDecomp.flush() 
+                decompobj = None
+                for buf in _SparseReader(fComp).iter_blocks(1024 * 64):
+                    if decompobj is None:
+                        decompobj = FileUtils._detect_codec(buf[:4]).decompressobj()
+                    decompbuf = decompobj.decompress(buf)
+                    hash.update(decompbuf)
+                    fDecomp.write(decompbuf)       
+                decompbuf = decompobj.flush() if decompobj is not None else ''
+                hash.update(decompbuf)
+                fDecomp.write(decompbuf)
+                if sparse:
+                    fDecomp.finish()
                 return hash.hexdigest() 
 
+    @staticmethod
+    def _hash(path):
+        #the sha1 of the file content is the id of the artifact.  the file is read into a single reused buffer so hashing 
+        #doesn't allocate per block, and hashlib releases the GIL while it hashes each block
+        hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for buf in _SparseReader(f).iter_blocks(FileUtils.s_hashblocksize):
+                hash.update(buf)
+        return hash.hexdigest()
+
+    @staticmethod
+    def _tree_hash(path):
+        #a faster digest for detecting changes to large files, the file is split into leaves of s_treeleafsize which are 
+        #hashed concurrently and the digest is the sha1 of the concatenated leaf digests.  a single sha1 stream is bound by
+        #one core, so this scales with the core count where _hash can't.  this is NOT the content id of the file, artifacts 
+        #are always identified by the sha1 returned from _hash
+        size = os.path.getsize(path)
+        leafcount = max(1, (size + FileUtils.s_treeleafsize - 1) / FileUtils.s_treeleafsize)
+        digests = FileUtils._get_hash_pool().map(FileUtils._hash_leaf, [ (path, i * FileUtils.s_treeleafsize) for i in range(leafcount) ])
+        return hashlib.sha1(''.join(digests)).hexdigest()
+
+    @staticmethod
+    def _hash_leaf(args):
+        path, offset = args
+        #each hashing thread reuses its own buffer
+        buf = getattr(FileUtils.s_hashlocal, 'buf', None)
+        if buf is None:
+            buf = FileUtils.s_hashlocal.buf = bytearray(FileUtils.s_hashblocksize)
+        hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = FileUtils.s_treeleafsize
+            while remaining > 0:
+                count = f.readinto(memoryview(buf)[:min(remaining, len(buf))])
+                if count == 0:
+                    break
+                TransferScheduler.DiskRead(count)
+                hash.update(buffer(buf, 0, count))
+                remaining -= count
+        return hash.digest()
+
+    @staticmethod
+    def _get_hash_pool():
+        with FileUtils.s_hashpoollock:
+            if FileUtils.s_hashpool is None:
+                FileUtils.s_hashpool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+            return FileUtils.s_hashpool
+
+    @staticmethod
+    def _hash_and_compress_parallel(inpath, outpath):
+        FileUtils._ensure_parent_dir(outpath)
+        hash = hashlib.sha1()
+        with open(outpath, 'wb') as fComp:
+            for buf in FileUtils._iter_compress_parallel(inpath, hash):
+                fComp.write(buf)
+        return hash.hexdigest()
+
+    @staticmethod
+    def _use_parallel_compression(path):
+        #sparse files are always compressed in blocks, as blocks of zeros are then deflated once and reused
+        return (multiprocessing.cpu_count() > 1 and os.path.getsize(path) >= FileUtils.s_parallelthreshold) or FileUtils._is_sparse(path)
+
+    @staticmethod
+    def _is_elf(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(4) == '\x7fELF'
+        except EnvironmentError:
+            return False
+
+    @staticmethod
+    def _is_sparse(path):
+        st = os.stat(path)
+        return hasattr(st, 'st_blocks') and st.st_blocks * 512 < st.st_size
+
+    @staticmethod
+    def _iter_hash_and_compress(inpath, expectedhash=None, parallel=False, codec='gzip'):
+        #generator which reads, hashes and compresses the file in a single pass yielding the compressed blocks as they
+        #become available so they can be streamed directly into a request body without staging a compressed copy on disk.
+        #if expectedhash is specified the hash of the content read is checked once the file is exhausted, and an IOError is
+        #raised if the file changed after it was hashed (raising from the generator aborts the request in progress).
+        hash = hashlib.sha1()
+        compiter = FileUtils._iter_compress_parallel(inpath, hash) if parallel else FileUtils._iter_compress(inpath, hash, codec)
+        for compbuf in compiter:
+            yield compbuf
+        if expectedhash is not None and hash.hexdigest() != expectedhash:
+            raise IOError('file %s was modified while it was being uploaded'%(inpath))
+
+    @staticmethod
+    def _iter_compress(inpath, hash, codec = 'gzip'):
+        compobj = FileUtils._get_codec(codec).compressobj()
+        with open(inpath, 'rb') as fDecomp:
+            for buf in _SparseReader(fDecomp).iter_blocks(1024 * 64):
+                hash.update(buf)
+                compbuf = compobj.compress(buf)
+                if len(compbuf) > 0:
+                    yield compbuf
+        yield compobj.flush()
+
+    @staticmethod
+    def _iter_compress_parallel(inpath, hash):
+        #pigz style compression, the file is split into fixed size blocks which are deflated independently on a process pool
+        #and concatenated in order as the body of a single gzip member.  the hash, crc and size are calculated here as blocks
+        #are read, so the output is an ordinary gzip stream readable by gzip.open as well as the service's GZipStream.  the 
+        #number of blocks in flight is bounded so memory use doesn't grow with the size of the file.  blocks of zeros, such as 
+        #the holes and unused pages of core dumps, always deflate to the same data so they're deflated once and reused
+        pool = None
+        maxpending = multiprocessing.cpu_count() * 2
+        pending = collections.deque()
+        crc = 0
+        size = 0
+        yield struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 0, int(time.time()), 2, 255)
+        with open(inpath, 'rb') as fDecomp:
+            reader = _SparseReader(fDecomp)
+            buf = reader.read(FileUtils.s_parallelblocksize)
+            while True:
+                nextbuf = reader.read(FileUtils.s_parallelblocksize)
+                last = len(nextbuf) == 0
+                hash.update(buf)
+                crc = zlib.crc32(buf, crc)
+                size += len(buf)
+                if buf == FileUtils._zeros(len(buf)):
+                    pending.append(FileUtils._deflate_zeros(len(buf), last))
+                else:
+                    pool = pool or FileUtils._get_compress_pool()
+                    pending.append(pool.apply_async(_deflate_block, ((buf, FileUtils.s_compresslevel, last),)))
+                while len(pending) >= maxpending or (last and len(pending) > 0):
+                    compbuf = pending.popleft()
+                    yield compbuf if isinstance(compbuf, str) else compbuf.get()
+                if last:
+                    break
+                buf = nextbuf
+        yield struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+    @staticmethod
+    def _get_codec(name):
+        codec = FileUtils.s_codecs.get(name)
+        if codec is None or not codec.available():
+            raise ValueError('the compression codec %s is not available'%(name))
+        return codec
+
+    @staticmethod
+    def _detect_codec(prefix):
+        #compressed content is identified by the magic bytes at the start of the stream, content with no known magic is
+        #assumed to be gzip so it fails to decompress with a gzip error
+        for name in [ 'gzip', 'zstd', 'lz4' ]:
+            if prefix.startswith(FileUtils.s_codecs[name].magic):
+                return FileUtils._get_codec(name)
+        return FileUtils.s_codecs['gzip']
+
+    @staticmethod
+    def _select_codec(path, codec):
+        #the auto codec stores files which look incompressible from a sample of their content, such as archives and
+        #packages, and gzip compresses the rest
+        if codec != 'auto':
+            return codec
+        return 'none' if FileUtils._sample_entropy(path) >= FileUtils.s_entropythreshold else 'gzip'
+
+    @staticmethod
+    def _sample_entropy(path):
+        #estimates the entropy of the file in bits per byte from blocks sampled evenly across it
+        size = os.path.getsize(path)
+        counts = collections.Counter()
+        total = 0
+        with open(path, 'rb') as f:
+            for i in range(FileUtils.s_entropysamples):
+                f.seek(size * i / FileUtils.s_entropysamples)
+                buf = f.read(FileUtils.s_entropysamplesize)
+                counts.update(buf)
+                total += len(buf)
+        if total == 0:
+            return 0.0
+        return -sum(c * math.log(float(c) / total, 2) for c in counts.itervalues()) / total
+
+    @staticmethod
+    def _zeros(size):
+        zeros = FileUtils.s_zeros.get(size)
+        if zeros is None:
+            zeros = '\0' * size
+            #only a handful of block sizes are used so the cache stays small
+            if len(FileUtils.s_zeros) < 16:
+                FileUtils.s_zeros[size] = zeros
+        return zeros
+
+    @staticmethod
+    def _deflate_zeros(size, last):
+        key = (size, FileUtils.s_compresslevel, last)
+        compbuf = FileUtils.s_deflatedzeros.get(key)
+        if compbuf is None:
+            compbuf = _deflate_block((FileUtils._zeros(size), FileUtils.s_compresslevel, last))
+            FileUtils.s_deflatedzeros[key] = compbuf
+        return compbuf
+
+    @staticmethod
+    def _get_compress_pool():
+        #the pool is shared by all transfers and created on first use to avoid starting worker processes for small uploads
+        with FileUtils.s_compresspoollock:
+            if FileUtils.s_compresspool is None:
+                FileUtils.s_compresspool = multiprocessing.Pool(multiprocessing.cpu_count())
+            return FileUtils.s_compresspool
+
     @staticmethod    
     def _ensure_parent_dir(path):
         FileUtils._ensure_dir(os.path.dirname(path))
@@ -136,20 +693,67 @@ class FileUtils:
                 return
 
     @staticmethod
-    def _enumerate_unique_files(paths):
+    def _enumerate_unique_files(paths, statkeys = None):
+        #directories are listed in parallel a level at a time, listing is bound by the latency of the file system rather 
+        #than the cpu so it's parallelized even on a single core.  if statkeys is specified it's filled with the stat key 
+        #of each file found, so the hashes of unchanged files can be looked up without another stat
         files = set()
+        dirs = [ ]
         for p in paths:
             p = p.rstrip('\\')
             p = p.rstrip('/')
             abspath = os.path.abspath(p)
             if os.path.isdir(abspath):
-                for dirpath, dirnames, filenames in os.walk(abspath):
-                    for name in filenames:
-                        subpath = os.path.join(dirpath, name)
-                        files.add(subpath)
+                dirs.append(abspath)
             elif os.path.isfile(abspath): 
                 files.add(abspath)   
+                if statkeys is not None:
+                    statkeys[abspath] = HashCache._try_stat_key(abspath)
+        while len(dirs) > 0:
+            subdirs = [ ]
+            for dirfiles, dirsubdirs in FileUtils._get_walk_pool().imap_unordered(FileUtils._scan_dir, [ (d, statkeys is not None) for d in dirs ]):
+                for path, key in dirfiles:
+                    files.add(path)
+                    if statkeys is not None:
+                        statkeys[path] = key
+                subdirs.extend(dirsubdirs)
+            dirs = subdirs
         return files
+
+    @staticmethod
+    def _scan_dir(args):
+        #returns the (path, statkey) of the files in the directory and the paths of its subdirectories.  like os.walk 
+        #symlinks to directories aren't followed and unreadable directories are skipped.  scandir gets the type of each 
+        #entry from the directory listing itself where os.listdir needs a stat of every entry
+        dirpath, stat = args
+        files = [ ]
+        subdirs = [ ]
+        try:
+            if scandir is not None:
+                for entry in scandir.scandir(dirpath):
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    else:
+                        files.append((entry.path, HashCache._try_stat_key(entry.path, entry) if stat else None))
+            else:
+                for name in os.listdir(dirpath):
+                    path = os.path.join(dirpath, name)
+                    if os.path.isdir(path):
+                        if not os.path.islink(path):
+                            subdirs.append(path)
+                    else:
+                        files.append((path, HashCache._try_stat_key(path) if stat else None))
+        except OSError:
+            pass
+        return files, subdirs
+
+    @staticmethod
+    def _get_walk_pool():
+        with FileUtils.s_walkpoollock:
+            if FileUtils.s_walkpool is None:
+                FileUtils.s_walkpool = multiprocessing.pool.ThreadPool(FileUtils.s_walkthreads)
+            return FileUtils.s_walkpool
     
     @staticmethod
     def _try_remove(path):
@@ -161,10 +765,583 @@ class FileUtils:
             if e.errno != errno.ENOENT: 
                 raise 
             return False
-    
+
+    @staticmethod
+    def _write_json_atomic(path, obj):
+        #writes to a temp file and renames it over path so a crash can never leave a partially written file
+        FileUtils._ensure_parent_dir(path)
+        temppath = '%s.%s.tmp'%(path, os.getpid())
+        with open(temppath, 'w') as f:
+            json.dump(obj, f)
+        if platform.system().lower() == 'windows':
+            FileUtils._try_remove(path)
+        os.rename(temppath, path)
+
+    @staticmethod
+    def _link_or_copy(srcpath, dstpath):
+        #materializes srcpath at dstpath as cheaply as the file system allows.  a reflink shares the data blocks copy-on-write,
+        #a hardlink shares the inode, and if neither is possible (different volumes, unsupported fs) the file is copied
+        FileUtils._ensure_parent_dir(dstpath)
+        FileUtils._unlink_existing(dstpath)
+        if FileUtils._try_reflink(srcpath, dstpath):
+            return 'reflink'
+        try:
+            os.link(srcpath, dstpath)
+            return 'hardlink'
+        except (OSError, AttributeError):
+            shutil.copyfile(srcpath, dstpath)
+            return 'copy'
+
+    @staticmethod
+    def _reflink_or_copy(srcpath, dstpath):
+        #materializes srcpath at dstpath as an independent file, so modifying either one never changes the other
+        FileUtils._ensure_parent_dir(dstpath)
+        FileUtils._unlink_existing(dstpath)
+        if FileUtils._try_reflink(srcpath, dstpath):
+            return 'reflink'
+        shutil.copyfile(srcpath, dstpath)
+        return 'copy'
+
+    @staticmethod
+    def _unlink_existing(path):
+        #files are replaced by unlinking them rather than being opened for writing, as the existing file may be a hardlink
+        #to a cache entry.  don't chmod unless required, the entry is read-only
+        if not os.path.lexists(path):
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+            os.remove(path)
+
+    @staticmethod
+    def _try_reflink(srcpath, dstpath):
+        if platform.system().lower() != 'linux':
+            return False
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(srcpath, 'rb') as fSrc:
+                with open(dstpath, 'wb') as fDst:
+                    fcntl.ioctl(fDst.fileno(), FICLONE, fSrc.fileno())
+            return True
+        except (IOError, OSError):
+            FileUtils._try_remove(dstpath)
+            return False
+
+class ArtifactCache:
+    #a local content addressed store of downloaded artifacts, entries are named by the sha1 of their content and are only 
+    #added after the downloaded content has been verified against the hash.  entries are reflinks or copies of the downloaded
+    #file, never hardlinks, and are made read-only since they may be hardlinked into dump directories.  the least recently
+    #used entries are evicted once the cache exceeds maxsize.
+
+    def __init__(self, cachedir, maxsize):
+        self._cachedir = cachedir
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def TryMaterialize(self, hash, path):
+        entrypath = self._entry_path(hash)
+        with self._lock:
+            if not os.path.isfile(entrypath):
+                return False
+            #touch the entry to mark it as recently used
+            os.utime(entrypath, None)
+            if self._entries is not None:
+                self._entries[hash] = (os.path.getsize(entrypath), time.time())
+        method = FileUtils._link_or_copy(entrypath, path)
+        Output.Message('restored artifact %s %s from cache (%s)'%(hash, os.path.basename(path), method))
+        return True
+
+    def Add(self, hash, path):
+        entrypath = self._entry_path(hash)
+        if os.path.isfile(entrypath):
+            return
+        #stage the entry under a unique temp name and rename it so a partially written entry can never be materialized
+        temppath = None
+        try:
+            FileUtils._ensure_parent_dir(entrypath)
+            tempfd, temppath = tempfile.mkstemp(dir=os.path.dirname(entrypath), suffix='.tmp')
+            os.close(tempfd)
+            FileUtils._reflink_or_copy(path, temppath)
+            os.chmod(temppath, stat.S_IREAD)
+            with self._lock:
+                if os.path.isfile(entrypath):
+                    return
+                os.rename(temppath, entrypath)
+                self._load_entries()
+                self._entries[hash] = (os.path.getsize(entrypath), time.time())
+                self._evict()
+        except (IOError, OSError) as e:
+            Output.Diagnostic('failed to add artifact %s to the cache: %s'%(hash, e))
+        finally:
+            if temppath is not None and os.path.lexists(temppath):
+                os.chmod(temppath, stat.S_IREAD | stat.S_IWRITE)
+                FileUtils._try_remove(temppath)
+
+    def _entry_path(self, hash):
+        hash = hash.lower()
+        return os.path.join(self._cachedir, hash[:2], hash)
+
+    def _load_entries(self):
+        if self._entries is not None:
+            return
+        self._entries = { }
+        FileUtils._ensure_dir(self._cachedir)
+        for dirpath, dirnames, filenames in os.walk(self._cachedir):
+            for name in filenames:
+                if len(name) == 40:
+                    st = os.stat(os.path.join(dirpath, name))
+                    self._entries[name] = (st.st_size, st.st_mtime)
+
+    def _evict(self):
+        cachesize = sum(size for size, mtime in self._entries.itervalues())
+        if cachesize <= self._maxsize:
+            return
+        for hash, (size, mtime) in sorted(self._entries.items(), key=lambda e: e[1][1]):
+            if cachesize <= self._maxsize:
+                break
+            entrypath = self._entry_path(hash)
+            try:
+                os.chmod(entrypath, stat.S_IREAD | stat.S_IWRITE)
+                os.remove(entrypath)
+            except OSError as e:
+                Output.Diagnostic('failed to evict artifact %s from the cache: %s'%(hash, e))
+                continue
+            Output.Diagnostic('evicted artifact %s from the cache'%(hash))
+            del self._entries[hash]
+            cachesize -= size
+
+class HashCache:
+    #a persistent map of absolute file path to the sha1 of the file content.  entries are keyed by the (size, mtime, inode)
+    #of the file when it was hashed, so files which haven't changed since they were last uploaded are never re-hashed
+
+    def __init__(self, cachepath):
+        self._cachepath = cachepath
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    def GetHash(self, path, key = None):
+        #key is the stat key of the file if the caller already has it
+        path = os.path.abspath(path)
+        key = key or HashCache._stat_key(path)
+        hash = self.TryGetHash(path, key)
+        if hash is not None:
+            return hash
+        hash = FileUtils._hash(path)
+        #only cache the hash if the file didn't change while it was being hashed
+        if HashCache._stat_key(path) == key:
+            with self._lock:
+                self._entries[path] = key + [ hash ]
+                self._dirty = True
+        return hash
+
+    def TryGetHash(self, path, key):
+        #returns the indexed hash of the file if it hasn't changed since it was hashed, otherwise None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(path)
+            if entry is not None and entry[:3] == key:
+                return entry[3]
+        return None
+
+    def Save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            FileUtils._write_json_atomic(self._cachepath, self._entries)
+            self._dirty = False
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = { }
+        if os.path.isfile(self._cachepath):
+            try:
+                with open(self._cachepath, 'r') as fcache:
+                    self._entries = json.load(fcache)
+            except ValueError:
+                Output.Diagnostic('ignoring corrupt hash cache %s'%(self._cachepath))
+
+    @staticmethod
+    def _stat_key(path, entry = None):
+        st = entry.stat() if entry is not None else os.stat(path)
+        return [ st.st_size, st.st_mtime, st.st_ino ]
+
+    @staticmethod
+    def _try_stat_key(path, entry = None):
+        try:
+            return HashCache._stat_key(path, entry)
+        except OSError:
+            return None
+
+class UploadSpool:
+    #a durable local queue of uploads which failed because the service was unreachable.  the files of a spooled upload are
+    #copied into a content addressed blob store, so a file included by several spooled dumps is stored once, and the upload
+    #is journaled as an entry which records its progress so a drain interrupted by a crash resumes where it stopped.  entries
+    #are retried with an exponential backoff and set aside in the failed directory once they have exhausted their attempts
+    s_backoff = 60
+    s_maxbackoff = 60 * 60 * 6
+    s_maxattempts = 20
+    #unreferenced blobs are kept this long as the entry referencing them may still be being written
+    s_orphanage = 60 * 60
+
+    def __init__(self, spooldir, hashcache = None):
+        self._spooldir = spooldir
+        self._blobdir = os.path.join(spooldir, 'blobs')
+        self._entrydir = os.path.join(spooldir, 'entries')
+        self._faileddir = os.path.join(spooldir, 'failed')
+        self._hashcache = hashcache
+
+    def Add(self, dumppath, origin, displayname, incpaths, properties, dumpid = None):
+        #spools the upload of a dump and its included files, or of standalone files when dumppath is None.  the files are 
+        #linked to dumpid if it's specified, for a dump which was already uploaded
+        entry = { 'created': time.time(), 'attempts': 0, 'nextattempt': 0, 'dump': None, 'dumpid': dumpid, 'files': [ ], 'properties': properties or { } }
+
+        if dumppath is not None:
+            entry['dump'] = { 'hash': self._add_blob(dumppath), 'localpath': dumppath, 'origin': origin, 'displayname': displayname }
+
+        for path in sorted(incpaths):
+            try:
+                entry['files'].append({ 'hash': self._add_blob(path), 'localpath': path })
+            except (IOError, OSError) as e:
+                Output.Message('WARNING: unable to read %s, the file will not be uploaded: %s'%(path, e))
+
+        entryid = '%d.%d'%(entry['created'] * 1000000, os.getpid())
+        FileUtils._write_json_atomic(self._entry_path(entryid), entry)
+
+        Output.Message('spooled upload %s to %s'%(entryid, self._spooldir))
+
+        return entryid
+
+    def Drain(self, filequeue, dumpSvc, force = False):
+        #uploads the spooled entries whose backoff has elapsed, or all of them if force is specified.  returns the number of
+        #entries which remain spooled
+        entries = self._load_entries()
+        due = [ (id, entry) for id, entry in entries if force or entry['nextattempt'] <= time.time() ]
+
+        if len(due) > 0:
+            Output.Message('draining %s of %s spooled uploads'%(len(due), len(entries)))
+            #the files of all the due entries are uploaded together first so a file included by several spooled dumps is
+            #uploaded once, the entries then only link them.  while the service is still unreachable the entries are left
+            #for the next drain, any other failure is left to be reported by the entries it affects
+            try:
+                self._upload_files(filequeue, None, [ f for id, entry in due for f in entry['files'] ])
+            except Exception as e:
+                if UploadSpool.IsTransientError(e):
+                    for entryid, entry in due:
+                        self._retry_entry(entryid, entry, e)
+                    due = [ ]
+                else:
+                    Output.Diagnostic('uploading spooled files failed: %s'%(e))
+
+            for entryid, entry in due:
+                try:
+                    self._drain_entry(filequeue, dumpSvc, entryid, entry)
+                except Exception as e:
+                    self._retry_entry(entryid, entry, e)
+
+        self._remove_orphans()
+
+        return len(self._load_entries())
+
+    @staticmethod
+    def IsTransientError(e):
+        #errors which are expected to go away when retried later, failures reported by the service for a bad request aren't
+        if isinstance(e, TransferError):
+            return len(e.errors) > 0 and all([ UploadSpool.IsTransientError(err) for err in e.errors ])
+        if isinstance(e, requests.exceptions.HTTPError):
+            return e.response is not None and e.response.status_code >= 500
+        return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.RetryError))
+
+    def _drain_entry(self, filequeue, dumpSvc, entryid, entry):
+        dump = entry['dump']
+        #the dump is its own dumpling id, it's only uploaded if the service doesn't already have it from an earlier attempt
+        #or from another spooled entry for the same dump
+        if dump is not None and entry['dumpid'] is None:
+            if dump['hash'] in dumpSvc.GetMissingArtifacts([ dump['hash'] ]):
+                dumpdata = filequeue.UploadDump(self._blob_path(dump['hash']), None, dump['origin'], dump['displayname'], dump['localpath'])
+                entry['dumpid'] = dumpdata['dumplingId']
+            else:
+                entry['dumpid'] = dumpSvc.CreateDump(dump['hash'], dump['origin'], dump['displayname'])['dumplingId']
+                dumpSvc.LinkArtifact(entry['dumpid'], dump['localpath'], dump['hash'])
+            FileUtils._write_json_atomic(self._entry_path(entryid), entry)
+
+        self._upload_files(filequeue, entry['dumpid'], entry['files'])
+
+        if entry['dumpid'] is not None and len(entry['properties']) > 0:
+            dumpSvc.UpdateDumpProperties(entry['dumpid'], entry['properties'])
+
+        FileUtils._try_remove(self._entry_path(entryid))
+
+        if entry['dumpid'] is not None:
+            Output.Message('dumplingid:  %s'%(entry['dumpid']))
+
+    def _upload_files(self, filequeue, dumpid, files):
+        localpaths = { }
+        for f in files:
+            localpaths.setdefault(self._blob_path(f['hash']), f['localpath'])
+        if len(localpaths) > 0:
+            filequeue.UploadFiles(dumpid, localpaths.keys(), localpaths)
+
+    def _retry_entry(self, entryid, entry, e):
+        entry['attempts'] += 1
+        if entry['attempts'] >= UploadSpool.s_maxattempts:
+            Output.Critical('ERROR: spooled upload %s failed %s times and will not be retried: %s'%(entryid, entry['attempts'], e))
+            FileUtils._ensure_dir(self._faileddir)
+            os.rename(self._entry_path(entryid), os.path.join(self._faileddir, entryid + '.json'))
+            return
+        entry['nextattempt'] = time.time() + min(UploadSpool.s_maxbackoff, UploadSpool.s_backoff * 2 ** (entry['attempts'] - 1))
+        FileUtils._write_json_atomic(self._entry_path(entryid), entry)
+        Output.Message('WARNING: spooled upload %s failed and will be retried: %s'%(entryid, e))
+
+    def _add_blob(self, path):
+        hash = self._hashcache.GetHash(path) if self._hashcache is not None else FileUtils._hash(path)
+        blobpath = self._blob_path(hash)
+        if os.path.isfile(blobpath):
+            #refresh the blob so it isn't collected as an orphan before the entry referencing it is written
+            os.utime(blobpath, None)
+            return hash
+        #the blob is an independent copy as the original may be modified or deleted before the spool is drained, it's
+        #written to a temporary path first so a partially copied blob is never mistaken for a complete one
+        temppath = '%s.%s.tmp'%(blobpath, os.getpid())
+        FileUtils._ensure_parent_dir(temppath)
+        if not FileUtils._try_reflink(path, temppath):
+            shutil.copyfile(path, temppath)
+        os.utime(temppath, None)
+        if platform.system().lower() == 'windows':
+            FileUtils._try_remove(blobpath)
+        os.rename(temppath, blobpath)
+        return hash
+
+    def _remove_orphans(self):
+        if not os.path.isdir(self._blobdir):
+            return
+        referenced = set()
+        for id, entry in self._load_entries():
+            referenced.update([ f['hash'] for f in entry['files'] ])
+            if entry['dump'] is not None:
+                referenced.add(entry['dump']['hash'])
+        for name in os.listdir(self._blobdir):
+            path = os.path.join(self._blobdir, name)
+            if name not in referenced and os.path.getmtime(path) < time.time() - UploadSpool.s_orphanage:
+                FileUtils._try_remove(path)
+
+    def _load_entries(self):
+        #returns (entryid, entry) for every spooled entry, oldest first
+        entries = [ ]
+        if os.path.isdir(self._entrydir):
+            for name in os.listdir(self._entrydir):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self._entrydir, name), 'r') as fEntry:
+                        entries.append((name[:-len('.json')], json.load(fEntry)))
+                except (IOError, ValueError):
+                    Output.Diagnostic('ignoring unreadable spool entry %s'%(name))
+        return sorted(entries, key=lambda e: e[1]['created'])
+
+    def _entry_path(self, entryid):
+        return os.path.join(self._entrydir, entryid + '.json')
+
+    def _blob_path(self, hash):
+        return os.path.join(self._blobdir, hash)
+
+class ElfImage:
+    #minimal reader for the headers and notes of an ELF image.  read(offset, size) returns the bytes at offset in the image or
+    #None if they aren't available, so the same parser reads ELF files on disk as well as modules mapped in a core's memory
+    PT_LOAD = 1
+    PT_NOTE = 4
+    ET_CORE = 4
+    NT_GNU_BUILD_ID = 3
+    NT_FILE = 0x46494c45
+
+    def __init__(self, read, inmemory = False):
+        self._read = read
+        self._inmemory = inmemory
+        ident = read(0, 16)
+        if ident is None or ident[:4] != '\x7fELF':
+            raise ValueError('not an ELF image')
+        self.is64 = ord(ident[4]) == 2
+        self.endian = '<' if ord(ident[5]) == 1 else '>'
+        self.wordsize = 8 if self.is64 else 4
+        self.type, = self._unpack('H', 16)
+        if self.is64:
+            phoff, = self._unpack('Q', 32)
+            phentsize, phnum = self._unpack('HH', 54)
+        else:
+            phoff, = self._unpack('I', 28)
+            phentsize, phnum = self._unpack('HH', 42)
+        #segments are (type, offset, vaddr, filesz)
+        self.segments = [ ]
+        for i in range(phnum):
+            if self.is64:
+                ptype, flags, offset, vaddr, paddr, filesz = self._unpack('IIQQQQ', phoff + i * phentsize)
+            else:
+                ptype, offset, vaddr, paddr, filesz = self._unpack('IIIII', phoff + i * phentsize)
+            self.segments.append((ptype, offset, vaddr, filesz))
+
+    def notes(self):
+        #yields (name, type, desc) for each note in the PT_NOTE segments.  the notes of an image in memory are found by their
+        #address relative to the first loaded page rather than their file offset
+        loads = [ vaddr for ptype, offset, vaddr, filesz in self.segments if ptype == ElfImage.PT_LOAD ]
+        bias = min(loads) & ~0xfff if len(loads) > 0 else 0
+        for ptype, offset, vaddr, filesz in self.segments:
+            if ptype != ElfImage.PT_NOTE:
+                continue
+            data = self._read(vaddr - bias if self._inmemory else offset, filesz)
+            if data is None:
+                continue
+            pos = 0
+            while pos + 12 <= len(data):
+                namesz, descsz, ntype = struct.unpack_from(self.endian + 'III', data, pos)
+                pos += 12
+                name = data[pos:pos + namesz].rstrip('\0')
+                pos += (namesz + 3) & ~3
+                desc = data[pos:pos + descsz]
+                pos += (descsz + 3) & ~3
+                yield (name, ntype, desc)
+
+    def build_id(self):
+        for name, ntype, desc in self.notes():
+            if name == 'GNU' and ntype == ElfImage.NT_GNU_BUILD_ID:
+                return desc.encode('hex')
+        return None
+
+    def _unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        data = self._read(offset, struct.calcsize(fmt))
+        if data is None:
+            raise ValueError('truncated ELF image')
+        return struct.unpack(fmt, data)
+
+class ElfCore:
+    #enumerates the files mapped into an ELF core dump from its NT_FILE note along with the build ids of the mapped modules.  
+    #the core is memory mapped so only the pages holding the headers, notes and module headers are read from disk, 
+    #regardless of the size of the core
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        try:
+            self._image = ElfImage(self._read_file)
+            if self._image.type != ElfImage.ET_CORE:
+                raise ValueError('%s is not an ELF core dump'%(path))
+        except:
+            self.close()
+            raise
+        self._loads = sorted((vaddr, offset, filesz) for ptype, offset, vaddr, filesz in self._image.segments if ptype == ElfImage.PT_LOAD and filesz > 0)
+        self._loadaddrs = [ l[0] for l in self._loads ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def Modules(self):
+        #returns a dictionary of the path of each mapped file to the build id of the module, the build id is None when the 
+        #file isn't a module or its headers weren't included in the core
+        modules = { }
+        for name, ntype, desc in self._image.notes():
+            if name == 'CORE' and ntype == ElfImage.NT_FILE:
+                for start, fileofs, path in self._parse_nt_file(desc):
+                    if modules.get(path) is None:
+                        modules[path] = self._module_build_id(start) if fileofs == 0 else None
+        return modules
+
+    @staticmethod
+    def _file_build_id(path):
+        #returns the build id of the ELF file at path, or None if it isn't an ELF file or doesn't have a build id
+        try:
+            with open(path, 'rb') as f:
+                fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return ElfImage(lambda offset, size: fmap[offset:offset + size] if 0 <= offset and offset + size <= len(fmap) else None).build_id()
+                finally:
+                    fmap.close()
+        except (ValueError, struct.error, EnvironmentError):
+            return None
+
+    def _parse_nt_file(self, desc):
+        #the NT_FILE note is a count and page size, followed by a (start, end, page offset) entry for each mapping and then
+        #the null terminated path of each mapping
+        word = self._image.endian + ('Q' if self._image.is64 else 'I')
+        wordsize = self._image.wordsize
+        count, pagesize = struct.unpack_from(word + word[-1], desc, 0)
+        namesoffset = wordsize * 2 + count * wordsize * 3
+        if namesoffset > len(desc):
+            raise ValueError('truncated NT_FILE note')
+        names = desc[namesoffset:].split('\0')
+        mappings = [ ]
+        for i in range(min(count, len(names))):
+            start, end, pageofs = struct.unpack_from(word + word[-1] * 2, desc, wordsize * 2 + i * wordsize * 3)
+            mappings.append((start, pageofs * pagesize, names[i]))
+        return mappings
+
+    def _module_build_id(self, start):
+        try:
+            return ElfImage(lambda offset, size: self._read_memory(start + offset, size), True).build_id()
+        except (ValueError, struct.error):
+            return None
+
+    def _read_file(self, offset, size):
+        if offset < 0 or offset + size > len(self._map):
+            return None
+        return self._map[offset:offset + size]
+
+    def _read_memory(self, addr, size):
+        i = bisect.bisect_right(self._loadaddrs, addr) - 1
+        if i < 0:
+            return None
+        vaddr, offset, filesz = self._loads[i]
+        if addr + size > vaddr + filesz:
+            return None
+        return self._read_file(offset + addr - vaddr, size)
+
 class DumplingService:
-    def __init__(self, baseurl):
+    s_rangedthreshold = 1024 * 1024 * 64
+    s_rangedsegmentsize = 1024 * 1024 * 8
+
+    def __init__(self, baseurl, poolsize = None, retries = 3, backoff = 0.5):
         self._dumplingUri = baseurl;
+        self._poolsize = poolsize
+        self._retries = retries
+        self._backoff = backoff
+        self._adapter = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _session(self):
+        #sessions are not safe to share between threads, so each thread gets its own session mounted on the shared adapter
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._get_adapter())
+            session.mount('https://', self._get_adapter())
+            self._local.session = session
+        return session
+
+    def _get_adapter(self):
+        #all requests share a single connection pool so connections to the service and storage are kept alive across calls.  
+        #the pool is sized to the number of transfer threads so every worker can hold a connection without blocking.  it's
+        #created on first use so commands which never reach the service don't import requests
+        with self._lock:
+            if self._adapter is None:
+                poolsize = self._poolsize or ThreadPool.MaxThreads()
+                retry = requests.packages.urllib3.util.retry.Retry(total=self._retries, backoff_factor=self._backoff, status_forcelist=[ 500, 502, 503, 504 ])
+                self._adapter = requests.adapters.HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize, max_retries=retry)
+            return self._adapter
 
     def DownloadDebugger(self, outputdir):
         url = self._dumplingUri + 'api/tools/debug?'
@@ -182,7 +1359,7 @@ class DumplingService:
                                                                
         Output.Diagnostic('   url: %s'%(url))
                
-        response = requests.get(url);
+        response = self._session.get(url);
                   
         response.raise_for_status()
         
@@ -207,7 +1384,7 @@ class DumplingService:
                           
         Output.Diagnostic('   url: %s'%(url))
         
-        response = requests.get(url);
+        response = self._session.get(url);
 
         Output.Diagnostic('   response: %s'%(response))   
 
@@ -225,7 +1402,7 @@ class DumplingService:
 
         Output.Diagnostic('   url: %s'%(url))
 
-        response = requests.get(url);
+        response = self._session.get(url);
                           
         Output.Diagnostic('   response: %s'%(response))
                                                           
@@ -233,9 +1410,9 @@ class DumplingService:
         
         return response.json()
 
-    def UploadArtifact(self, dumpid, localpath, hash, file):
+    def UploadArtifact(self, dumpid, localpath, hash, file, codec = 'gzip'):
         
-        qargs = { 'hash': hash, 'localpath': localpath }
+        qargs = { 'hash': hash, 'localpath': localpath, 'codec': codec }
         
         url = self._dumplingUri  + 'api/'
 
@@ -249,37 +1426,150 @@ class DumplingService:
 
         Output.Diagnostic('   url: %s'%(url))
 
-        response = requests.post(url, data=file)
+        response = self._session.post(url, data=TransferScheduler.ThrottleUpload(file))
 
         Output.Diagnostic('   response: %s'%(response.content))
 
         response.raise_for_status()
 
     
-    def DownloadArtifact(self, hash, downpath):  
-        if os.path.isdir(downpath):
-            self._dumpSvc.DowloadArtifactToDirectory(hash, downpath)
+    def LinkArtifact(self, dumpid, localpath, hash):
+        #associates an artifact the service already has with the dump. the service only reads the content of an upload
+        #when the artifact is new, so posting an empty body adds the dump artifact without transferring the file
+        qargs = { 'hash': hash, 'localpath': localpath }
 
-            return
+        url = self._dumplingUri  + 'api/dumplings/' + dumpid + '/artifacts/uploads?' + urllib.urlencode(qargs)
+
+        Output.Message('linking artifact %s %s'%(hash, os.path.basename(localpath)))
+
+        Output.Diagnostic('   url: %s'%(url))
+
+        response = self._session.post(url, data='')
+
+        Output.Diagnostic('   response: %s'%(response.content))
+
+        response.raise_for_status()
+
+    def CreateUpload(self, dumpid, localpath, hash, size, partsize, codec = 'gzip'):
+        qargs = { 'hash': hash, 'localpath': localpath, 'size': size, 'partsize': partsize, 'codec': codec }
+
+        if dumpid is not None:
+            qargs['dumplingid'] = dumpid
+
+        url = self._dumplingUri + 'api/uploads?' + urllib.urlencode(qargs)
+
+        Output.Message('starting resumable upload %s %s'%(hash, os.path.basename(localpath)))
+
+        Output.Diagnostic('   url: %s'%(url))
+
+        response = self._session.post(url)
+
+        Output.Diagnostic('   response: %s'%(response))
+
+        #if the service doesn't support resumable uploads return None so the caller can fall back to a single request
+        if response.status_code == 404:
+            return None
+
+        response.raise_for_status()
+
+        return response.json()['uploadId']
+
+    def GetUploadParts(self, uploadid):
+        url = self._dumplingUri + 'api/uploads/' + uploadid
+
+        Output.Diagnostic('   url: %s'%(url))
+
+        response = self._session.get(url)
+
+        Output.Diagnostic('   response: %s'%(response))
+
+        #the upload has expired or was never created
+        if response.status_code == 404:
+            return None
+
+        response.raise_for_status()
+
+        return set(response.json()['parts'])
+
+    def UploadPart(self, uploadid, index, hash, data):
+        url = self._dumplingUri + 'api/uploads/%s/parts/%s?%s'%(uploadid, index, urllib.urlencode({ 'hash': hash }))
+
+        Output.Diagnostic('   url: %s'%(url))
+
+        TransferScheduler.Upload(len(data))
+
+        response = self._session.put(url, data=data)
+
+        Output.Diagnostic('   response: %s'%(response))
+
+        response.raise_for_status()
+
+    def CommitUpload(self, uploadid):
+        url = self._dumplingUri + 'api/uploads/' + uploadid + '/commit'
+
+        Output.Diagnostic('   url: %s'%(url))
+
+        response = self._session.post(url)
+
+        Output.Diagnostic('   response: %s'%(response))
+
+        response.raise_for_status()
+
+    def GetMissingArtifacts(self, hashes):
+        hashes = list(set(h.lower() for h in hashes))
+
+        missing = set()
+
+        url = self._dumplingUri + 'api/artifacts/missing'
+
+        Output.Diagnostic('   url: %s'%(url))
+
+        #query in batches to keep the request size reasonable for large include paths
+        BATCHSIZE = 512
+        for i in range(0, len(hashes), BATCHSIZE):
+            batch = hashes[i:i + BATCHSIZE]
+
+            response = self._session.post(url, json=batch)
+
+            Output.Diagnostic('   response: %s'%(response))
+
+            #if the service doesn't support the query assume every artifact is missing
+            if response.status_code == 404:
+                return set(hashes)
+
+            response.raise_for_status()
+
+            missing.update(h.lower() for h in response.json())
+
+        return missing
+
+    def DownloadArtifact(self, hash, downpath, sparse = False, pool = None):  
+        #if sparse is specified runs of zeros in the artifact are written as holes in the downloaded file.  the ranges of 
+        #large artifacts are downloaded in parallel on the pool if one is given, otherwise they're downloaded in turn
+        if os.path.isdir(downpath):
+            return self.DowloadArtifactToDirectory(hash, downpath)
 
         url = self._dumplingUri + 'api/artifacts/' + hash
 
         Output.Diagnostic('   url: %s'%(url))
         
-        response = requests.get(url, stream=True)
+        response = self._session.get(url, stream=True)
                                                      
         Output.Diagnostic('   response: %s'%(response))
                                     
         response.raise_for_status()
 
-        DumplingService._stream_compressed_file_from_response(response, hash, downpath)
+        if DumplingService._supports_ranged_download(response):
+            return self._download_ranged(response, hash, downpath, sparse, pool)
+
+        return DumplingService._stream_compressed_file_from_response(response, hash, downpath, sparse)
         
     def DowloadArtifactToDirectory(self, hash, dirpath):
         url = self._dumplingUri + 'api/artifacts/' + hash
 
         Output.Diagnostic('   url: %s'%(url))
         
-        response = requests.get(url, stream=True)
+        response = self._session.get(url, stream=True)
                                                      
         Output.Diagnostic('   response: %s'%(response))
                                     
@@ -290,12 +1580,12 @@ class DumplingService:
         
         downpath = os.path.join(dirpath, filename)
         
-        DumplingService._stream_compressed_file_from_response(response, hash, downpath)
+        return DumplingService._stream_compressed_file_from_response(response, hash, downpath)
         
-    def UploadDump(self, localpath, hash, origin, displayname, file):    
+    def UploadDump(self, localpath, hash, origin, displayname, file, codec = 'gzip'):    
         dumplingid = self.CreateDump(hash, origin, displayname)
 
-        qargs = { 'hash': hash, 'localpath': localpath  }
+        qargs = { 'hash': hash, 'localpath': localpath, 'codec': codec }
 
         url = self._dumplingUri + 'api/dumplings/uploads?' + str(urllib.urlencode(qargs))
 
@@ -303,7 +1593,7 @@ class DumplingService:
 
         Output.Diagnostic('   url: %s'%(url))
 
-        response = requests.post(url, data=file)
+        response = self._session.post(url, data=TransferScheduler.ThrottleUpload(file))
                                      
         Output.Diagnostic('   response: %s'%(response))
                     
@@ -320,7 +1610,7 @@ class DumplingService:
 
         Output.Diagnostic('   url: %s'%(url))
         
-        response = requests.get(url)
+        response = self._session.get(url)
                                      
         Output.Diagnostic('   response: %s'%(response))
                     
@@ -337,12 +1627,118 @@ class DumplingService:
 
         Output.Diagnostic('   data: %s'%(_json_format(dictProps)))
 
-        response = requests.post(url, data=dictProps)    
+        response = self._session.post(url, data=dictProps)    
 
         response.raise_for_status()
                           
         Output.Diagnostic('   response: %s'%(response))
 
+    def _download_ranged(self, response, hash, path, sparse = False, pool = None):
+        #large artifacts are downloaded as byte ranges over several connections in parallel, each range is written directly
+        #to its offset in a preallocated file.  completed ranges are recorded in a state file beside the partial download so
+        #a download which is interrupted only fetches the remaining ranges when it's restarted.
+        url = response.url
+        size = int(response.headers['Content-Length'])
+        response.close()
+
+        partpath = path + '.partial'
+        statepath = partpath + '.json'
+        state = None
+
+        if os.path.isfile(statepath) and os.path.isfile(partpath):
+            try:
+                with open(statepath, 'r') as fState:
+                    state = json.load(fState)
+            except ValueError:
+                state = None
+
+        if state is None or state['hash'] != hash or state['size'] != size:
+            state = { 'hash': hash, 'size': size, 'segmentsize': DumplingService.s_rangedsegmentsize, 'completed': [ ] }
+            FileUtils._ensure_parent_dir(partpath)
+            with open(partpath, 'wb') as fd:
+                fd.truncate(size)
+            FileUtils._write_json_atomic(statepath, state)
+        else:
+            Output.Message('resuming download of artifact %s %s'%(hash, os.path.basename(path)))
+
+        segmentsize = state['segmentsize']
+        completed = set(state['completed'])
+        pending = [ i for i in range((size + segmentsize - 1) / segmentsize) if i not in completed ]
+        errors = [ ]
+        lock = threading.Lock()
+
+        if pool is None:
+            for segment in pending:
+                self._download_segment(url, partpath, statepath, state, segment, errors, lock)
+        else:
+            tasks = [ pool.queue_work(self._download_segment, args=(url, partpath, statepath, state, segment, errors, lock)) for segment in pending ]
+            for t in tasks:
+                t.await_result()
+
+        if len(errors) > 0:
+            Output.Message('WARNING: download of artifact %s failed, the download will resume if the command is run again'%(hash))
+            raise errors[0]
+
+        downhash = FileUtils._hash_and_decompress(partpath, path, sparse)
+
+        FileUtils._try_remove(statepath)
+        FileUtils._try_remove(partpath)
+
+        return DumplingService._verify_download(hash, downhash, path)
+
+    def _download_segment(self, url, partpath, statepath, state, segment, errors, lock):
+        #once a segment fails the remaining segments are skipped, the download resumes from the completed segments when 
+        #the command is run again
+        TransferScheduler.SetPriority(state['size'])
+        segmentsize = state['segmentsize']
+        with lock:
+            if len(errors) > 0:
+                return
+        try:
+            start = segment * segmentsize
+            self._download_range(url, partpath, start, min(state['size'], start + segmentsize) - 1)
+        except Exception as e:
+            with lock:
+                errors.append(e)
+            return
+        with lock:
+            state['completed'].append(segment)
+            FileUtils._write_json_atomic(statepath, state)
+
+    def _download_range(self, url, path, start, end):
+        response = self._session.get(url, headers={ 'Range': 'bytes=%s-%s'%(start, end) }, stream=True)
+
+        response.raise_for_status()
+
+        if response.status_code != 206:
+            raise IOError('the server did not honor the requested range %s-%s'%(start, end))
+
+        written = 0
+        with open(path, 'r+b') as fd:
+            fd.seek(start)
+            for chunk in response.iter_content(1024*64):
+                TransferScheduler.Download(len(chunk))
+                fd.write(chunk)
+                written += len(chunk)
+
+        if written != end - start + 1:
+            raise IOError('the server returned %s bytes for the requested range %s-%s'%(written, start, end))
+
+    @staticmethod
+    def _supports_ranged_download(response):
+        length = int(response.headers.get('Content-Length', 0))
+        return response.headers.get('Accept-Ranges', '').lower() == 'bytes' and 'Content-Encoding' not in response.headers and length >= DumplingService.s_rangedthreshold
+
+    @staticmethod
+    def _verify_download(hash, downhash, path):
+        if downhash != hash:
+            Output.Critical("ERROR: downloaded file did not match expected hash value")
+            os.remove(path)
+            return False
+        else: 
+            Output.Message('downloaded artifact %s %s'%(hash, os.path.basename(path)))      
+            return True
+
     @staticmethod
     def _stream_zip_archive_from_response(response, unpackdir):
         #write the zip archive a temp file
@@ -361,22 +1757,36 @@ class DumplingService:
         os.remove(tempPath)
         
     @staticmethod
-    def _stream_compressed_file_from_response(response, hash, path):
-        #write the compressed blob to a temp file
-        tempPath = os.path.join(tempfile.gettempdir(), tempfile.mktemp())
-        with open(tempPath, 'wb') as fd:
-            for chunk in response.iter_content(1024*8):
-                fd.write(chunk)
-        
-        downhash = FileUtils._hash_and_decompress(tempPath, path)
-        
-        os.remove(tempPath)
-
-        if downhash != hash:
-            Output.Critical("ERROR: downloaded file did not match expected hash value")
+    def _stream_compressed_file_from_response(response, hash, path, sparse = False):
+        #decompress and hash the blob as it is received, writing only the decompressed content, so the compressed blob 
+        #never lands on disk.  the codec is detected from the start of the blob, and the content hash is checked once the 
+        #response is exhausted
+        FileUtils._ensure_parent_dir(path)
+        FileUtils._unlink_existing(path)
+        hasher = hashlib.sha1()
+        decompobj = None
+        try:
+            with open(path, 'wb') as fOut:
+                fd = _SparseWriter(fOut) if sparse else fOut
+                for chunk in response.iter_content(1024*64):
+                    TransferScheduler.Download(len(chunk))
+                    if decompobj is None:
+                        decompobj = FileUtils._detect_codec(chunk).decompressobj()
+                    buf = decompobj.decompress(chunk)
+                    hasher.update(buf)
+                    fd.write(buf)
+                if decompobj is not None:
+                    buf = decompobj.flush()
+                    hasher.update(buf)
+                    fd.write(buf)
+                if sparse:
+                    fd.finish()
+        except FileUtils.s_codecerrors as e:
+            Output.Critical("ERROR: downloaded file is not a valid compressed artifact: %s"%(e))
             os.remove(path)
-        else: 
-            Output.Message('downloaded artifact %s %s'%(hash, os.path.basename(path)))      
+            return False
+
+        return DumplingService._verify_download(hash, hasher.hexdigest(), path)
                    
     @staticmethod
     def _stream_file_from_response(response, path):
@@ -388,25 +1798,60 @@ class DumplingService:
             for chunk in response.iter_content(1024*8):
                 fd.write(chunk)     
      
+class TransferError(Exception):
+    def __init__(self, errors):
+        Exception.__init__(self, '%s transfers failed'%(len(errors)))
+        self.errors = errors
+
+class TaskCancelledError(Exception):
+    pass
+
+class Continuation:
+    #returned by the function of a task to continue the task on another pool rather than completing it, this lets a 
+    #transfer move from the cpu pool to the io pool while callers keep waiting on the same task
+    def __init__(self, pool, func, args=()):
+        self.pool = pool
+        self.func = func
+        self.args = args
+
 class Task:
     def __init__(self, func, args):
         self.completed = False
+        self.cancelled = False
         self.func = func
         self.args = args
         self.result = None   
         self.exception = None
+        self._started = False
+        self._pool = None
         self._condvar = threading.Condition(threading.Lock())
 
     def execute(self):
         try:
-            self.result = self.func(*self.args[0:])
+            result = self.func(*self.args[0:])
         except Exception as e:                              
-            self.exception = e
-            print "workitem failed with exception: %s" % e
-        finally:
+            Output.Diagnostic('workitem failed with exception: %s' % e)
+            self._complete(None, e)
+            return
+        if isinstance(result, Continuation):
             self._condvar.acquire()
+            self._started = False
+            self._condvar.release()
+            result.pool.queue_task(self, result.func, result.args)
+        else:
+            self._complete(result, None)
+
+    def cancel(self):
+        #cancels the task if it has not started executing, returns True if the task was cancelled
+        self._condvar.acquire()
+        try:
+            if self.completed or self._started:
+                return False
+            self.cancelled = True
             self.completed = True
             self._condvar.notify_all()
+            return True
+        finally:
             self._condvar.release()
 
     def wait(self, timeout = None):
@@ -417,118 +1862,784 @@ class Task:
     
     def await_result(self, timeout = None):
         self.wait(timeout)
+        if self.cancelled:
+            raise TaskCancelledError()
         if self.exception:
+            #the caller has observed the failure so the pool no longer needs to report it
+            if self._pool is not None:
+                self._pool._observe(self)
             raise self.exception
         return self.result
-        
+
+    def _start(self):
+        self._condvar.acquire()
+        try:
+            if self.cancelled:
+                return False
+            self._started = True
+            return True
+        finally:
+            self._condvar.release()
+
+    def _complete(self, result, exception):
+        self.result = result
+        self.exception = exception
+        if exception is not None and self._pool is not None:
+            self._pool._report(self)
+        self._condvar.acquire()
+        self.completed = True
+        self._condvar.notify_all()
+        self._condvar.release()
       
 class ThreadPool:
-    s_MaxThreads = multiprocessing.cpu_count()
+    #None sizes the pools to the core count, which is only looked up once a pool starts its first thread
+    s_MaxThreads = None
+    s_MaxQueued = 4096
+
+    def __init__(self, maxthreads = None, maxqueued = None):
+        self._lock = threading.Lock()
+        #signalled when work is queued, when space frees up in the queue, and when the pool becomes idle
+        self._workcond = threading.Condition(self._lock)
+        self._spacecond = threading.Condition(self._lock)
+        self._idlecond = threading.Condition(self._lock)
+        self._queue = collections.deque()
+        self._threadcount = 0
+        self._idlecount = 0
+        self._busycount = 0
+        self._errors = [ ]
+        self._maxthreads = maxthreads
+        self._maxqueued = maxqueued or ThreadPool.s_MaxQueued
+
+    @staticmethod
+    def MaxThreads():
+        return ThreadPool.s_MaxThreads or multiprocessing.cpu_count()
+    
+    def queue_work(self, func, args=()):
+        task = Task(func, args)
+        self.queue_task(task, func, args)
+        return task
+
+    def queue_task(self, task, func, args=()):
+        task.func = func
+        task.args = args
+        task._pool = self
+        self._enqueue(task)
+
+    def wait_on_pending_work(self):
+        #waits for all queued work to complete and returns the exceptions of any failed tasks whose results were not awaited
+        self._lock.acquire()
+        try:
+            while len(self._queue) > 0 or self._busycount > 0:
+                self._idlecond.wait()
+            errors = [ t.exception for t in self._errors ]
+            self._errors = [ ]
+            return errors
+        finally:
+            self._lock.release()
+
+    def cancel_pending(self):
+        #cancels all the work which has not yet started, returns the number of tasks cancelled
+        self._lock.acquire()
+        tasks = list(self._queue)
+        self._lock.release()
+        return len([ t for t in tasks if t.cancel() ])
+
+    def _enqueue(self, task):
+        self._lock.acquire()
+        try:
+            #block the producer while the queue is full so queued work can't grow without bound
+            while len(self._queue) >= self._maxqueued:
+                self._spacecond.wait()
+
+            self._queue.append(task)
+
+            if self._maxthreads is None:
+                self._maxthreads = ThreadPool.MaxThreads()
+
+            if len(self._queue) > self._idlecount and self._threadcount < self._maxthreads:
+                self._threadcount += 1
+                self._add_thread()
+
+            self._workcond.notify()
+        finally:
+            self._lock.release()
+
+    def _report(self, task):
+        self._lock.acquire()
+        self._errors.append(task)
+        self._lock.release()
+
+    def _observe(self, task):
+        self._lock.acquire()
+        if task in self._errors:
+            self._errors.remove(task)
+        self._lock.release()
+
+    def _add_thread(self):
+        thread = threading.Thread(target=self._process_queue_items, args=())
+        thread.setDaemon(True)
+        thread.start()
+
+    def _process_queue_items(self):
+        while True:
+            self._lock.acquire()
+            while len(self._queue) == 0:
+                self._idlecount += 1
+                self._workcond.wait()
+                self._idlecount -= 1
+            task = self._queue.popleft()
+            self._busycount += 1
+            self._spacecond.notify()
+            self._lock.release()
+            try:
+                if task._start():
+                    task.execute()
+            finally:
+                self._lock.acquire()
+                self._busycount -= 1
+                if len(self._queue) == 0 and self._busycount == 0:
+                    self._idlecond.notify_all()
+                self._lock.release()
+        
+class FileTransferManager:
+    s_resumablethreshold = 1024 * 1024 * 64
+    s_partsize = 1024 * 1024 * 8
+
+    def __init__(self, dumpSvc, maxthreads = None, streaming = False, cache = None, hashcache = None, uploadstatedir = None, codec = 'auto'):
+        self._hashmap = { }
+        self._dumpSvc = dumpSvc
+        #hashing and compression are bound by the cpu so they run on a pool sized to the machine, network transfers run on
+        #the io pool.  parts of resumable uploads are uploaded on a separate pool so that transfers waiting on their parts 
+        #can't starve them
+        self._cpupool = ThreadPool()
+        self._iopool = ThreadPool(maxthreads)
+        self._partpool = ThreadPool(maxthreads)
+        self._streaming = streaming
+        self._cache = cache
+        self._hashcache = hashcache
+        self._uploadstatedir = uploadstatedir
+        self._codec = codec
+        #maps paths which are read for upload to the local path reported to the service when they differ, as they do for
+        #files uploaded from the spool
+        self._localpaths = { }
+         
+    def QueueFileDownload(self, hash, abspath, sparse = False):
+        return self._iopool.queue_work(self._download, args=(hash, abspath, sparse))
+        
+    def QueueManifestDownload(self, dumpid):
+        return self._iopool.queue_work(self._dumpSvc.GetDumplingManfiest, args=(dumpid,))
+
+    def QueueFileUpload(self, dumpid, abspath):
+        #the file is hashed and compressed on the cpu pool, the returned task then continues on the io pool for the upload
+        return self._cpupool.queue_work(self._prepare_upload, args=(dumpid, abspath))
+
+    def WaitForPendingTransfers(self):
+        #work on the cpu pool continues on the io pool so the cpu pool must be drained first.  raises a TransferError with
+        #all the failures that weren't already observed through the queued tasks
+        errors = self._cpupool.wait_on_pending_work()
+        errors.extend(self._iopool.wait_on_pending_work())
+        if len(errors) > 0:
+            raise TransferError(errors)
+
+    def CancelPendingTransfers(self):
+        return self._cpupool.cancel_pending() + self._iopool.cancel_pending() + self._partpool.cancel_pending()
+
+    def UploadFiles(self, dumpid, paths, localpaths = None, statkeys = None):
+        #hashes all the specified files and asks the service which of them it already has, only the missing files are 
+        #compressed and uploaded, the rest are just linked to the dump.  returns once all transfers have completed.  
+        #statkeys are the stat keys of the files collected by _enumerate_unique_files, the hashes of unchanged files are
+        #taken from the hash cache without queueing any work and only the new and changed files are hashed
+        #the local paths only apply to this upload, they're removed once it returns so a long lived processor doesn't 
+        #accumulate them
+        self._localpaths.update(localpaths or { })
+        try:
+            self._hash_and_upload_files(dumpid, paths, statkeys)
+        finally:
+            for path in localpaths or { }:
+                self._localpaths.pop(path, None)
+
+    def _hash_and_upload_files(self, dumpid, paths, statkeys):
+        statkeys = statkeys or { }
+        hashtasks = [ ]
+        for p in sorted(paths):
+            key = statkeys.get(p)
+            hash = self._hashcache.TryGetHash(p, key) if self._hashcache is not None and key is not None else None
+            hashtasks.append((p, hash, self._cpupool.queue_work(self._hash, args=(p, key)) if hash is None else None))
+        paths = [ ]
+        hashes = [ ]
+        for path, hash, task in hashtasks:
+            try:
+                hashes.append(hash or task.await_result())
+                paths.append(path)
+            except (IOError, OSError) as e:
+                Output.Message('WARNING: unable to read %s, the file will not be uploaded: %s'%(path, e))
+        if self._hashcache is not None:
+            self._hashcache.Save()
+
+        missing = self._dumpSvc.GetMissingArtifacts(hashes) if len(hashes) > 0 else set()
+
+        Output.Diagnostic('%s of %s artifacts need to be uploaded'%(len(missing), len(set(hashes))))
+
+        #files which share a hash with a file being uploaded are linked once the upload has completed
+        uploading = set()
+        deferred = [ ]
+        for path, hash in zip(paths, hashes):
+            if hash in missing and hash not in uploading:
+                uploading.add(hash)
+                self.QueueFileUpload(dumpid, path)
+            elif hash in missing:
+                deferred.append((path, hash))
+            elif dumpid is not None:
+                self._iopool.queue_work(self._dumpSvc.LinkArtifact, args=(dumpid, self._localpath(path), hash))
+        self.WaitForPendingTransfers()
+
+        if dumpid is not None:
+            for path, hash in deferred:
+                self._iopool.queue_work(self._dumpSvc.LinkArtifact, args=(dumpid, self._localpath(path), hash))
+            self.WaitForPendingTransfers()
+
+    def DownloadFiles(self, targets):
+        #targets maps artifact hashes to the list of (path, sparse) destinations the artifact is restored to.  each distinct
+        #artifact is downloaded once and its other destinations are linked to the downloaded copy.  returns once all 
+        #transfers have completed.
+        for hash, destinations in targets.iteritems():
+            self._iopool.queue_work(self._download_to_many, args=(hash, destinations))
+        self.WaitForPendingTransfers()
+
+    def _hash(self, abspath, key = None):
+        TransferScheduler.SetPriority(key[0] if key is not None else os.path.getsize(abspath))
+        if self._hashcache is not None:
+            return self._hashcache.GetHash(abspath, key)
+        return FileUtils._hash(abspath)
+
+    def _download(self, hash, abspath, sparse = False):
+        #the size of the artifact isn't known until it's downloaded, large artifacts are prioritized once the download of 
+        #their ranges starts.  the ranges are downloaded on the part pool for the same reason parts are uploaded there
+        TransferScheduler.SetPriority(0)
+        #artifacts downloaded to a directory are named by the service, so they can't be served from the cache
+        if self._cache is None or os.path.isdir(abspath):
+            return self._dumpSvc.DownloadArtifact(hash, abspath, sparse, self._partpool)
+
+        if self._cache.TryMaterialize(hash, abspath):
+            return True
+
+        if self._dumpSvc.DownloadArtifact(hash, abspath, sparse, self._partpool):
+            self._cache.Add(hash, abspath)
+            return True
+
+        return False
+
+    def _download_to_many(self, hash, destinations):
+        abspath, sparse = destinations[0]
+        if not self._download(hash, abspath, sparse):
+            return False
+        for linkpath, _ in destinations[1:]:
+            FileUtils._link_or_copy(abspath, linkpath)
+        return True
+
+    def _prepare_upload(self, dumpid, abspath):
+        TransferScheduler.SetPriority(os.path.getsize(abspath))
+        Output.Diagnostic('uncompressed file size: %s Kb'%(str(os.path.getsize(abspath) / 1024)))
+        if self._use_resumable_upload(abspath):
+            return Continuation(self._iopool, self._resumable_upload, (dumpid, abspath, self._prepare_resumable_upload(abspath)))
+        codec = FileUtils._select_codec(abspath, self._codec)
+        if self._streaming:
+            #the hash is part of the upload url so it must be calculated before the compressed content is streamed
+            return Continuation(self._iopool, self._upload_streamed, (dumpid, abspath, self._hash(abspath), codec))
+        tempPath = os.path.join(tempfile.gettempdir(), tempfile.mktemp())
+        try:
+            hash = FileTransferManager._hash_and_compress(abspath, tempPath, codec)
+        except:
+            FileUtils._try_remove(tempPath)
+            raise
+        Output.Diagnostic('compressed file size:   %s Kb'%(str(os.path.getsize(tempPath) / 1024)))
+        return Continuation(self._iopool, self._upload_compressed, (dumpid, abspath, hash, tempPath, codec))
+
+    def _upload_streamed(self, dumpid, abspath, hash, codec):
+        TransferScheduler.SetPriority(os.path.getsize(abspath))
+        self._dumpSvc.UploadArtifact(dumpid, self._localpath(abspath), hash, FileTransferManager._iter_hash_and_compress(abspath, hash, codec), codec)
+        return hash
+
+    def _upload_compressed(self, dumpid, abspath, hash, tempPath, codec):
+        TransferScheduler.SetPriority(os.path.getsize(abspath))
+        try:
+            with open(tempPath, 'rb') as fUpld:
+                self._dumpSvc.UploadArtifact(dumpid, self._localpath(abspath), hash, fUpld, codec)   
+        finally:
+            try:
+                os.remove(tempPath)
+            except:
+                Output.Message('WARNING: failed to remove temp file %s'%(tempPath))
+        return hash  
+
+    def UploadDump(self, dumppath, incpaths, origin, displayname, localpath = None):
+        #
+        if localpath is not None:
+            self._localpaths[dumppath] = localpath
+        try:
+            return self._upload_dump(dumppath, origin, displayname)
+        finally:
+            if localpath is not None:
+                self._localpaths.pop(dumppath, None)
+
+    def _upload_dump(self, dumppath, origin, displayname):
+        hash = None                                                      
+        Output.Message('processing dump file %s'%(dumppath))
+        TransferScheduler.SetPriority(os.path.getsize(dumppath))
+        Output.Diagnostic('uncompressed file size: %s Kb'%(str(os.path.getsize(dumppath) / 1024)))
+        if self._use_resumable_upload(dumppath):
+            hash = self._resumable_upload(None, dumppath, self._prepare_resumable_upload(dumppath), (origin, displayname))
+            return { 'dumplingId' : hash, 'opToken' : None }
+        codec = FileUtils._select_codec(dumppath, self._codec)
+        if self._streaming:
+            hash = FileUtils._hash(dumppath)
+            return self._dumpSvc.UploadDump(self._localpath(dumppath), hash, origin, displayname, FileTransferManager._iter_hash_and_compress(dumppath, hash, codec), codec)
+        tempPath = os.path.join(tempfile.gettempdir(), tempfile.mktemp())
+        hash = FileTransferManager._hash_and_compress(dumppath, tempPath, codec)
+        Output.Diagnostic('compressed file size:   %s Kb'%(str(os.path.getsize(tempPath) / 1024)))
+        with open(tempPath, 'rb') as fUpld:
+            dumpData = self._dumpSvc.UploadDump(self._localpath(dumppath), hash, origin, displayname, fUpld, codec)   
+        os.remove(tempPath)
+        return dumpData
+
+    def _localpath(self, abspath):
+        return self._localpaths.get(abspath, abspath)
+
+    def _use_resumable_upload(self, path):
+        #resumable uploads write a compressed copy of the file to disk, so streamed uploads are never resumable
+        return not self._streaming and self._uploadstatedir is not None and os.path.getsize(path) >= FileTransferManager.s_resumablethreshold
+
+    def _prepare_resumable_upload(self, abspath):
+        #compresses the file into the upload state directory unless a previous attempt already did, returns the prepared 
+        #upload as (statepath, comppath, state)
+        st = os.stat(abspath)
+        statekey = hashlib.sha1('%s|%s|%s'%(abspath, st.st_size, st.st_mtime)).hexdigest()
+        statepath = os.path.join(self._uploadstatedir, statekey + '.json')
+        comppath = os.path.join(self._uploadstatedir, statekey + '.gz')
+        state = FileTransferManager._load_upload_state(statepath)
+
+        if state is None or not os.path.isfile(comppath) or os.path.getsize(comppath) != state['compsize']:
+            codec = FileUtils._select_codec(abspath, self._codec)
+            hash = FileTransferManager._hash_and_compress(abspath, comppath, codec)
+            state = { 'hash': hash, 'codec': codec, 'compsize': os.path.getsize(comppath), 'partsize': FileTransferManager.s_partsize, 'dumpid': None, 'uploadid': None }
+            FileUtils._write_json_atomic(statepath, state)
+            Output.Diagnostic('compressed file size:   %s Kb'%(str(state['compsize'] / 1024)))
+        else:
+            Output.Message('resuming upload of %s'%(abspath))
+
+        return (statepath, comppath, state)
+
+    def _resumable_upload(self, dumpid, abspath, prepared, dumpinfo = None):
+        #large files are uploaded in fixed size parts so an interrupted upload resumes from the parts the service has already
+        #acknowledged.  the compressed file and the upload state are kept in the upload state directory until the upload is 
+        #committed, so the upload can also be resumed by a later process if this one is killed.  if dumpinfo is specified 
+        #as (origin, displayname) the file is uploaded as a new dump rather than an artifact of dumpid
+        statepath, comppath, state = prepared
+        size = os.path.getsize(abspath)
+        TransferScheduler.SetPriority(size)
+        hash = state['hash']
+        codec = state.get('codec', 'gzip')
+
+        if dumpinfo is not None:
+            self._dumpSvc.CreateDump(hash, dumpinfo[0], dumpinfo[1])
+            dumpid = hash
+
+        acked = None
+
+        if state['uploadid'] is not None and state['dumpid'] == dumpid:
+            acked = self._dumpSvc.GetUploadParts(state['uploadid'])
+
+        if acked is None:
+            acked = set()
+            state['uploadid'] = self._dumpSvc.CreateUpload(dumpid, self._localpath(abspath), hash, state['compsize'], state['partsize'], codec)
+            state['dumpid'] = dumpid
+            #if the service doesn't support resumable uploads fall back to uploading the compressed file in one request
+            if state['uploadid'] is None:
+                with open(comppath, 'rb') as fUpld:
+                    self._dumpSvc.UploadArtifact(dumpid, self._localpath(abspath), hash, fUpld, codec)
+                FileTransferManager._remove_upload_state(statepath, comppath)
+                return hash
+            FileUtils._write_json_atomic(statepath, state)
+
+        partcount = max(1, (state['compsize'] + state['partsize'] - 1) / state['partsize'])
+
+        tasks = [ self._partpool.queue_work(self._upload_part, args=(state['uploadid'], comppath, i, state['partsize'], size)) for i in range(partcount) if i not in acked ]
+
+        #the remaining parts are still uploaded after a part fails, as every acknowledged part is kept by the service for 
+        #the next attempt
+        failed = [ ]
+        for t in tasks:
+            try:
+                t.await_result()
+            except Exception as e:
+                failed.append(e)
+
+        if len(failed) > 0:
+            Output.Message('WARNING: %s of %s parts of %s failed to upload, the upload will resume if the command is run again'%(len(failed), partcount, abspath))
+            raise failed[0]
+
+        self._dumpSvc.CommitUpload(state['uploadid'])
+
+        FileTransferManager._remove_upload_state(statepath, comppath)
+
+        return hash
+
+    def _upload_part(self, uploadid, comppath, index, partsize, size):
+        TransferScheduler.SetPriority(size)
+        with open(comppath, 'rb') as fComp:
+            fComp.seek(index * partsize)
+            data = fComp.read(partsize)
+        self._dumpSvc.UploadPart(uploadid, index, hashlib.sha1(data).hexdigest(), data)
+
+    @staticmethod
+    def _load_upload_state(statepath):
+        if not os.path.isfile(statepath):
+            return None
+        try:
+            with open(statepath, 'r') as fState:
+                return json.load(fState)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _remove_upload_state(statepath, comppath):
+        FileUtils._try_remove(statepath)
+        FileUtils._try_remove(comppath)
+
+    @staticmethod
+    def _hash_and_compress(inpath, outpath, codec = 'gzip'):
+        #large files are gzipped on all available cores, small files aren't worth the overhead of the process pool.  the other
+        #codecs are either multithreaded already or cheap enough not to need it
+        if codec == 'gzip' and FileUtils._use_parallel_compression(inpath):
+            return FileUtils._hash_and_compress_parallel(inpath, outpath)
+        return FileUtils._hash_and_compress(inpath, outpath, codec)
+
+    @staticmethod
+    def _iter_hash_and_compress(inpath, expectedhash, codec = 'gzip'):
+        return FileUtils._iter_hash_and_compress(inpath, expectedhash, codec == 'gzip' and FileUtils._use_parallel_compression(inpath), codec)
+
+class _TriageJob:
+    def __init__(self, dumpid, dumppath):
+        self.dumpid = dumpid
+        self.dumppath = dumppath
+        self.memory = TriageScheduler._estimate_memory(dumppath)
+        self.proc = None
+        self.worker = None
+        self.started = None
+        self.outpath = None
+        self.logpath = None
+
+class _TriageWorker:
+    #a long lived debugger with sos and the triage script loaded which triages one dump at a time sent to it as commands
+    #over its stdin.  the target of each dump is deleted once it is triaged, and the debugger is replaced after 
+    #s_maxjobs dumps to bound the memory held by the modules it keeps loaded.  the debugger writes a marker file once the
+    #commands of a dump have run as its output isn't piped
+    s_maxjobs = 50
+
+    def __init__(self, dbgpath, setupcmds):
+        self._dbgpath = dbgpath
+        self._setupcmds = setupcmds
+        self._jobcount = 0
+        self._failed = False
+        self._markerpath = None
+        self.proc = None
+        self.logpath = None
+        self.job = None
+
+    def Submit(self, job, dbgcmds):
+        if self.proc is None or self.proc.poll() is not None or self._jobcount >= _TriageWorker.s_maxjobs:
+            self.Close()
+            self._start()
+
+        self.job = job
+        self._jobcount += 1
+        self._markerpath = job.outpath + '.done'
+        
+        dbgcmds = dbgcmds + [ 'target delete --all', 'script open(%r, "w").close()'%(self._markerpath) ]
+
+        Output.Diagnostic('Debugger commands: %s'%('; '.join(dbgcmds)))
+
+        try:
+            self.proc.stdin.write(''.join(str(cmd) + '\n' for cmd in dbgcmds))
+            self.proc.stdin.flush()
+        except IOError:
+            #the debugger exited, the job completes as failed on the next poll
+            pass
+
+    def Poll(self):
+        #returns True once the commands of the current job have run or the debugger has exited
+        if os.path.exists(self._markerpath):
+            FileUtils._try_remove(self._markerpath)
+            self.job = None
+            return True
+        if self.proc.poll() is not None:
+            self.job = None
+            self._failed = True
+            return True
+        return False
+
+    def Fail(self):
+        #the log of a debugger which failed to triage a dump is kept
+        self._failed = True
+
+    def Kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        FileUtils._try_remove(self._markerpath)
+        self.job = None
+        self._failed = True
+
+    def Close(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                try:
+                    self.proc.stdin.write('exit\n')
+                    self.proc.stdin.close()
+                except IOError:
+                    pass
+                self.proc.wait()
+            if not self._failed:
+                FileUtils._try_remove(self.logpath)
+        self.proc = None
+
+    def _start(self):
+        procArgs = TriageScheduler.GetDebuggerArgs(self._dbgpath, self._setupcmds)
+
+        Output.Diagnostic('Debugger command: %s'%(' '.join(procArgs)))
+
+        #the debugger output is written to a log rather than a pipe, piping the output of lldb has caused it to segfault
+        logfd, self.logpath = tempfile.mkstemp(suffix='.triage.log')
+        with os.fdopen(logfd, 'w') as log:
+            self.proc = subprocess.Popen(procArgs, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+        self._jobcount = 0
+        self._failed = False
+
+class TriageScheduler:
+    #runs the full triage of many dumps, each in its own debugger process.  up to maxprocs debuggers run concurrently and
+    #a debugger is only started while the estimated memory of the running debuggers fits in the memory budget, as a 
+    #debugger triaging a large core can take gigabytes.  debuggers which run past the timeout are killed.  the properties
+    #written by analyze are sent to the service as soon as each triage completes.  persistent schedulers triage the dumps
+    #on long lived debuggers rather than starting a debugger for each dump
+    s_pollinterval = 0.25
+    #the memory a debugger is estimated to use as a multiple of the allocated size of the core it triages
+    s_memfactor = 1.0
+
+    def __init__(self, dumpSvc, dbgpath, installpath, maxprocs = None, timeout = None, maxmemory = None, persistent = False):
+        self._dumpSvc = dumpSvc
+        self._dbgpath = dbgpath
+        self._installpath = installpath
+        self._maxprocs = maxprocs or multiprocessing.cpu_count()
+        self._timeout = timeout
+        #by default the budget is the memory available when the triage starts
+        self._maxmemory = maxmemory if maxmemory is not None else TriageScheduler._get_available_memory()
+        self._workers = [ ] if persistent else None
+
+    def Run(self, dumps):
+        #triages the (dumpid, dumppath) dumps and returns a dictionary of each dumpid to the result of its triage, which
+        #is one of triaged, failed or timeout
+        results = collections.OrderedDict()
+        pending = collections.deque(_TriageJob(dumpid, dumppath) for dumpid, dumppath in dumps)
+        running = [ ]
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for job in [ job for job in running if self._try_complete(job, results) ]:
+                    running.remove(job)
+
+                #dumps are started in order so a large core waiting for memory isn't starved by smaller cores behind it
+                while len(pending) > 0 and len(running) < self._maxprocs and self._can_admit(pending[0], running):
+                    job = pending.popleft()
+                    if self._start(job):
+                        running.append(job)
+                    else:
+                        results[job.dumpid] = 'failed'
+
+                if len(running) > 0:
+                    time.sleep(TriageScheduler.s_pollinterval)
+        finally:
+            for job in running:
+                self._kill(job)
+            for worker in self._workers or [ ]:
+                worker.Close()
+
+        return results
+
+    @staticmethod
+    def GetDebuggerCommands(dbgpath, installpath, dumppath, outpath):
+        #returns the debugger commands which write the analysis of the dump to outpath, or None if the triage tooling 
+        #isn't installed
+        scriptPath = os.path.join(installpath, 'analysis.py')
+
+        iniPath = os.path.join(installpath, 'triage.ini')
+
+        #if the debugger or the triage tooling is not found error and return
+        if not os.path.isfile(scriptPath) or not os.path.isfile(iniPath) or not os.path.isfile(dbgpath):
+            Output.Critical('unable to find necissary debugger and triage tooling, please ensure these componenets are intalled')
+            return None
+
+        dbgcmds = []
+        dbgcmds.append('target create --core %s' % dumppath)
+        dbgcmds.extend(TriageScheduler._get_setup_commands(dbgpath, installpath))
+        dbgcmds.append(TriageScheduler._get_analyze_command(installpath, outpath))
+        dbgcmds.append('exit')
+        return dbgcmds
+
+    @staticmethod
+    def _get_setup_commands(dbgpath, installpath):
+        sosPath = os.path.join(os.path.dirname(dbgpath), 'libsosplugin.so') 
+
+        return [ 'plugin load %s' % sosPath, 'command script import %s' % os.path.join(installpath, 'analysis.py') ]
+
+    @staticmethod
+    def _get_analyze_command(installpath, outpath):
+        iniPath = os.path.join(installpath, 'triage.ini')
+
+        return 'analyze -i %s -o %s' % ( iniPath, outpath )
+
+    @staticmethod
+    def GetDebuggerArgs(dbgpath, dbgcmds):
+        procArgs = [ str(dbgpath) ]
+
+        for dbgcmd in dbgcmds:
+            procArgs.append('-o')
+            procArgs.append(str(dbgcmd))
+
+        return procArgs
+
+    @staticmethod
+    def UpdateProperties(dumpSvc, dumpid, outpath):
+        #sends the properties written by analyze to the service, returns False if the debugger didn't write them
+        if not os.path.isfile(outpath):
+            return False
+
+        try:
+            with open(outpath, 'r') as fTriage:
+                propsDict = json.load(fTriage)
+        finally:
+            os.remove(outpath)
+
+        if len(propsDict) > 0: 
+            dumpSvc.UpdateDumpProperties(dumpid, propsDict) 
+
+        return True
+
+    def _start(self, job):
+        job.outpath = tempfile.mktemp(suffix='.triage.json')
+
+        dbgcmds = TriageScheduler.GetDebuggerCommands(self._dbgpath, self._installpath, job.dumppath, job.outpath)
+
+        if dbgcmds is None or not os.path.isfile(job.dumppath):
+            Output.Critical('ERROR: unable to triage dump %s'%(job.dumpid))
+            return False
 
-    def __init__(self, maxthreads = None):
-        self._condvar = threading.Condition(threading.RLock())
-        self._threadcount = 0
-        self._availcount = 0
-        self._queue = [ ]
-        self._emptyevent = threading.Event()
-        self._emptyevent.set()
-        self._maxthreads = maxthreads or ThreadPool.s_MaxThreads
-    
-    def queue_work(self, func, args=()):
-        self._condvar.acquire()
-                          
-        self._emptyevent.clear()
-        
-        task = Task(func, args)
+        job.started = time.time()
 
-        self._queue.append(task)
-        
-        if self._availcount == 0 and self._threadcount < self._maxthreads:
-            self._threadcount += 1
-            self._add_thread()
+        if self._workers is not None:
+            self._submit(job)
+        else:
+            procArgs = TriageScheduler.GetDebuggerArgs(self._dbgpath, dbgcmds)
 
-        self._condvar.notify()
+            Output.Diagnostic('Debugger command: %s'%(' '.join(procArgs)))
 
-        self._condvar.release()
-        
-        return task
-                
-    def wait_on_pending_work(self):
-        self._emptyevent.wait()
+            #the debugger output is written to a log rather than a pipe, piping the output of lldb has caused it to segfault
+            logfd, job.logpath = tempfile.mkstemp(suffix='.triage.log')
+            with os.fdopen(logfd, 'w') as log, open(os.devnull, 'r') as devnull:
+                job.proc = subprocess.Popen(procArgs, stdin=devnull, stdout=log, stderr=subprocess.STDOUT)
 
-    def _add_thread(self):
-        thread = threading.Thread(target=self._process_queue_items, args=())
-        thread.setDaemon(True)
-        thread.start()
+        Output.Message('triaging dump %s'%(job.dumpid))
 
-    def _process_queue_items(self):
-        while True:
-            self._condvar.acquire()
-            if len(self._queue) == 0: 
-                self._availcount = self._availcount + 1
-                if self._availcount == self._threadcount:
-                    self._emptyevent.set()
-                self._condvar.wait()
-                self._availcount = self._availcount - 1
-            task = self._queue.pop(0)
-            self._condvar.release()
-            task.execute()
- 
-        
-class FileTransferManager:
+        return True
 
-    def __init__(self, dumpSvc, maxthreads = None):
-        self._hashmap = { }
-        self._dumpSvc = dumpSvc
-        self._threadpool = ThreadPool(maxthreads)
-        self._threadpool._maxthreads
-         
-    def QueueFileDownload(self, hash, abspath):
-        return self._threadpool.queue_work(self._dumpSvc.DownloadArtifact, args=(hash, abspath))
-        
-    def QueueFileUpload(self, dumpid, abspath):
-        return self._threadpool.queue_work(self._compress_and_upload, args=(dumpid, abspath))
+    def _submit(self, job):
+        #the dump is sent to an idle worker, all the workers are busy only when maxprocs dumps are running
+        job.worker = next((w for w in self._workers if w.job is None), None)
 
-    def WaitForPendingTransfers(self):
-        self._threadpool.wait_on_pending_work()
+        if job.worker is None:
+            job.worker = _TriageWorker(self._dbgpath, TriageScheduler._get_setup_commands(self._dbgpath, self._installpath))
+            self._workers.append(job.worker)
+
+        job.worker.Submit(job, [ 'target create --core %s' % job.dumppath, TriageScheduler._get_analyze_command(self._installpath, job.outpath) ])
+
+        job.logpath = job.worker.logpath
+
+    def _try_complete(self, job, results):
+        #returns True once the debugger has finished the job or been killed
+        if not (job.worker.Poll() if job.worker is not None else job.proc.poll() is not None):
+            if self._timeout is None or time.time() - job.started < self._timeout:
+                return False
+            self._kill(job)
+            results[job.dumpid] = 'timeout'
+            Output.Critical('ERROR: the triage of dump %s timed out after %s seconds, the debugger output is in %s'%(job.dumpid, self._timeout, job.logpath))
+            return True
+
+        if job.proc is not None:
+            Output.Diagnostic('Debugger exit code %s' % job.proc.returncode)
 
-    def _compress_and_upload(self, dumpid, abspath):              
-        hash = None
-        Output.Diagnostic('uncompressed file size: %s Kb'%(str(os.path.getsize(abspath) / 1024)))
-        tempPath = os.path.join(tempfile.gettempdir(), tempfile.mktemp())
         try:
-            hash = FileUtils._hash_and_compress(abspath, tempPath)
-            Output.Diagnostic('compressed file size:   %s Kb'%(str(os.path.getsize(tempPath) / 1024)))
-            with open(tempPath, 'rb') as fUpld:
-                self._dumpSvc.UploadArtifact(dumpid, abspath, hash, fUpld)   
-        finally:
-            try:
-                os.remove(tempPath)
-            except:
-                Output.Message('WARNING: failed to remove temp file %s'%(tempPath))
-        return hash  
+            triaged = TriageScheduler.UpdateProperties(self._dumpSvc, job.dumpid, job.outpath)
+        except Exception as e:
+            Output.Critical('ERROR: unable to update the properties of dump %s: %s'%(job.dumpid, e))
+            triaged = False
+
+        if triaged:
+            results[job.dumpid] = 'triaged'
+            Output.Message('triaged dump %s in %.1fs'%(job.dumpid, time.time() - job.started))
+            if job.worker is None:
+                FileUtils._try_remove(job.logpath)
+        else:
+            if job.worker is not None:
+                job.worker.Fail()
+            results[job.dumpid] = 'failed'
+            Output.Critical('ERROR: the triage of dump %s failed, the debugger output is in %s'%(job.dumpid, job.logpath))
+        return True
+
+    def _kill(self, job):
+        #a killed worker is replaced by the next dump sent to it
+        if job.worker is not None:
+            job.worker.Kill()
+        elif job.proc.poll() is None:
+            job.proc.kill()
+            job.proc.wait()
+        FileUtils._try_remove(job.outpath)
+
+    def _can_admit(self, job, running):
+        #a dump is always started when no others are running so a core larger than the budget is still triaged
+        if len(running) == 0 or self._maxmemory is None:
+            return True
+        return sum(j.memory for j in running) + job.memory <= self._maxmemory
 
-    def UploadDump(self, dumppath, incpaths, origin, displayname):
-        #
-        hash = None                                                      
-        Output.Message('processing dump file %s'%(dumppath))
-        Output.Diagnostic('uncompressed file size: %s Kb'%(str(os.path.getsize(dumppath) / 1024)))
-        tempPath = os.path.join(tempfile.gettempdir(), tempfile.mktemp())
-        hash = FileUtils._hash_and_compress(dumppath, tempPath)
-        Output.Diagnostic('compressed file size:   %s Kb'%(str(os.path.getsize(tempPath) / 1024)))
-        with open(tempPath, 'rb') as fUpld:
-            dumpData = self._dumpSvc.UploadDump(dumppath, hash, origin, displayname, fUpld)   
-        os.remove(tempPath)
-        return dumpData
+    @staticmethod
+    def _estimate_memory(dumppath):
+        #downloaded cores are sparse so the allocated size is used rather than the file size
+        try:
+            st = os.stat(dumppath)
+        except OSError:
+            return 0
+        size = min(st.st_size, st.st_blocks * 512) if hasattr(st, 'st_blocks') else st.st_size
+        return int(size * TriageScheduler.s_memfactor)
+
+    @staticmethod
+    def _get_available_memory():
+        #returns the memory available for new processes in bytes, or None if it can't be determined
+        try:
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
 
 class CommandProcessor:
-    def __init__(self, filequeue, dumpSvc):
+    def __init__(self, filequeue, dumpSvc, spool = None):
         self._dumpSvc = dumpSvc
         self._filequeue = filequeue
+        self._spool = spool
 
     def Process(self, config):
         if config.command == 'upload':
-            self.Upload(config)
+            return self.Upload(config)
         elif config.command == 'update':
             self.Update(config)
         elif config.command == 'download':
@@ -539,6 +2650,12 @@ class CommandProcessor:
             self.Install(config)
         elif config.command == 'debug':
             self.Debug(config)
+        elif config.command == 'daemon':
+            self.Daemon(config)
+        elif config.command == 'drain':
+            return self.Drain(config)
+        elif config.command == 'triage':
+            self.Triage(config)
      
     def Install(self, config):
         
@@ -610,8 +2727,8 @@ class CommandProcessor:
         self.UpdateProperties(config.dumpid, config, None)
 
         if config.incpaths:
-            for f in FileUtils._enumerate_unique_files(config.incpaths):
-                self._filequeue.QueueFileUpload(config.dumpid, f)
+            statkeys = { }
+            self._filequeue.UploadFiles(config.dumpid, FileUtils._enumerate_unique_files(config.incpaths, statkeys), statkeys=statkeys)
 
     def Upload(self, config):
         
@@ -620,12 +2737,27 @@ class CommandProcessor:
         #if nothing was specified to upload
         if config.dumppath is None and (config.incpaths is None or len(config.incpaths) == 0):
             Output.Critical('No artifacts or dumps were specified to upload, either --dumppath or --incpaths is required to upload')
+            return 1
 
-        #if dumppath was specified call create dump and upload dump
-        if config.dumppath is not None:
-            self.UploadDump(config)
-        else:
-            self.UploadArtifacts(config)
+        if config.spool and self._spool is not None:
+            self._spool_upload(config)
+            return
+
+        #if the service can't be reached the upload is spooled and retried by a later drain rather than lost
+        try:
+            #if dumppath was specified call create dump and upload dump
+            if config.dumppath is not None:
+                self.UploadDump(config)
+            else:
+                self.UploadArtifacts(config)
+        except Exception as e:
+            if not self._can_spool(e):
+                raise
+            Output.Message('WARNING: the dumpling service is unreachable, the upload will be retried by dumpling drain: %s'%(e))
+            self._spool_upload(config)
+
+    def _can_spool(self, e):
+        return self._spool is not None and UploadSpool.IsTransientError(e)
 
 
     def UploadDump(self, config):
@@ -652,9 +2784,14 @@ class CommandProcessor:
         requestpaths = set() #set(dumpdata['refPaths'])      
         
         incpaths = set()
+
+        statkeys = { }
           
+        if config.modules:
+            incpaths.update(CommandProcessor._get_core_modules(config.dumppath))
+
         if not (config.incpaths is None or len(config.incpaths) == 0):
-            incpaths = FileUtils._enumerate_unique_files(config.incpaths)
+            incpaths.update(FileUtils._enumerate_unique_files(config.incpaths, statkeys))
             #if the dump file is in the incpaths remove it as it has already been uploaded
             incpaths.discard(os.path.abspath(config.dumppath))
             requestpaths.difference_update(incpaths)
@@ -667,18 +2804,30 @@ class CommandProcessor:
             if Output.Prompt_YN(prompt):
                 incpaths.update(requestpaths)
     
-        for f in incpaths:
-            self._filequeue.QueueFileUpload(dumpid, f) 
-
-        self._filequeue.WaitForPendingTransfers();
-        
-        Output.Message('dumplingid:  %s'%(dumpid))
-        Output.Critical('%sapi/dumplings/archived/%s'%(config.url, dumpid ))
+        #the dump itself has been uploaded so report its id even if some of the included files fail to upload.  if the service
+        #becomes unreachable only the included files are spooled, to be linked to the uploaded dump by a later drain
+        try:
+            self._filequeue.UploadFiles(dumpid, incpaths, statkeys=statkeys)
+        except Exception as e:
+            if not self._can_spool(e):
+                raise
+            Output.Message('WARNING: the dumpling service is unreachable, the included files will be uploaded by dumpling drain: %s'%(e))
+            self._spool.Add(None, config.user, config.displayname, incpaths, None, dumpid)
+        finally:
+            Output.Message('dumplingid:  %s'%(dumpid))
+            Output.Critical('%sapi/dumplings/archived/%s'%(config.url, dumpid ))
 
         return dumpid
 
     def UpdateProperties(self, dumpid, config, props):
 
+        props = self._get_properties(config, props)
+
+        if len(props) > 0: 
+            self._dumpSvc.UpdateDumpProperties(dumpid, props)      
+
+    def _get_properties(self, config, props):
+
         props = props or { }
 
         if config.properties is not None:
@@ -688,21 +2837,53 @@ class CommandProcessor:
             
         
         if config.propfile is not None:
+            #the propfile is read again if an upload which already read it is spooled
+            try:
+                config.propfile.seek(0)
+            except IOError:
+                pass
             loadedProps = json.load(config.propfile)              
             for kvp in loadedProps.iteritems():
                 if kvp is not None:
                     CommandProcessor._add_key_if_not_exists(props, kvp[0], kvp[1]) 
 
-        if len(props) > 0: 
-            self._dumpSvc.UpdateDumpProperties(dumpid, props)      
-                
+        return props
+
+    def _spool_upload(self, config):
+        dumppath = os.path.abspath(config.dumppath) if config.dumppath is not None else None
+
+        incpaths = set(FileUtils._enumerate_unique_files(config.incpaths)) if config.incpaths else set()
+
+        props = None
+
+        if dumppath is not None:
+            if config.displayname is None:
+                config.displayname = str('%s.%.7f'%(getpass.getuser().lower(), time.time()))
+
+            if config.modules:
+                incpaths.update(CommandProcessor._get_core_modules(dumppath))
+
+            incpaths.discard(dumppath)
+
+            props = None if config.triage == 'none' else CommandProcessor._get_client_triage_properties()
+
+            if config.triage == 'full':
+                Output.Message('WARNING: full triage is not run for spooled uploads')
+
+        self._spool.Add(dumppath, config.user, config.displayname, incpaths, self._get_properties(config, props))
+
+    def Drain(self, config):
+        #returns the exit code of the command, which fails while uploads remain spooled
+        remaining = self._spool.Drain(self._filequeue, self._dumpSvc, force=True)
+        if remaining > 0:
+            Output.Critical('%s spooled uploads could not be uploaded and remain spooled'%(remaining))
+            return 1
+        return 0
 
     def UploadArtifacts(self, config):
         if config.incpaths:
-            for f in FileUtils._enumerate_unique_files(config.incpaths):
-                self._filequeue.QueueFileUpload(None, f)
-        
-        self._filequeue.WaitForPendingTransfers();
+            statkeys = { }
+            self._filequeue.UploadFiles(None, FileUtils._enumerate_unique_files(config.incpaths, statkeys), statkeys=statkeys)
     
     def Download(self, config):
         
@@ -731,6 +2912,36 @@ class CommandProcessor:
             
             self._download_dump(dir, dumpManifest)
 
+        elif config.dumpidsfile is not None:
+            self._download_dumps(dir, CommandProcessor._read_dumpids(config.dumpidsfile))
+
+    def Triage(self, config):
+        if config.dbgpath is None:
+            Output.Critical('dbgpath must be specified either as an argument or in the dumpling config to preform a full dump triage')
+            return
+
+        if config.dumps:
+            dumps = [ (dumpid, os.path.abspath(path)) for dumpid, path in config.dumps ]
+        else:
+            dumpids = [ config.dumpid ] if config.dumpid is not None else CommandProcessor._read_dumpids(config.dumpidsfile)
+
+            dumplingDirs = self._download_dumps(os.path.abspath(config.downdir), dumpids)
+
+            dumps = [ d for d in (CommandProcessor._get_dump_core(dir) for dir in dumplingDirs) if d is not None ]
+
+        maxmemory = int(config.triagememory) * 1024 * 1024 if config.triagememory else None
+
+        scheduler = TriageScheduler(self._dumpSvc, config.dbgpath, config.installpath, config.triageprocs, int(config.triagetimeout) or None, maxmemory, config.persistent)
+
+        results = scheduler.Run(dumps)
+
+        counts = collections.Counter(results.values())
+
+        Output.Message('triaged %s dumps, %s failed, %s timed out'%(counts['triaged'], counts['failed'], counts['timeout']))
+
+    def Daemon(self, config):
+        DumplingDaemon(config.socketpath or DumplingDaemon.GetSocketPath(config), self, int(config.draininterval)).Serve()
+
     def Debug(self, config):
         if config.dbgpath is None:
             Output.Critical('dbgpath must be specified either as an argument or in the dumpling config to use the debug command')
@@ -815,69 +3026,109 @@ class CommandProcessor:
             Output.Critical('dbgpath must be specified either as an argument or in the dumpling config to preform a full dump triage')
             return
 
-        scriptPath = os.path.join(config.installpath, 'analysis.py')
-
-        iniPath = os.path.join(config.installpath, 'triage.ini')
-
-        sosPath = os.path.join(os.path.dirname(config.dbgpath), 'libsosplugin.so') 
-        
-        #if the debugger or the triage tooling is not found error and return
-        if not os.path.isfile(scriptPath) or not os.path.isfile(iniPath) or not os.path.isfile(config.dbgpath):
-            Output.Critical('unable to find necissary debugger and triage tooling, please ensure these componenets are intalled')
-            return
-
         triageOut = os.path.join(tempfile.gettempdir(), tempfile.mktemp())
 
         #define the debugger commands to execute
-        dbgcmds = []
-        dbgcmds.append('target create --core %s' % dumppath)
-        dbgcmds.append('plugin load %s' % sosPath)
-        dbgcmds.append('command script import %s' % scriptPath)
-        dbgcmds.append('analyze -i %s -o %s' % ( iniPath, triageOut ))
-        dbgcmds.append('exit')
+        dbgcmds = TriageScheduler.GetDebuggerCommands(config.dbgpath, config.installpath, dumppath, triageOut)
+
+        if dbgcmds is None:
+            return
 
         #execute the debugger commands to triage the dump file
         CommandProcessor._load_debugger(config.dbgpath, dbgcmds)
 
         #if the debugger wrote out the triage output file as expected load it and update the dump properties
-        if os.path.isfile(triageOut):
-            #load the output of analyze
-            with open(triageOut, 'r') as fTriage:
-                propsDict = json.load(fTriage)
-            
-                if len(propsDict) > 0: 
-                    self._dumpSvc.UpdateDumpProperties(dumpid, propsDict) 
-        
-            #delete the temporary triage props file
-            os.remove(triageOut)
         #if the debugger did not write the triage output file message and return
-        else:
+        if not TriageScheduler.UpdateProperties(self._dumpSvc, dumpid, triageOut):
             Output.Message('WARNING: Debugger triage analysis failed')
 
             
     def _download_dump(self, dir, dumpManifest):
-        dumplingDir = os.path.join(dir, dumpManifest['displayName'])
-            
-        if not os.path.exists(dumplingDir):
-            FileUtils._ensure_dir(dumplingDir)
+        dumplingDir = self._create_dumpling_dir(os.path.join(dir, dumpManifest['displayName']), dumpManifest)
 
         #download all the artifacts for the dump
-        for da in dumpManifest['dumpArtifacts']:
-            if 'hash' in da and 'relativePath' in da:
-                hash = da['hash']
-                relPath = da['relativePath']
-                if hash and relPath:
-                    self._filequeue.QueueFileDownload(hash, os.path.join(dumplingDir, relPath)) 
+        for hash, path, sparse in CommandProcessor._get_dump_artifacts(dumplingDir, dumpManifest):
+            self._filequeue.QueueFileDownload(hash, path, sparse) 
+ 
+        self._filequeue.WaitForPendingTransfers();
+
+        return dumplingDir
+
+    def _download_dumps(self, dir, dumpids):
+        #the manifests are retrieved in parallel and the artifacts of all the dumps are downloaded together, an artifact 
+        #shared by several dumps (the same runtime binaries, or the same core uploaded twice) is only downloaded once and
+        #linked into the other dump directories
+        manifesttasks = [ (id, self._filequeue.QueueManifestDownload(id)) for id in collections.OrderedDict.fromkeys(dumpids) ]
+
+        dumplingDirs = [ ]
+        targets = { }
+        artifactcount = 0
+        for dumpid, task in manifesttasks:
+            try:
+                dumpManifest = task.await_result()
+            except Exception as e:
+                Output.Message('WARNING: unable to retrieve the manifest of dump %s, the dump will not be downloaded: %s'%(dumpid, e))
+                continue
+
+            #dumps commonly share a display name, the dump id keeps their directories apart
+            dumplingDir = os.path.join(dir, dumpManifest['displayName'])
+            if dumplingDir in dumplingDirs:
+                dumplingDir = '%s.%s'%(dumplingDir, dumpid)
+            dumplingDirs.append(self._create_dumpling_dir(dumplingDir, dumpManifest))
+
+            for hash, path, sparse in CommandProcessor._get_dump_artifacts(dumplingDir, dumpManifest):
+                targets.setdefault(hash, [ ]).append((path, sparse))
+                artifactcount += 1
+
+        Output.Message('downloading %s unique artifacts for %s artifacts in %s dumps'%(len(targets), artifactcount, len(dumplingDirs)))
+
+        self._filequeue.DownloadFiles(targets)
+
+        return dumplingDirs
+
+    def _create_dumpling_dir(self, dumplingDir, dumpManifest):
+        if not os.path.exists(dumplingDir):
+            FileUtils._ensure_dir(dumplingDir)
         
         #save the manifest at the root 
         manifestPath = os.path.join(dumplingDir, 'manifest.json')
 
         with open(manifestPath, 'w') as manFile:
             _json_format_tofile(dumpManifest, manFile)
- 
-        self._filequeue.WaitForPendingTransfers();
 
         return dumplingDir
+
+    @staticmethod
+    def _get_dump_core(dumplingDir):
+        #returns the (dumpid, dumppath) of the core downloaded to the dumpling dir, the core is the artifact whose hash is
+        #the dump id
+        with open(os.path.join(dumplingDir, 'manifest.json'), 'r') as manFile:
+            dumpManifest = json.load(manFile)
+
+        dumpart = next((da for da in dumpManifest['dumpArtifacts'] if da.get('hash') and da.get('hash') == da.get('dumpId')), None)
+
+        if dumpart is None:
+            Output.Message('WARNING: the dump in %s does not have a dump file associated with it, it will not be triaged'%(dumplingDir))
+            return None
+
+        return (dumpart['dumpId'], os.path.join(dumplingDir, dumpart['relativePath']))
+
+    @staticmethod
+    def _read_dumpids(path):
+        with open(path, 'r') as fIds:
+            return [ line.strip() for line in fIds if line.strip() and not line.strip().startswith('#') ]
+
+    @staticmethod
+    def _get_dump_artifacts(dumplingDir, dumpManifest):
+        artifacts = [ ]
+        for da in dumpManifest['dumpArtifacts']:
+            if 'hash' in da and 'relativePath' in da:
+                hash = da['hash']
+                relPath = da['relativePath']
+                if hash and relPath:
+                    #core dumps are mostly zeros so the dump itself is restored as a sparse file
+                    artifacts.append((hash, os.path.join(dumplingDir, relPath), hash == da.get('dumpId')))
+        return artifacts
     
     @staticmethod         
     #TODO: Replace this with _load_debugger after refactoring callers
@@ -900,11 +3151,7 @@ class CommandProcessor:
     #      refactored to accomidate the slight difference in functionality.
     def _load_debugger(debuggerPath, debuggerCommands):
                                   
-        procArgs = [ str(debuggerPath) ]
-
-        for dbgcmd in debuggerCommands:
-            procArgs.append('-o')
-            procArgs.append(str(dbgcmd))
+        procArgs = TriageScheduler.GetDebuggerArgs(debuggerPath, debuggerCommands)
                      
         dbgcmdline =  ' '.join(procArgs)   
   
@@ -925,6 +3172,31 @@ class CommandProcessor:
         Output.Diagnostic('Debugger exit code %s' % returncode)
 
     
+    @staticmethod
+    def _get_core_modules(dumppath):
+        #returns the paths of the local modules mapped into the ELF core dump, modules which have been replaced since the dump
+        #was taken are skipped as they won't match the build id in the dump
+        try:
+            with ElfCore(dumppath) as core:
+                modules = core.Modules()
+        except (ValueError, struct.error, EnvironmentError) as e:
+            Output.Message('WARNING: unable to read the modules of %s, they will not be uploaded: %s'%(dumppath, e))
+            return set()
+
+        paths = set()
+        for path, buildid in sorted(modules.iteritems()):
+            if not os.path.isfile(path):
+                Output.Diagnostic('mapped file %s is not present locally'%(path))
+                continue
+            localid = ElfCore._file_build_id(path)
+            if localid is None and not FileUtils._is_elf(path):
+                continue
+            if buildid is not None and localid is not None and localid != buildid:
+                Output.Message('WARNING: module %s does not match the build id %s in the dump, it will not be uploaded'%(path, buildid))
+                continue
+            paths.add(os.path.abspath(path))
+        return paths
+
     @staticmethod
     def _get_client_triage_properties():
         dictProp = { }
@@ -946,6 +3218,223 @@ class CommandProcessor:
         if not key in dictProp:
             dictProp[key] = val
 
+class _DaemonOutput:
+    #file like object which forwards the output of a command run by the daemon to the connected client as json messages
+    def __init__(self, sock, stream):
+        self._sock = sock
+        self._stream = stream
+        self._connected = True
+
+    def write(self, text):
+        if not self._connected or not text:
+            return
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        try:
+            self._sock.sendall(json.dumps({ self._stream: text }) + '\n')
+        except socket.error:
+            #the client went away, the command is still run to completion
+            self._connected = False
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class _DaemonRequestHandler:
+    #handles a single client connection, this doesn't derive from SocketServer's handlers so SocketServer is only imported
+    #by the daemon
+    def __init__(self, sock, address, server):
+        try:
+            request = json.loads(sock.makefile('r').readline())
+        except ValueError:
+            request = None
+        messages = [ ]
+        if _DaemonRequestHandler._is_valid(request):
+            exitcode = server.dumplingdaemon.RunCommand(request['argv'], request['cwd'], sock)
+        else:
+            messages.append({ 'stderr': 'ERROR: the dumpling daemon received a malformed request\n' })
+            exitcode = 1
+        messages.append({ 'exit': exitcode })
+        try:
+            for message in messages:
+                sock.sendall(json.dumps(message) + '\n')
+        except socket.error:
+            pass
+
+    @staticmethod
+    def _is_valid(request):
+        #the request is { 'argv': [ args ], 'cwd': path } as sent by _forward_to_daemon
+        if not isinstance(request, dict) or not isinstance(request.get('cwd'), basestring):
+            return False
+        argv = request.get('argv')
+        return isinstance(argv, list) and all([ isinstance(arg, basestring) for arg in argv ])
+
+class DumplingDaemon:
+    #commands which can be forwarded to the daemon, the others prompt, launch the debugger or change the saved config
+    s_commands = { 'upload', 'update', 'download', 'drain' }
+    #the settings used to create a command processor, commands with the same settings share a warm command processor
+    s_processorargs = ( 'url', 'engine', 'concurrency', 'retries', 'backoff', 'cachesize', 'installpath', 'configpath', 'streaming', 'codec', 'resumable' )
+
+    def __init__(self, socketpath, cmdProc = None, draininterval = 0):
+        self._socketpath = socketpath
+        self._lock = threading.Lock()
+        self._processors = { }
+        self._server = None
+        #the daemon drains the spool of its own command processor every draininterval seconds
+        self._cmdProc = cmdProc
+        self._draininterval = draininterval
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def GetSocketPath(config = None):
+        #the thin client doesn't parse its arguments so it finds the daemon through DUMPLING_SOCKET or the saved config
+        if 'DUMPLING_SOCKET' in os.environ:
+            return os.environ['DUMPLING_SOCKET']
+        config = config or DumplingConfig.Load(_get_default_configpath()) or DumplingConfig({ })
+        return os.path.join(config.installpath, 'dumpling.sock')
+
+    def Serve(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            Output.Critical('ERROR: the dumpling daemon requires unix domain sockets which are not supported on this platform')
+            return
+
+        FileUtils._ensure_parent_dir(self._socketpath)
+
+        #a socket left behind by a daemon which didn't exit cleanly is removed, a socket with a live daemon is left alone
+        if os.path.exists(self._socketpath):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._socketpath)
+                Output.Critical('ERROR: a dumpling daemon is already listening on %s'%(self._socketpath))
+                return
+            except socket.error:
+                FileUtils._try_remove(self._socketpath)
+            finally:
+                sock.close()
+
+        #the daemon runs commands in the callers working directory, only the owner may connect to it
+        umask = os.umask(stat.S_IRWXG | stat.S_IRWXO)
+        try:
+            self._server = SocketServer.ThreadingUnixStreamServer(self._socketpath, _DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        self._server.dumplingdaemon = self
+
+        Output.Message('dumpling daemon listening on %s'%(self._socketpath))
+
+        if self._cmdProc is not None and self._cmdProc._spool is not None and self._draininterval > 0:
+            drainthread = threading.Thread(target=self._drain_spool)
+            drainthread.setDaemon(True)
+            drainthread.start()
+
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+            FileUtils._try_remove(self._socketpath)
+
+    def Shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _drain_spool(self):
+        while not self._stopped.is_set():
+            #commands and drains share the output streams so they don't run at the same time
+            with self._lock:
+                try:
+                    self._cmdProc._spool.Drain(self._cmdProc._filequeue, self._cmdProc._dumpSvc)
+                except Exception as e:
+                    Output.Critical('ERROR: draining the spool failed: %s'%(e))
+            self._stopped.wait(self._draininterval)
+
+    def RunCommand(self, argv, cwd, sock):
+        #commands run one at a time as they share the working directory, the output settings and the standard streams
+        with self._lock:
+            stdout, stderr = sys.stdout, sys.stderr
+            prevcwd = os.getcwd()
+            sys.stdout = _DaemonOutput(sock, 'stdout')
+            sys.stderr = _DaemonOutput(sock, 'stderr')
+            try:
+                os.chdir(cwd)
+                return self._run_command(argv)
+            except SystemExit as e:
+                #argparse exits on invalid arguments and -h
+                return e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception as e:
+                Output.Critical('ERROR: %s'%(e))
+                return 1
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+                os.chdir(prevcwd)
+
+    def _run_command(self, argv):
+        starttime = datetime.datetime.now()
+
+        config = _parse_args(argv)
+
+        _init_output(config)
+
+        #there is no one to answer a prompt
+        Output.s_noprompt = True
+
+        if config.command not in DumplingDaemon.s_commands:
+            Output.Critical('ERROR: the %s command can not be run by the dumpling daemon'%(config.command))
+            return 1
+
+        key = tuple([ config.__dict__.get(arg) for arg in DumplingDaemon.s_processorargs ])
+        if key in self._processors:
+            _configure_transfer_scheduler(config)
+        else:
+            self._processors[key] = _create_command_processor(config)
+
+        exitcode = _process_command(config, self._processors[key])
+
+        Output.Message('total elapsed time %s'%(datetime.datetime.now() - starttime))
+
+        return exitcode
+
+def _forward_to_daemon(argv):
+    #runs the command in the dumpling daemon if one is listening, this avoids the startup of the client and reuses its 
+    #connections and caches.  returns the exit code of the command, or None if the command should be run in process 
+    if '--nodaemon' in argv or not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    if _find_command(argv) not in DumplingDaemon.s_commands:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    received = False
+    try:
+        sock.connect(DumplingDaemon.GetSocketPath())
+        sock.sendall(json.dumps({ 'argv': argv, 'cwd': os.getcwd() }) + '\n')
+        for line in sock.makefile('r'):
+            message = json.loads(line)
+            received = True
+            if 'exit' in message:
+                return message['exit']
+            for stream, text in message.iteritems():
+                (sys.stderr if stream == 'stderr' else sys.stdout).write(text.encode('utf-8'))
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+
+    #the command may have partially run if the daemon went away after it started, it isn't run again
+    if received:
+        Output.Critical('ERROR: the connection to the dumpling daemon was lost')
+        return 1
+
+    return None
+
+def _get_default_configpath():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dumpling.config.json')
+
 def _get_default_dbgargs():
     if platform.system().lower() == 'windows':
         return [ '-z', '$(dumppath)' ]
@@ -954,8 +3443,11 @@ def _get_default_dbgargs():
 
 class DumplingConfig:
 
-    s_unsaved_args = { 'action', 'command', 'configpath', 'verbose', 'squelch', 'noprompt' }
-    s_default_args = { 'url': 'https://dumpling.azurewebsites.net/', 'installpath': os.path.join(os.path.expanduser('~'), '.dumpling'), 'dbgargs': _get_default_dbgargs() }
+    s_unsaved_args = { 'action', 'command', 'configpath', 'verbose', 'squelch', 'noprompt', 'nodaemon' }
+    #defaults are only saved for the settings which have always been saved, other settings are only saved when they differ
+    #from their default so that an existing configuration picks up changes to the defaults
+    s_saved_defaults = { 'url', 'installpath', 'dbgargs' }
+    s_default_args = { 'url': 'https://dumpling.azurewebsites.net/', 'installpath': os.path.join(os.path.expanduser('~'), '.dumpling'), 'dbgargs': _get_default_dbgargs(), 'streaming': False, 'cachesize': 10240, 'retries': 3, 'backoff': 0.5, 'engine': 'threads', 'concurrency': 64, 'maxupload': 0, 'maxdownload': 0, 'maxdiskread': 0, 'codec': 'auto', 'modules': False, 'spool': False, 'resumable': False, 'draininterval': 300, 'triagetimeout': 1800, 'persistent': False }
     def __init__(self, dictConfig):
         self.__dict__ = copy.copy(DumplingConfig.s_default_args)
 
@@ -980,8 +3472,10 @@ class DumplingConfig:
         config.Save(strpath)
 
     def Merge(self, dictConfig):
+        #None is an unspecified setting, any other value is merged even if it's 0 so that unlimited or disabled settings can
+        #override saved ones
         for key, value in dictConfig.iteritems():
-            if value or key not in self.__dict__:
+            if value is not None or key not in self.__dict__:
                 self.__dict__[key] = value
 
     def Save(self, strpath):
@@ -990,7 +3484,15 @@ class DumplingConfig:
             Output.Message('configuration saved to %s'%(strpath))
 
     def _persistable_args(self):
-        return dict([(key, value) for key, value in self.__dict__.iteritems() if key not in DumplingConfig.s_unsaved_args and value])
+        return dict([(key, value) for key, value in self.__dict__.iteritems() if DumplingConfig._is_persistable(key, value)])
+
+    @staticmethod
+    def _is_persistable(key, value):
+        if key in DumplingConfig.s_unsaved_args or value is None:
+            return False
+        if key in DumplingConfig.s_default_args and key not in DumplingConfig.s_saved_defaults:
+            return value != DumplingConfig.s_default_args[key]
+        return bool(value)
 
     def __str__(self):
         return _json_format(self._persistable_args())
@@ -1003,7 +3505,23 @@ def _parse_key_value_pair(argStr):
 
     return kvp
 
-def _parse_args(argv):
+class _CommandParser(argparse.ArgumentParser):
+    #parses only the options shared by all commands to find the command without building the full parser, errors in the
+    #arguments are left to be reported when the command is parsed
+    def error(self, message):
+        raise ValueError(message)
+
+def _find_command(argv):
+    parser = _CommandParser(parents=[_create_shared_parser()], add_help=False)
+
+    parser.add_argument('command', nargs='?')
+
+    try:
+        return parser.parse_known_args(argv)[0].command
+    except ValueError:
+        return None
+
+def _create_shared_parser():
     sharedparser = argparse.ArgumentParser(add_help=False)
     
     sharedparser.add_argument('--verbose', default=False, action='store_true', help='indicates that  all critical, standard, and diagnostic messages should be output')
@@ -1016,7 +3534,28 @@ def _parse_args(argv):
 
     sharedparser.add_argument('--url', type=str, help='url of the dumpling service for the connected client')
 
-    sharedparser.add_argument('--configpath', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dumpling.config.json'), help='path to the saved dumpling client configuration file')
+    sharedparser.add_argument('--retries', type=int, help='the number of times failed requests to the dumpling service are retried')
+
+    sharedparser.add_argument('--backoff', type=float, help='the backoff factor in seconds between retries of failed requests to the dumpling service')
+
+    sharedparser.add_argument('--engine', choices=['threads', 'concurrent'], help='the transfer engine, threads runs one transfer per core while concurrent runs up to --concurrency transfers regardless of the core count')
+
+    sharedparser.add_argument('--concurrency', type=int, help='the maximum number of concurrent transfers run by the concurrent transfer engine')
+
+    sharedparser.add_argument('--maxupload', type=int, help='the maximum upload rate in KB per second shared by all transfers, 0 is unlimited')
+
+    sharedparser.add_argument('--maxdownload', type=int, help='the maximum download rate in KB per second shared by all transfers, 0 is unlimited')
+
+    sharedparser.add_argument('--maxdiskread', type=int, help='the maximum rate in KB per second at which files are read for upload, 0 is unlimited')
+
+    sharedparser.add_argument('--configpath', type=str, default=_get_default_configpath(), help='path to the saved dumpling client configuration file')
+
+    sharedparser.add_argument('--nodaemon', default=False, action='store_true', help='run the command in this process even if a dumpling daemon is running')
+
+    return sharedparser
+
+def _create_parser():
+    sharedparser = _create_shared_parser()
 
     parser = argparse.ArgumentParser(parents=[sharedparser], description='dumpling client for managing core files and interacting with the dumpling service')
     
@@ -1040,12 +3579,22 @@ def _parse_args(argv):
     
     upload_parser.add_argument('--triage', choices=['none', 'client', 'full'], default='client', help='specifies the triage info to be uploadeded with the dump')
 
+    upload_parser.add_argument('--modules', default=None, action='store_true', help='include the modules mapped into an ELF core dump in the upload.  This argument is ignored unless --dumppath is specified')
+
     upload_parser.add_argument('--incpaths', nargs='*', type=str, help='paths to files or directories to be included in the upload')
 
     upload_parser.add_argument('--properties', nargs='*', type=_parse_key_value_pair, help='a list of properties to be associated with the dump in the format key=value', metavar='key=value')  
                                          
     upload_parser.add_argument('--propfile', type=argparse.FileType('r'), help='path to a file containing a json serialized dictionary of property value paires')
 
+    upload_parser.add_argument('--codec', choices=['auto', 'gzip', 'zstd', 'lz4', 'none'], help='the compression codec used to upload files, auto stores incompressible files and gzips the rest.  zstd and lz4 require the matching python package and a service which accepts them')
+
+    upload_parser.add_argument('--streaming', default=None, action='store_true', help='indicates that files should be hashed, compressed and uploaded in a single stream without writing a compressed copy to disk')
+
+    upload_parser.add_argument('--resumable', default=None, action='store_true', help='upload large files in parts which are resumed if the upload is interrupted, this writes a compressed copy of each large file to disk and requires a service which supports resumable uploads.  ignored with --streaming')
+
+    upload_parser.add_argument('--spool', default=None, action='store_true', help='spool the upload to be uploaded by a later drain rather than uploading it now.  uploads which fail because the service is unreachable are always spooled')
+
     download_parser = subparsers.add_parser('download', parents=[sharedparser], help='command used for downloading dumps and files from the dumpling service')    
     
     download_idtype = download_parser.add_mutually_exclusive_group(required=True)                                                                                             
@@ -1056,6 +3605,8 @@ def _parse_args(argv):
 
     download_idtype.add_argument('--symindex', type=str, help='the symstore index of the artifact to download')
 
+    download_idtype.add_argument('--dumpids-file', dest='dumpidsfile', type=str, help='path to a file listing the dumpling ids of many dumps to download, one per line.  artifacts shared between the dumps are only downloaded once')
+
     download_parser.add_argument('--downpath', type=str, help='the path to download the specified content to. NOTE: if both downpath and downdir are specified downdir will be ignored')
 
     download_parser.add_argument('--downdir', type=str, default=os.getcwd(), help='the path to the directory to download the specified content')    
@@ -1069,6 +3620,12 @@ def _parse_args(argv):
     update_parser.add_argument('--propfile', type=argparse.FileType('r'), help='path to a file containing a json serialized dictionary of property value paires')
 
     update_parser.add_argument('--incpaths', nargs='*', type=str, help='paths to files or directories to be associated with the specified dump')
+
+    update_parser.add_argument('--codec', choices=['auto', 'gzip', 'zstd', 'lz4', 'none'], help='the compression codec used to upload files, auto stores incompressible files and gzips the rest.  zstd and lz4 require the matching python package and a service which accepts them')
+
+    update_parser.add_argument('--streaming', default=None, action='store_true', help='indicates that files should be hashed, compressed and uploaded in a single stream without writing a compressed copy to disk')
+
+    update_parser.add_argument('--resumable', default=None, action='store_true', help='upload large files in parts which are resumed if the upload is interrupted, this writes a compressed copy of each large file to disk and requires a service which supports resumable uploads.  ignored with --streaming')
     
     install_parser = subparsers.add_parser('install', parents=[sharedparser], help='command used for installing dumpling services and support tooling')
 
@@ -1088,7 +3645,40 @@ def _parse_args(argv):
                                                  
     debug_parser.add_argument('--downdir', type=str, default=os.getcwd(), help='the path to the directory to download the specified content')    
     
-    parsed_args = parser.parse_args(argv)
+    daemon_parser = subparsers.add_parser('daemon', parents=[sharedparser], help='run a long lived client which keeps its connections and caches warm and runs the upload, update and download commands forwarded to it')
+
+    daemon_parser.add_argument('--socketpath', type=str, help='path of the unix domain socket the daemon listens on, defaults to dumpling.sock in the install path.  clients locate the daemon through the DUMPLING_SOCKET environment variable or the install path')
+
+    daemon_parser.add_argument('--draininterval', type=int, help='the interval in seconds at which the daemon uploads spooled uploads, 0 disables draining')
+
+    drain_parser = subparsers.add_parser('drain', parents=[sharedparser], help='upload the dumps and files spooled while the dumpling service was unreachable')
+
+    triage_parser = subparsers.add_parser('triage', parents=[sharedparser], help='run the full debugger triage of many dumps in parallel and update their properties with the results')
+
+    triage_dumps = triage_parser.add_mutually_exclusive_group(required=True)
+
+    triage_dumps.add_argument('--dumpid', type=str, help='the dumpling id of a dump to download and triage')
+
+    triage_dumps.add_argument('--dumpids-file', dest='dumpidsfile', type=str, help='path to a file listing the dumpling ids of dumps to download and triage, one per line')
+
+    triage_dumps.add_argument('--dumps', nargs='+', type=_parse_key_value_pair, help='already downloaded dumps to triage in the format dumpid=dumppath', metavar='dumpid=dumppath')
+
+    triage_parser.add_argument('--downdir', type=str, default=os.getcwd(), help='the path to the directory to download the dumps to be triaged')
+
+    triage_parser.add_argument('--dbgpath', type=str, default=None, help='path to debugger to be used by the dumpling client for debugging and triage')
+
+    triage_parser.add_argument('--parallel', dest='triageprocs', type=int, help='the maximum number of debuggers run concurrently, defaults to the number of cores')
+
+    triage_parser.add_argument('--timeout', dest='triagetimeout', type=int, help='the number of seconds after which the debugger triaging a dump is killed')
+
+    triage_parser.add_argument('--persistent', default=None, action='store_true', help='triage the dumps on long lived debuggers which load sos and the triage script once, rather than starting a debugger for each dump')
+
+    triage_parser.add_argument('--maxmemory', dest='triagememory', type=int, help='the memory in MB shared by the concurrent debuggers, each is estimated to use the size of its core.  defaults to the memory available when triage starts')
+
+    return parser
+
+def _parse_args(argv):
+    parsed_args = _create_parser().parse_args(argv)
 
     config = DumplingConfig.Load(parsed_args.configpath) or DumplingConfig({ })
     
@@ -1097,11 +3687,47 @@ def _parse_args(argv):
     return config
 
 def _create_command_processor(config):
-    dumplingsvc = DumplingService(config.url)
+    #transfers are bound by the network rather than the cpu, so the concurrent engine sizes the io pools and the connection 
+    #pool independently of the core count.  compression stays on the cpu pool which is always sized to the core count
+    #fail before anything is transferred if the configured codec isn't installed
+    if config.codec != 'auto':
+        FileUtils._get_codec(config.codec)
+
+    iothreads = int(config.concurrency) if config.engine == 'concurrent' else None
+
+    _configure_transfer_scheduler(config)
+
+    dumplingsvc = DumplingService(config.url, iothreads, int(config.retries), float(config.backoff))
     
-    filequeue = FileTransferManager(dumplingsvc)
+    #the artifact cache size is configured in MB, a cachesize of 0 disables the cache
+    cache = ArtifactCache(os.path.join(config.installpath, 'cache'), int(config.cachesize) * 1024 * 1024) if config.cachesize else None
+
+    hashcache = HashCache(os.path.join(config.installpath, 'hashcache.json'))
+
+    #the state of interrupted uploads is kept next to the dumpling config so they can be resumed.  resumable uploads are 
+    #only used when requested as they require a service which supports them
+    uploadstatedir = os.path.join(os.path.dirname(os.path.abspath(config.configpath)), 'uploads') if config.resumable else None
+
+    filequeue = FileTransferManager(dumplingsvc, iothreads, streaming=config.streaming, cache=cache, hashcache=hashcache, uploadstatedir=uploadstatedir, codec=config.codec)
+
+    spool = UploadSpool(os.path.join(config.installpath, 'spool'), hashcache)
     
-    return CommandProcessor(filequeue, dumplingsvc)
+    return CommandProcessor(filequeue, dumplingsvc, spool)
+
+def _configure_transfer_scheduler(config):
+    #the rate limits are configured in KB per second
+    TransferScheduler.Configure(int(config.maxupload) * 1024, int(config.maxdownload) * 1024, int(config.maxdiskread) * 1024)
+
+def _process_command(config, cmdProc):
+    try:
+        #commands which can partially fail return an exit code, the rest return None
+        exitcode = cmdProc.Process(config)
+    except TransferError as e:
+        for err in e.errors:
+            Output.Critical('ERROR: transfer failed: %s'%(err))
+        Output.Critical('ERROR: %s'%(e))
+        return 1
+    return exitcode or 0
 
 def _init_output(config):
     Output.s_verbose = config.verbose
@@ -1116,13 +3742,20 @@ def main(argv):
     
     starttime = datetime.datetime.now();
 
+    #a running daemon prints the elapsed time of the command itself
+    exitcode = _forward_to_daemon(argv[1:])
+    if exitcode is not None:
+        sys.exit(exitcode)
+
     config = _parse_args(argv[1:])
     
     _init_output(config)
 
     cmdProc = _create_command_processor(config)
 
-    cmdProc.Process(config)
+    exitcode = _process_command(config, cmdProc)
+    if exitcode:
+        sys.exit(exitcode)
 
     Output.Message('total elapsed time %s'%(datetime.datetime.now() - starttime))
 
@@ -0,0 +1,81 @@
+import argparse
+import hashlib
+import imp
+import multiprocessing
+import os
+import tempfile
+import time
+
+#dumpling.py is an empty stub, the client is loaded from the versioned script the same as the tests
+dumpling = imp.load_source('dumpling', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dumpling-1.0.py'))
+
+def _hash_8k_reads(path):
+    #the hashing loop used before the reused buffer, kept as the baseline
+    hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        BLOCKSIZE = 1024 * 8
+        buf = f.read(BLOCKSIZE)
+        while len(buf) > 0:
+            hash.update(buf)
+            buf = f.read(BLOCKSIZE)
+    return hash.hexdigest()
+
+def _hash_in_memory(path):
+    #sha1 of content which is already in memory, the most any single stream hashing path can reach
+    with open(path, 'rb') as f:
+        data = f.read()
+    start = time.time()
+    hashlib.sha1(data)
+    return time.time() - start
+
+def _create_file(size):
+    temp = tempfile.mkstemp()
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(temp[0], 'wb') as f:
+        for i in range(size):
+            f.write(block)
+    return temp[1]
+
+def _best_time(func, path, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='microbenchmark of the dumpling client hashing paths')
+
+    parser.add_argument('--path', type=str, help='the file to hash, a file of --size MB is created if not specified')
+
+    parser.add_argument('--size', type=int, default=512, help='the size in MB of the file created to hash')
+
+    parser.add_argument('--repeat', type=int, default=3, help='the number of times each path is timed, the best time is reported')
+
+    args = parser.parse_args()
+
+    path = args.path or _create_file(args.size)
+
+    try:
+        size = os.path.getsize(path) / (1024.0 * 1024.0)
+
+        #read the file once so every path is timed from the page cache
+        _hash_8k_reads(path)
+
+        baseline = _best_time(_hash_8k_reads, path, args.repeat)
+
+        ceiling = min(_hash_in_memory(path) for i in range(args.repeat))
+        print '%s cores, single stream sha1 ceiling %.1f MB/s'%(multiprocessing.cpu_count(), size / ceiling)
+
+        #the tree hash is not the content id, it's timed to show the throughput available from hashing leaves in parallel
+        for name, func in [ ('8k reads', _hash_8k_reads), ('reused buffer', dumpling.FileUtils._hash), ('tree hash', dumpling.FileUtils._tree_hash) ]:
+            elapsed = _best_time(func, path, args.repeat)
+            print '%-14s %8.3fs %10.1f MB/s %6.2fx'%(name, elapsed, size / elapsed, baseline / elapsed)
+    finally:
+        if args.path is None:
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
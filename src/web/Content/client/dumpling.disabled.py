@@ -96,13 +96,14 @@ class FileUtils:
 
     @staticmethod
     def _hash(path):
+        #the file is read into a single reused buffer so hashing doesn't allocate per block
         hash = hashlib.sha1()
         with open(path, 'rb') as f:
-            BLOCKSIZE = 1024 * 8
-            buf = f.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hash.update(buf)  
-                buf = f.read(BLOCKSIZE)
+            buf = bytearray(1024 * 1024)
+            count = f.readinto(buf)
+            while count > 0:
+                hash.update(buffer(buf, 0, count))  
+                count = f.readinto(buf)
         return hash.hexdigest()
 
     @staticmethod
@@ -0,0 +1,82 @@
+import argparse
+import imp
+import os
+import subprocess
+import sys
+import time
+
+#run in a child interpreter, times each import made directly by the client module including the modules it imports in
+#turn, the same as the cumulative column of python -X importtime which isn't available in python 2
+_IMPORT_TIMER = '''
+import __builtin__
+import imp
+import sys
+import time
+
+times = [ ]
+depth = [ 0 ]
+builtin_import = __builtin__.__import__
+
+def timed_import(name, *args, **kwargs):
+    start = time.time()
+    depth[0] += 1
+    try:
+        return builtin_import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        if depth[0] == 0:
+            times.append((time.time() - start, name))
+
+__builtin__.__import__ = timed_import
+start = time.time()
+imp.load_source('dumpling', sys.argv[1])
+total = time.time() - start
+__builtin__.__import__ = builtin_import
+
+for elapsed, name in sorted(times, reverse=True):
+    print '%-24s %8.1fms'%(name, elapsed * 1000)
+print '%-24s %8.1fms'%('total', total * 1000)
+'''
+
+def _get_commands(client):
+    #the subcommands are read from the parser of the benchmarked client so new commands are benchmarked without changes here
+    parser = imp.load_source('dumpling', client)._create_parser()
+    subparsers = next(a for a in parser._actions if isinstance(a, argparse._SubParsersAction))
+    return sorted(subparsers.choices.keys())
+
+def _best_time(cmdline, repeat):
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.call(cmdline, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the cold start time of each dumpling client command')
+
+    parser.add_argument('--client', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dumpling-1.0.py'), help='path to the dumpling client script to benchmark')
+
+    parser.add_argument('--repeat', type=int, default=10, help='the number of times each command is timed, the best time is reported')
+
+    parser.add_argument('--imports', default=False, action='store_true', help='also report the time spent importing each module imported by the client')
+
+    args = parser.parse_args()
+
+    baseline = _best_time([ sys.executable, '-c', 'pass' ], args.repeat)
+
+    print '%-24s %8.1fms'%('interpreter', baseline * 1000)
+
+    for command in [ None ] + _get_commands(args.client):
+        cmdline = [ sys.executable, args.client ] + ([ command ] if command else [ ]) + [ '-h' ]
+        elapsed = _best_time(cmdline, args.repeat)
+        print '%-24s %8.1fms %8.1fms over the interpreter'%(' '.join(cmdline[2:]), elapsed * 1000, (elapsed - baseline) * 1000)
+
+    if args.imports:
+        print
+        subprocess.call([ sys.executable, '-c', _IMPORT_TIMER, args.client ])
+
+if __name__ == '__main__':
+    main()
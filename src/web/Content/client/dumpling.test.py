@@ -4,6 +4,22 @@ import sys
 import tempfile
 import random
 import os
+import shutil
+import stat
+import time
+import threading
+import hashlib
+import struct
+import json
+import gzip
+import uuid
+import urlparse
+import StringIO
+import BaseHTTPServer
+import SocketServer
+import socket
+import collections
+import subprocess
 
 DUMPLING_HOSTURL = 'https://dumpling-dev.azurewebsites.net/'
 
@@ -29,6 +45,166 @@ class dumpling_testcase(unittest.TestCase):
     def _parse_cmdline(self, cmdline):
         return cmdline.split(' ')
 
+class standin_service(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    #a minimal local stand-in for the dumpling service used to test transfers without the live service.  artifacts are 
+    #stored in memory in their compressed form keyed by hash, and the parts of resumable uploads are kept until committed
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), standin_handler)
+        self.url = 'http://127.0.0.1:%s/'%(self.server_address[1])
+        self.lock = threading.Lock()
+        self.artifacts = { }
+        self.codecs = { }
+        self.dumpartifacts = { }
+        self.manifests = { }
+        self.properties = { }
+        self.uploads = { }
+        self.failparts = set()
+        self.failhashes = set()
+        self.partputs = 0
+        self.rangegets = 0
+        self.artifactgets = collections.Counter()
+        self.artifactposts = collections.Counter()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        #clients closing a streamed response early is expected, anything else is a bug in the stand-in
+        if not issubclass(sys.exc_info()[0], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def store(self, hash, compressed, codec = 'gzip'):
+        if codec in [ 'gzip', 'none' ]:
+            content = gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read()
+        else:
+            decompobj = dumpling.FileUtils._get_codec(codec).decompressobj()
+            content = decompobj.decompress(compressed) + decompobj.flush()
+        if hashlib.sha1(content).hexdigest() != hash:
+            return False
+        with self.lock:
+            self.artifacts[hash] = compressed
+            self.codecs[hash] = codec
+        return True
+
+class standin_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, qargs = self._parse_path()
+        if path[:3] == [ 'api', 'dumplings', 'create' ]:
+            return self._reply(200, qargs['hash'])
+        if path[:2] == [ 'api', 'uploads' ] and len(path) == 3 and path[2] in self.server.uploads:
+            return self._reply(200, json.dumps({ 'parts': sorted(self.server.uploads[path[2]]['parts'].keys()) }))
+        if path[:2] == [ 'api', 'dumplings' ] and len(path) == 4 and path[3] == 'manifest' and path[2] in self.server.manifests:
+            return self._reply(200, json.dumps(self.server.manifests[path[2]]))
+        if path[:2] == [ 'api', 'artifacts' ] and len(path) == 3 and path[2] in self.server.artifacts:
+            with self.server.lock:
+                self.server.artifactgets[path[2]] += 1
+            return self._reply_content(self.server.artifacts[path[2]])
+        self._reply(404)
+
+    def _reply_content(self, content):
+        rangehdr = self.headers.get('Range')
+        if rangehdr is None:
+            self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        start, end = [ int(i) for i in rangehdr.split('=')[1].split('-') ]
+        with self.server.lock:
+            self.server.rangegets += 1
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %s-%s/%s'%(start, end, len(content)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(content[start:end + 1])
+
+    def do_PUT(self):
+        path, qargs = self._parse_path()
+        body = self._read_body()
+        if path[:2] == [ 'api', 'uploads' ] and len(path) == 5 and path[3] == 'parts' and path[2] in self.server.uploads:
+            index = int(path[4])
+            with self.server.lock:
+                self.server.partputs += 1
+                if index in self.server.failparts:
+                    self.server.failparts.discard(index)
+                    return self._reply(400)
+            if hashlib.sha1(body).hexdigest() != qargs['hash']:
+                return self._reply(400)
+            self.server.uploads[path[2]]['parts'][index] = body
+            return self._reply(200)
+        self._reply(404)
+
+    def do_POST(self):
+        path, qargs = self._parse_path()
+        body = self._read_body()
+        if path == [ 'api', 'artifacts', 'missing' ]:
+            return self._reply(200, json.dumps([ h for h in json.loads(body) if h not in self.server.artifacts ]))
+        if path == [ 'api', 'uploads' ]:
+            uploadid = uuid.uuid4().hex
+            self.server.uploads[uploadid] = { 'hash': qargs['hash'], 'codec': qargs.get('codec', 'gzip'), 'dumpid': qargs.get('dumplingid'), 'localpath': qargs['localpath'], 'parts': { } }
+            return self._reply(200, json.dumps({ 'uploadId': uploadid }))
+        if path[:2] == [ 'api', 'uploads' ] and len(path) == 4 and path[3] == 'commit' and path[2] in self.server.uploads:
+            upload = self.server.uploads.pop(path[2])
+            compressed = ''.join(upload['parts'][i] for i in sorted(upload['parts'].keys()))
+            if not self.server.store(upload['hash'], compressed, upload['codec']):
+                return self._reply(400)
+            self._add_dump_artifact(upload['dumpid'], upload['localpath'], upload['hash'])
+            return self._reply(200, upload['hash'])
+        if path[:2] == [ 'api', 'dumplings' ] and len(path) == 4 and path[3] == 'properties':
+            self.server.properties.setdefault(path[2], { }).update((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+            return self._reply(200)
+        if path[-2:] == [ 'artifacts', 'uploads' ] or path == [ 'api', 'dumplings', 'uploads' ]:
+            if qargs['hash'] in self.server.failhashes:
+                return self._reply(503)
+            dumpid = path[2] if len(path) == 5 else (qargs['hash'] if path[1] == 'dumplings' else None)
+            if qargs['hash'] not in self.server.artifacts and not self.server.store(qargs['hash'], body, qargs.get('codec', 'gzip')):
+                return self._reply(400)
+            if len(body) > 0:
+                with self.server.lock:
+                    self.server.artifactposts[qargs['hash']] += 1
+            self._add_dump_artifact(dumpid, qargs['localpath'], qargs['hash'])
+            return self._reply(200, qargs['hash'])
+        self._reply(404)
+
+    def _add_dump_artifact(self, dumpid, localpath, hash):
+        if dumpid is not None:
+            with self.server.lock:
+                self.server.dumpartifacts.setdefault(dumpid, { })[localpath] = hash
+
+    def _parse_path(self):
+        url = urlparse.urlparse(self.path)
+        qargs = dict((k, v[0]) for k, v in urlparse.parse_qs(url.query).items())
+        return [ p for p in url.path.split('/') if p ], qargs
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = [ ]
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, code, body = ''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 class test_dumpling_argparser(dumpling_testcase):
     def test_simple_help(self):
         with self.assertRaises(SystemExit):
@@ -54,6 +230,35 @@ class test_dumpling_argparser(dumpling_testcase):
         with self.assertRaises(SystemExit):
             dumpling.main(self._parse_cmdline('dumpling debug -h'))
 
+    def test_saved_config(self):
+        tempdir = tempfile.mkdtemp()
+        configpath = os.path.join(tempdir, 'dumpling.config.json')
+        try:
+            dumpling.DumplingConfig.SaveSettings(configpath, { 'streaming': True, 'maxupload': 100, 'cachesize': 50 })
+            with open(configpath, 'r') as f:
+                saved = json.load(f)
+            #settings other than those which have always been saved are only saved when they differ from their defaults
+            self.assertEqual({ 'url', 'installpath', 'streaming', 'maxupload', 'cachesize' }, set(saved.keys()) - { 'dbgargs' })
+
+            config = dumpling._parse_args([ 'upload', '--configpath', configpath, '--dumppath', 'core', '--maxupload', '0' ])
+            self.assertEqual(0, config.maxupload)
+            self.assertEqual(50, config.cachesize)
+            self.assertTrue(config.streaming)
+
+            dumpling._parse_args([ 'config', 'save', '--configpath', configpath, '--maxupload', '0' ]).Save(configpath)
+            with open(configpath, 'r') as f:
+                saved = json.load(f)
+            self.assertNotIn('maxupload', saved)
+            self.assertEqual(50, saved['cachesize'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_lazy_imports(self):
+        #loading the client and parsing its arguments must not import the modules only needed for transfers
+        script = 'import imp, sys; d = imp.load_source("dumpling", sys.argv[1]); d._parse_args([ "config", "dump" ]); print " ".join(m for m in [ "requests", "multiprocessing", "zipfile", "subprocess", "SocketServer" ] if m in sys.modules)'
+        output = subprocess.check_output([ sys.executable, '-c', script, os.path.splitext(dumpling.__file__)[0] + '.py' ])
+        self.assertEqual('', output.strip())
+
 class test_dumpling_fileutils(dumpling_testcase):
     def test_compress_uncompress(self):
         #create a test file
@@ -76,6 +281,1206 @@ class test_dumpling_fileutils(dumpling_testcase):
         self.assertEqual(size1, size2)
         self.assertTrue(zipsize < size1)
 
+    def test_stream_compress_uncompress(self):
+        origpath = self.rand_file(1024 * 256)
+        zippedpath = origpath + '.gzip'
+        unzippedpath = origpath + '.gunzip'
+
+        hash1 = dumpling.FileUtils._hash(origpath)
+
+        with open(zippedpath, 'wb') as fComp:
+            for buf in dumpling.FileUtils._iter_hash_and_compress(origpath, hash1):
+                fComp.write(buf)
+
+        hash2 = dumpling.FileUtils._hash_and_decompress(zippedpath, unzippedpath)
+
+        size1 = os.path.getsize(origpath)
+        size2 = os.path.getsize(unzippedpath)
+
+        os.remove(origpath)
+        os.remove(zippedpath)
+        os.remove(unzippedpath)
+
+        self.assertEqual(hash1, hash2)
+        self.assertEqual(size1, size2)
+
+    def test_hash_reused_buffer(self):
+        path = self.rand_file(1024 * 1024 * 2 + 17)
+        blocksize = dumpling.FileUtils.s_hashblocksize
+        try:
+            dumpling.FileUtils.s_hashblocksize = 1024 * 64
+            with open(path, 'rb') as f:
+                self.assertEqual(hashlib.sha1(f.read()).hexdigest(), dumpling.FileUtils._hash(path))
+        finally:
+            dumpling.FileUtils.s_hashblocksize = blocksize
+            dumpling.FileUtils._try_remove(path)
+
+    def test_tree_hash(self):
+        path = self.rand_file(1024 * 1024 + 17)
+        leafsize = dumpling.FileUtils.s_treeleafsize
+        try:
+            dumpling.FileUtils.s_treeleafsize = 1024 * 256
+            with open(path, 'rb') as f:
+                data = f.read()
+            leaves = [ hashlib.sha1(data[i:i + 1024 * 256]).digest() for i in range(0, len(data), 1024 * 256) ]
+
+            self.assertEqual(hashlib.sha1(''.join(leaves)).hexdigest(), dumpling.FileUtils._tree_hash(path))
+            #the tree hash is not the content id
+            self.assertNotEqual(dumpling.FileUtils._hash(path), dumpling.FileUtils._tree_hash(path))
+        finally:
+            dumpling.FileUtils.s_treeleafsize = leafsize
+            dumpling.FileUtils._try_remove(path)
+
+    def test_parallel_compress_uncompress(self):
+        origpath = self.rand_file(1024 * 200 + 17)
+        zippedpath = origpath + '.gzip'
+        unzippedpath = origpath + '.gunzip'
+
+        blocksize = dumpling.FileUtils.s_parallelblocksize
+        dumpling.FileUtils.s_parallelblocksize = 1024 * 16
+        try:
+            hash1 = dumpling.FileUtils._hash_and_compress_parallel(origpath, zippedpath)
+        finally:
+            dumpling.FileUtils.s_parallelblocksize = blocksize
+
+        hash2 = dumpling.FileUtils._hash_and_decompress(zippedpath, unzippedpath)
+
+        size1 = os.path.getsize(origpath)
+        size2 = os.path.getsize(unzippedpath)
+        zipsize = os.path.getsize(zippedpath)
+
+        os.remove(origpath)
+        os.remove(zippedpath)
+        os.remove(unzippedpath)
+
+        self.assertEqual(hash1, hash2)
+        self.assertEqual(size1, size2)
+        self.assertTrue(zipsize < size1)
+
+    def test_parallel_compress_empty(self):
+        origpath = self.rand_file()
+        open(origpath, 'wb').close()
+        zippedpath = origpath + '.gzip'
+        unzippedpath = origpath + '.gunzip'
+
+        hash1 = dumpling.FileUtils._hash_and_compress_parallel(origpath, zippedpath)
+        hash2 = dumpling.FileUtils._hash_and_decompress(zippedpath, unzippedpath)
+
+        size2 = os.path.getsize(unzippedpath)
+
+        os.remove(origpath)
+        os.remove(zippedpath)
+        os.remove(unzippedpath)
+
+        self.assertEqual(hash1, hash2)
+        self.assertEqual(0, size2)
+
+    def test_stream_compress_modified(self):
+        origpath = self.rand_file()
+
+        try:
+            with self.assertRaises(IOError):
+                for buf in dumpling.FileUtils._iter_hash_and_compress(origpath, '0' * 40):
+                    pass
+        finally:
+            os.remove(origpath)
+
+class test_dumpling_codecs(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def _available_codecs(self):
+        return [ name for name, codec in dumpling.FileUtils.s_codecs.iteritems() if codec.available() ]
+
+    def _incompressible_file(self):
+        path = self.rand_file()
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1024 * 64))
+        return path
+
+    def test_codecs_round_trip(self):
+        origpath = self.rand_file(1024 * 64)
+        try:
+            for codec in self._available_codecs():
+                comppath = origpath + '.' + codec
+                decomppath = comppath + '.decomp'
+                try:
+                    hash1 = dumpling.FileUtils._hash_and_compress(origpath, comppath, codec)
+                    #the codec is detected from the compressed content
+                    hash2 = dumpling.FileUtils._hash_and_decompress(comppath, decomppath)
+                    self.assertEqual(hash1, hash2)
+                    self.assertEqual(hash1, dumpling.FileUtils._hash(decomppath))
+                finally:
+                    dumpling.FileUtils._try_remove(comppath)
+                    dumpling.FileUtils._try_remove(decomppath)
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+
+    def test_auto_codec_selection(self):
+        randpath = self._incompressible_file()
+        textpath = self.rand_file()
+        with open(textpath, 'w') as f:
+            f.write('the quick brown fox jumps over the lazy dog\n' * 1024)
+        try:
+            self.assertEqual('none', dumpling.FileUtils._select_codec(randpath, 'auto'))
+            self.assertEqual('gzip', dumpling.FileUtils._select_codec(textpath, 'auto'))
+            self.assertEqual('gzip', dumpling.FileUtils._select_codec(randpath, 'gzip'))
+        finally:
+            dumpling.FileUtils._try_remove(randpath)
+            dumpling.FileUtils._try_remove(textpath)
+
+    def test_upload_download_with_codec(self):
+        origpath = self._incompressible_file()
+        downpath = origpath + '.down'
+        dumpsvc = dumpling.DumplingService(self.service.url)
+        try:
+            for codec in self._available_codecs():
+                self.service.artifacts.clear()
+                transmgr = dumpling.FileTransferManager(dumpsvc, codec=codec)
+                hash = transmgr.QueueFileUpload('dumpid', origpath).await_result()
+
+                self.assertEqual(codec, self.service.codecs[hash])
+                self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath))
+                self.assertEqual(hash, dumpling.FileUtils._hash(downpath))
+                dumpling.FileUtils._try_remove(downpath)
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+class test_dumpling_sparse(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def _sparse_file(self):
+        #a 4MB file with data only at 1MB and in the last 4KB, the rest are holes
+        path = self.rand_file()
+        with open(path, 'wb') as f:
+            f.truncate(1024 * 1024 * 4)
+            f.seek(1024 * 1024)
+            f.write(self.rand_bytes(1024 * 16))
+            f.seek(1024 * 1024 * 4 - 1024 * 4)
+            f.write(self.rand_bytes(1024 * 4))
+        return path
+
+    def _full_hash(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def test_sparse_hash_compress(self):
+        origpath = self._sparse_file()
+        zippedpath = origpath + '.gzip'
+        unzippedpath = origpath + '.gunzip'
+        try:
+            hash = self._full_hash(origpath)
+            self.assertEqual(hash, dumpling.FileUtils._hash(origpath))
+            self.assertEqual(hash, dumpling.FileTransferManager._hash_and_compress(origpath, zippedpath))
+            self.assertEqual(hash, dumpling.FileUtils._hash_and_decompress(zippedpath, unzippedpath))
+            self.assertEqual(os.path.getsize(origpath), os.path.getsize(unzippedpath))
+            self.assertLess(os.path.getsize(zippedpath), 1024 * 64)
+        finally:
+            for p in [ origpath, zippedpath, unzippedpath ]:
+                dumpling.FileUtils._try_remove(p)
+
+    def test_sparse_download(self):
+        origpath = self._sparse_file()
+        downpath = origpath + '.down'
+        dumpsvc = dumpling.DumplingService(self.service.url)
+        try:
+            hash = dumpling.FileTransferManager(dumpsvc).QueueFileUpload('dumpid', origpath).await_result()
+            self.assertEqual(self._full_hash(origpath), hash)
+
+            self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath, True))
+            self.assertEqual(hash, self._full_hash(downpath))
+            self.assertEqual(os.path.getsize(origpath), os.path.getsize(downpath))
+            self.assertLess(os.stat(downpath).st_blocks * 512, os.path.getsize(downpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+class test_dumpling_elfcore(dumpling_testcase):
+    def _elf(self, type, segments, size):
+        #builds a 64 bit little endian ELF image of the specified size from (type, offset, vaddr, size, data) segments, the 
+        #data of each segment is written at its offset
+        header = struct.pack('<4sBBBBB7sHHIQQQIHHHHHH', '\x7fELF', 2, 1, 1, 0, 0, '', type, 62, 1, 0, 64, 0, 0, 64, 56, len(segments), 64, 0, 0)
+        phdrs = ''.join(struct.pack('<IIQQQQQQ', ptype, 0, offset, vaddr, vaddr, segsize, segsize, 0x1000) for ptype, offset, vaddr, segsize, data in segments)
+        image = bytearray(size)
+        image[0:len(header + phdrs)] = header + phdrs
+        for ptype, offset, vaddr, segsize, data in segments:
+            if data is not None:
+                image[offset:offset + len(data)] = data
+        return str(image)
+
+    def _note(self, name, type, desc):
+        name += '\0'
+        pad = lambda b: b + '\0' * (-len(b) % 4)
+        return struct.pack('<III', len(name), len(desc), type) + pad(name) + pad(desc)
+
+    def _module(self, buildid):
+        note = self._note('GNU', 3, buildid.decode('hex'))
+        return self._elf(3, [ (1, 0, 0, 0x200, None), (4, 0x100, 0x100, len(note), note) ], 0x200)
+
+    def _write(self, data):
+        path = self.rand_file()
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _core(self, mappings, memory, size = None):
+        #mappings are (start, end, pageoffset, path), memory is (vaddr, data) for a single load segment
+        desc = struct.pack('<QQ', len(mappings), 0x1000)
+        desc += ''.join(struct.pack('<QQQ', start, end, pageofs) for start, end, pageofs, path in mappings)
+        desc += ''.join(path + '\0' for start, end, pageofs, path in mappings)
+        notes = self._note('CORE', 0x46494c45, desc)
+        core = self._elf(4, [ (4, 0x1000, 0, len(notes), notes), (1, 0x2000, memory[0], len(memory[1]), memory[1]) ], 0x2000 + len(memory[1]))
+        path = self._write(core)
+        if size is not None:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        return path
+
+    def test_core_modules(self):
+        buildid = 'a1b2c3d4e5f60718293a4b5c6d7e8f9001122334'
+        module = self._module(buildid)
+        modpath = self._write(module)
+        stalepath = self._write(self._module('ff' * 20))
+        datapath = self.rand_file()
+        missingpath = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+        mappings = [ (0x400000, 0x401000, 0, modpath), (0x401000, 0x402000, 1, modpath), (0x500000, 0x501000, 0, stalepath), (0x600000, 0x601000, 0, datapath), (0x700000, 0x701000, 0, missingpath) ]
+        #the core is extended to 3GB to check it isn't read into memory, only the module loaded at 0x400000 is in the core
+        corepath = self._core(mappings, (0x400000, module), 1024 * 1024 * 1024 * 3)
+        try:
+            with dumpling.ElfCore(corepath) as core:
+                modules = core.Modules()
+
+            self.assertEqual({ modpath: buildid, stalepath: None, datapath: None, missingpath: None }, modules)
+            self.assertEqual(buildid, dumpling.ElfCore._file_build_id(modpath))
+
+            #the data file isn't a module, the missing file can't be uploaded
+            self.assertEqual(set([ modpath, stalepath ]), dumpling.CommandProcessor._get_core_modules(corepath))
+        finally:
+            for p in [ modpath, stalepath, datapath, corepath ]:
+                dumpling.FileUtils._try_remove(p)
+
+    def test_stale_module_skipped(self):
+        modpath = self._write(self._module('ff' * 20))
+        corepath = self._core([ (0x400000, 0x401000, 0, modpath) ], (0x400000, self._module('11' * 20)))
+        try:
+            self.assertEqual(set(), dumpling.CommandProcessor._get_core_modules(corepath))
+        finally:
+            dumpling.FileUtils._try_remove(modpath)
+            dumpling.FileUtils._try_remove(corepath)
+
+    def test_not_a_core(self):
+        path = self.rand_file()
+        try:
+            with self.assertRaises(ValueError):
+                dumpling.ElfCore(path)
+            self.assertEqual(set(), dumpling.CommandProcessor._get_core_modules(path))
+        finally:
+            dumpling.FileUtils._try_remove(path)
+
+class test_dumpling_artifactcache(dumpling_testcase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for dirpath, dirnames, filenames in os.walk(self.cachedir):
+            for name in filenames:
+                os.chmod(os.path.join(dirpath, name), 0o600)
+        shutil.rmtree(self.cachedir)
+
+    def test_add_materialize(self):
+        cache = dumpling.ArtifactCache(self.cachedir, 1024 * 1024)
+        origpath = self.rand_file()
+        copypath = origpath + '.cached'
+        hash = dumpling.FileUtils._hash(origpath)
+
+        try:
+            self.assertFalse(cache.TryMaterialize(hash, copypath))
+
+            cache.Add(hash, origpath)
+
+            self.assertTrue(cache.TryMaterialize(hash, copypath))
+            self.assertEqual(hash, dumpling.FileUtils._hash(copypath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(copypath)
+
+    def test_add_keeps_download_mode(self):
+        cache = dumpling.ArtifactCache(self.cachedir, 1024 * 1024)
+        origpath = self.rand_file()
+        os.chmod(origpath, 0o644)
+        hash = dumpling.FileUtils._hash(origpath)
+
+        try:
+            cache.Add(hash, origpath)
+
+            self.assertEqual(0o644, stat.S_IMODE(os.stat(origpath).st_mode))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+
+    def test_entry_independent_of_files(self):
+        cache = dumpling.ArtifactCache(self.cachedir, 1024 * 1024)
+        origpath = self.rand_file()
+        otherpath = self.rand_file()
+        zippedpath = otherpath + '.gzip'
+        copypath = origpath + '.cached'
+        hash = dumpling.FileUtils._hash(origpath)
+
+        try:
+            cache.Add(hash, origpath)
+            #modify the added file in place, and overwrite a file materialized from the cache with another download
+            with open(origpath, 'r+b') as f:
+                f.write('modified')
+            self.assertTrue(cache.TryMaterialize(hash, copypath))
+            dumpling.FileUtils._hash_and_compress(otherpath, zippedpath)
+            dumpling.FileUtils._hash_and_decompress(zippedpath, copypath)
+
+            self.assertTrue(cache.TryMaterialize(hash, copypath))
+            self.assertEqual(hash, dumpling.FileUtils._hash(copypath))
+        finally:
+            for p in [ origpath, otherpath, zippedpath, copypath ]:
+                dumpling.FileUtils._try_remove(p)
+
+    def test_evict_least_recently_used(self):
+        cache = dumpling.ArtifactCache(self.cachedir, 1024 * 40)
+        paths = [ self.rand_file(1024 * 16) for i in range(3) ]
+        hashes = [ dumpling.FileUtils._hash(p) for p in paths ]
+        copypath = paths[0] + '.cached'
+
+        try:
+            cache.Add(hashes[0], paths[0])
+            cache.Add(hashes[1], paths[1])
+            #use the first entry so the second is the least recently used when the third is added
+            time.sleep(0.01)
+            self.assertTrue(cache.TryMaterialize(hashes[0], copypath))
+            cache.Add(hashes[2], paths[2])
+
+            self.assertTrue(cache.TryMaterialize(hashes[0], copypath))
+            self.assertFalse(cache.TryMaterialize(hashes[1], copypath))
+            self.assertTrue(cache.TryMaterialize(hashes[2], copypath))
+        finally:
+            for p in paths:
+                dumpling.FileUtils._try_remove(p)
+            dumpling.FileUtils._try_remove(copypath)
+
+class test_dumpling_hashcache(dumpling_testcase):
+    def test_hash_reused_until_modified(self):
+        origpath = self.rand_file()
+        cachepath = self.rand_file()
+        os.remove(cachepath)
+
+        try:
+            cache = dumpling.HashCache(cachepath)
+            hash1 = cache.GetHash(origpath)
+            cache.Save()
+
+            #a new cache loaded from disk should return the stored hash without reading the file
+            cache = dumpling.HashCache(cachepath)
+            hashfunc = dumpling.FileUtils.__dict__['_hash']
+            dumpling.FileUtils._hash = staticmethod(lambda path: self.fail('file was re-hashed'))
+            try:
+                hash2 = cache.GetHash(origpath)
+            finally:
+                dumpling.FileUtils._hash = hashfunc
+
+            with open(origpath, 'ab') as f:
+                f.write(self.rand_bytes(16))
+            hash3 = cache.GetHash(origpath)
+
+            self.assertEqual(hash1, hash2)
+            self.assertNotEqual(hash1, hash3)
+            self.assertEqual(hash3, dumpling.FileUtils._hash(origpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(cachepath)
+
+    def test_indexed_tree_only_hashes_changes(self):
+        root = tempfile.mkdtemp()
+        cachepath = os.path.join(root, 'hashcache.json')
+        hashfunc = dumpling.FileUtils.__dict__['_hash']
+
+        try:
+            tree = os.path.join(root, 'tree')
+            for i in range(20):
+                path = os.path.join(tree, str(i % 4), str(i % 3), str(i))
+                dumpling.FileUtils._ensure_parent_dir(path)
+                with open(path, 'wb') as f:
+                    f.write(self.rand_bytes(64))
+            #symlinked directories aren't followed, the same as os.walk
+            os.symlink(os.path.join(tree, '0'), os.path.join(tree, 'link'))
+
+            statkeys = { }
+            files = dumpling.FileUtils._enumerate_unique_files([ tree ], statkeys)
+            self.assertEqual(set(os.path.join(d, n) for d, dirs, names in os.walk(tree) for n in names), files)
+            self.assertEqual(20, len(files))
+            self.assertEqual(dict((p, dumpling.HashCache._stat_key(p)) for p in files), statkeys)
+
+            cache = dumpling.HashCache(cachepath)
+            hashes = dict((p, cache.GetHash(p, statkeys[p])) for p in files)
+            cache.Save()
+
+            changed = sorted(files)[0]
+            with open(changed, 'ab') as f:
+                f.write(self.rand_bytes(16))
+
+            hashed = [ ]
+            dumpling.FileUtils._hash = staticmethod(lambda path: hashed.append(path) or hashfunc.__func__(path))
+            statkeys = { }
+            dumpsvc = test_dumpling_dedupupload._service_double(hashes.values())
+            transmgr = dumpling.FileTransferManager(dumpsvc, hashcache=dumpling.HashCache(cachepath))
+            transmgr.UploadFiles('dumpid', dumpling.FileUtils._enumerate_unique_files([ tree ], statkeys), statkeys=statkeys)
+
+            self.assertEqual([ changed ], hashed)
+            self.assertEqual(19, len(dumpsvc.linked))
+        finally:
+            dumpling.FileUtils._hash = hashfunc
+            shutil.rmtree(root, ignore_errors=True)
+
+class test_dumpling_threadpool(dumpling_testcase):
+    def test_queue_backpressure(self):
+        pool = dumpling.ThreadPool(1, 2)
+        gate = threading.Event()
+        pool.queue_work(gate.wait)
+        time.sleep(0.1)
+        pool.queue_work(gate.wait)
+        pool.queue_work(gate.wait)
+
+        #the queue is full so the producer must block until the worker frees a slot
+        queued = threading.Event()
+        thread = threading.Thread(target=lambda: (pool.queue_work(gate.wait), queued.set()))
+        thread.start()
+        self.assertFalse(queued.wait(0.2))
+
+        gate.set()
+        self.assertTrue(queued.wait(5))
+        thread.join()
+        self.assertEqual([ ], pool.wait_on_pending_work())
+
+    def test_unobserved_errors_aggregated(self):
+        def fail(msg):
+            raise IOError(msg)
+
+        pool = dumpling.ThreadPool(2)
+        observed = pool.queue_work(fail, args=('observed',))
+        pool.queue_work(fail, args=('unobserved',))
+        pool.queue_work(lambda: None)
+
+        with self.assertRaises(IOError):
+            observed.await_result()
+
+        errors = pool.wait_on_pending_work()
+        self.assertEqual([ 'unobserved' ], [ str(e) for e in errors ])
+        self.assertEqual([ ], pool.wait_on_pending_work())
+
+    def test_cancel_pending(self):
+        pool = dumpling.ThreadPool(1)
+        gate = threading.Event()
+        running = pool.queue_work(gate.wait)
+        time.sleep(0.1)
+        pending = [ pool.queue_work(lambda: None) for i in range(3) ]
+
+        self.assertEqual(3, pool.cancel_pending())
+        gate.set()
+
+        self.assertEqual(True, running.await_result())
+        for task in pending:
+            with self.assertRaises(dumpling.TaskCancelledError):
+                task.await_result()
+        self.assertEqual([ ], pool.wait_on_pending_work())
+
+    def test_transfer_errors_surfaced(self):
+        missing = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+        transmgr = dumpling.FileTransferManager(None)
+        transmgr.QueueFileUpload('dumpid', missing)
+
+        with self.assertRaises(dumpling.TransferError) as ctx:
+            transmgr.WaitForPendingTransfers()
+        self.assertEqual(1, len(ctx.exception.errors))
+
+class test_dumpling_concurrentengine(dumpling_testcase):
+    class _service_double:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.active = 0
+            self.maxactive = 0
+
+        def DownloadArtifact(self, hash, abspath, sparse = False, pool = None):
+            with self.lock:
+                self.active += 1
+                self.maxactive = max(self.maxactive, self.active)
+            time.sleep(0.2)
+            with self.lock:
+                self.active -= 1
+            return True
+
+    def test_concurrency_independent_of_cores(self):
+        config = dumpling.DumplingConfig({ 'engine': 'concurrent', 'concurrency': 32, 'cachesize': 0, 'configpath': os.path.join(tempfile.gettempdir(), 'dumpling.config.json') })
+        cmdproc = dumpling._create_command_processor(config)
+        self.assertEqual(32, cmdproc._dumpSvc._get_adapter()._pool_maxsize)
+
+        dumpsvc = self._service_double()
+        transmgr = dumpling.FileTransferManager(dumpsvc, 32)
+        for i in range(32):
+            transmgr.QueueFileDownload(str(i), os.path.join(tempfile.gettempdir(), str(uuid.uuid4())))
+        transmgr.WaitForPendingTransfers()
+
+        self.assertEqual(32, dumpsvc.maxactive)
+
+class test_dumpling_transferscheduler(dumpling_testcase):
+    def tearDown(self):
+        dumpling.TransferScheduler.Configure(None, None, None)
+
+    def test_token_bucket_rate(self):
+        bucket = dumpling.TokenBucket(1024 * 1024)
+        start = time.time()
+        #the first second of tokens is available immediately, the second must be waited for
+        for i in range(32):
+            bucket.consume(1024 * 64)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_priority_consumer_first(self):
+        bucket = dumpling.TokenBucket(1024 * 64)
+        bucket.consume(1024 * 128)
+        order = [ ]
+        normal = threading.Thread(target=lambda: (bucket.consume(1024), order.append('normal')))
+        normal.start()
+        time.sleep(0.1)
+        priority = threading.Thread(target=lambda: (bucket.consume(1024, True), order.append('priority')))
+        priority.start()
+        normal.join()
+        priority.join()
+
+        self.assertEqual([ 'priority', 'normal' ], order)
+
+    def test_throttled_upload_body(self):
+        path = self.rand_file(1024 * 64)
+        try:
+            dumpling.TransferScheduler.Configure(1024 * 1024, None, None)
+            with open(path, 'rb') as fUpld:
+                body = dumpling.TransferScheduler.ThrottleUpload(fUpld)
+                self.assertEqual(os.path.getsize(path), body.len)
+                data = ''.join(body)
+            self.assertEqual(dumpling.FileUtils._hash(path), hashlib.sha1(data).hexdigest())
+        finally:
+            dumpling.FileUtils._try_remove(path)
+
+class test_dumpling_dedupupload(dumpling_testcase):
+    class _service_double:
+        def __init__(self, known):
+            self.known = set(known)
+            self.uploaded = [ ]
+            self.linked = [ ]
+
+        def GetMissingArtifacts(self, hashes):
+            return set(hashes) - self.known
+
+        def UploadArtifact(self, dumpid, localpath, hash, file, codec = 'gzip'):
+            self.uploaded.append(hash)
+
+        def LinkArtifact(self, dumpid, localpath, hash):
+            self.linked.append(hash)
+
+    def test_upload_only_missing(self):
+        paths = [ self.rand_file() for i in range(3) ]
+        shutil.copyfile(paths[2], paths[2] + '.dup')
+        paths.append(paths[2] + '.dup')
+        hashes = [ dumpling.FileUtils._hash(p) for p in paths ]
+
+        try:
+            dumpsvc = self._service_double([ hashes[0] ])
+            transmgr = dumpling.FileTransferManager(dumpsvc)
+
+            transmgr.UploadFiles('dumpid', paths)
+
+            self.assertEqual(sorted(dumpsvc.uploaded), sorted([ hashes[1], hashes[2] ]))
+            self.assertEqual(sorted(dumpsvc.linked), sorted([ hashes[0], hashes[2] ]))
+        finally:
+            for p in paths:
+                dumpling.FileUtils._try_remove(p)
+
+class test_dumpling_service(dumpling_testcase):
+    def test_session_per_thread_shared_pool(self):
+        dumpsvc = dumpling.DumplingService(DUMPLING_HOSTURL, poolsize=4)
+        sessions = [ ]
+        thread = threading.Thread(target=lambda: sessions.append(dumpsvc._session))
+        thread.start()
+        thread.join()
+
+        self.assertIs(dumpsvc._session, dumpsvc._session)
+        self.assertIsNot(dumpsvc._session, sessions[0])
+        self.assertIs(dumpsvc._session.get_adapter(DUMPLING_HOSTURL), sessions[0].get_adapter(DUMPLING_HOSTURL))
+        self.assertEqual(4, dumpsvc._adapter._pool_maxsize)
+
+class test_dumpling_resumableupload(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+        self.statedir = tempfile.mkdtemp()
+        self.threshold = dumpling.FileTransferManager.s_resumablethreshold
+        self.partsize = dumpling.FileTransferManager.s_partsize
+        dumpling.FileTransferManager.s_resumablethreshold = 0
+        dumpling.FileTransferManager.s_partsize = 1024 * 16
+
+    def tearDown(self):
+        dumpling.FileTransferManager.s_resumablethreshold = self.threshold
+        dumpling.FileTransferManager.s_partsize = self.partsize
+        self.service.stop()
+        shutil.rmtree(self.statedir)
+
+    def test_resume_after_failed_part(self):
+        origpath = self.rand_file(1024 * 256)
+        dumpsvc = dumpling.DumplingService(self.service.url, retries=0)
+        self.service.failparts.add(2)
+
+        try:
+            transmgr = dumpling.FileTransferManager(dumpsvc, uploadstatedir=self.statedir)
+            with self.assertRaises(dumpling.requests.HTTPError):
+                transmgr.QueueFileUpload('dumpid', origpath).await_result()
+
+            self.assertEqual(0, len(self.service.artifacts))
+            partputs = self.service.partputs
+
+            #a new transfer manager resumes the upload from the persisted state, re-sending only the failed part
+            transmgr = dumpling.FileTransferManager(dumpsvc, uploadstatedir=self.statedir)
+            hash = transmgr.QueueFileUpload('dumpid', origpath).await_result()
+
+            self.assertEqual(1, self.service.partputs - partputs)
+            self.assertEqual(dumpling.FileUtils._hash(origpath), hash)
+            self.assertIn(hash, self.service.artifacts)
+            self.assertEqual(hash, self.service.dumpartifacts['dumpid'][origpath])
+            self.assertEqual([ ], os.listdir(self.statedir))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+
+    def test_streaming_is_not_resumable(self):
+        #streamed uploads never write a compressed copy of the file to the upload state directory
+        origpath = self.rand_file(1024 * 256)
+        dumpsvc = dumpling.DumplingService(self.service.url, retries=0)
+
+        try:
+            transmgr = dumpling.FileTransferManager(dumpsvc, streaming=True, uploadstatedir=self.statedir)
+            hash = transmgr.QueueFileUpload('dumpid', origpath).await_result()
+
+            self.assertIn(hash, self.service.artifacts)
+            self.assertEqual(0, self.service.partputs)
+            self.assertEqual([ ], os.listdir(self.statedir))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+
+    def test_resumable_is_opt_in(self):
+        configpath = os.path.join(self.statedir, 'dumpling.config.json')
+        config = dumpling._parse_args([ 'upload', '--configpath', configpath, '--dumppath', 'core' ])
+        self.assertIsNone(dumpling._create_command_processor(config)._filequeue._uploadstatedir)
+        config = dumpling._parse_args([ 'upload', '--configpath', configpath, '--dumppath', 'core', '--resumable' ])
+        self.assertEqual(os.path.join(self.statedir, 'uploads'), dumpling._create_command_processor(config)._filequeue._uploadstatedir)
+
+class test_dumpling_rangeddownload(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+        self.threshold = dumpling.DumplingService.s_rangedthreshold
+        self.segmentsize = dumpling.DumplingService.s_rangedsegmentsize
+        dumpling.DumplingService.s_rangedthreshold = 0
+        dumpling.DumplingService.s_rangedsegmentsize = 1024 * 16
+
+    def tearDown(self):
+        dumpling.DumplingService.s_rangedthreshold = self.threshold
+        dumpling.DumplingService.s_rangedsegmentsize = self.segmentsize
+        self.service.stop()
+
+    def _add_artifact(self, path):
+        zippedpath = path + '.gzip'
+        hash = dumpling.FileUtils._hash_and_compress(path, zippedpath)
+        with open(zippedpath, 'rb') as f:
+            self.service.artifacts[hash] = f.read()
+        os.remove(zippedpath)
+        return hash
+
+    def test_ranged_download(self):
+        origpath = self.rand_file(1024 * 256)
+        downpath = origpath + '.down'
+
+        try:
+            hash = self._add_artifact(origpath)
+            segments = (len(self.service.artifacts[hash]) + 1024 * 16 - 1) / (1024 * 16)
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath))
+
+            self.assertEqual(segments, self.service.rangegets)
+            self.assertEqual(hash, dumpling.FileUtils._hash(downpath))
+            self.assertFalse(os.path.exists(downpath + '.partial'))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+    def test_ranged_download_on_pool(self):
+        origpath = self.rand_file(1024 * 256)
+        downpath = origpath + '.down'
+
+        try:
+            hash = self._add_artifact(origpath)
+            segments = (len(self.service.artifacts[hash]) + 1024 * 16 - 1) / (1024 * 16)
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath, pool=dumpling.ThreadPool(4)))
+
+            self.assertEqual(segments, self.service.rangegets)
+            self.assertEqual(hash, dumpling.FileUtils._hash(downpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+    def test_ranged_download_resume(self):
+        origpath = self.rand_file(1024 * 256)
+        downpath = origpath + '.down'
+
+        try:
+            hash = self._add_artifact(origpath)
+            content = self.service.artifacts[hash]
+            segments = (len(content) + 1024 * 16 - 1) / (1024 * 16)
+
+            #simulate an interrupted download which completed the first two segments
+            with open(downpath + '.partial', 'wb') as f:
+                f.write(content[:1024 * 32])
+                f.truncate(len(content))
+            with open(downpath + '.partial.json', 'w') as f:
+                json.dump({ 'hash': hash, 'size': len(content), 'segmentsize': 1024 * 16, 'completed': [ 0, 1 ] }, f)
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath))
+
+            self.assertEqual(segments - 2, self.service.rangegets)
+            self.assertEqual(hash, dumpling.FileUtils._hash(downpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+class test_dumpling_streameddownload(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def _compress(self, path):
+        zippedpath = path + '.gzip'
+        hash = dumpling.FileUtils._hash_and_compress(path, zippedpath)
+        with open(zippedpath, 'rb') as f:
+            compressed = f.read()
+        os.remove(zippedpath)
+        return hash, compressed
+
+    def test_streamed_download(self):
+        origpath = self.rand_file(1024 * 256)
+        downpath = origpath + '.down'
+
+        try:
+            hash, compressed = self._compress(origpath)
+            self.service.artifacts[hash] = compressed
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath))
+            self.assertEqual(hash, dumpling.FileUtils._hash(downpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+    def test_streamed_download_multimember(self):
+        origpath = self.rand_file(1024 * 64)
+        downpath = origpath + '.down'
+
+        try:
+            hash1, compressed1 = self._compress(origpath)
+            with open(origpath, 'rb') as f:
+                content = f.read()
+            hash = hashlib.sha1(content + content).hexdigest()
+            self.service.artifacts[hash] = compressed1 + compressed1
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            self.assertTrue(dumpsvc.DownloadArtifact(hash, downpath))
+            self.assertEqual(hash, dumpling.FileUtils._hash(downpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+    def test_streamed_download_hash_mismatch(self):
+        origpath = self.rand_file()
+        downpath = origpath + '.down'
+
+        try:
+            hash, compressed = self._compress(origpath)
+            self.service.artifacts['0' * 40] = compressed
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            self.assertFalse(dumpsvc.DownloadArtifact('0' * 40, downpath))
+            self.assertFalse(os.path.exists(downpath))
+        finally:
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(downpath)
+
+class test_dumpling_bulkdownload(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+        self.downdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.service.stop()
+        shutil.rmtree(self.downdir, ignore_errors=True)
+
+    def _add_artifact(self, path):
+        zippedpath = path + '.gzip'
+        hash = dumpling.FileUtils._hash_and_compress(path, zippedpath)
+        with open(zippedpath, 'rb') as f:
+            self.service.artifacts[hash] = f.read()
+        os.remove(zippedpath)
+        return hash
+
+    def test_bulk_download_shared_artifacts(self):
+        paths = [ self.rand_file() for i in range(3) ]
+
+        try:
+            sharedhash, dump1hash, dump2hash = [ self._add_artifact(p) for p in paths ]
+            self.service.manifests['dump1'] = { 'displayName': 'crash', 'dumpArtifacts': [ 
+                { 'hash': dump1hash, 'relativePath': 'core', 'dumpId': dump1hash },
+                { 'hash': sharedhash, 'relativePath': 'lib/libshared.so' } ] }
+            self.service.manifests['dump2'] = { 'displayName': 'crash', 'dumpArtifacts': [ 
+                { 'hash': dump2hash, 'relativePath': 'core', 'dumpId': dump2hash },
+                { 'hash': sharedhash, 'relativePath': 'lib/libshared.so' } ] }
+
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            processor = dumpling.CommandProcessor(dumpling.FileTransferManager(dumpsvc, 4), dumpsvc)
+            dirs = processor._download_dumps(self.downdir, [ 'dump1', 'dump2', 'dump1', 'missing' ])
+
+            self.assertEqual([ os.path.join(self.downdir, 'crash'), os.path.join(self.downdir, 'crash.dump2') ], dirs)
+            self.assertEqual(1, self.service.artifactgets[sharedhash])
+            for dir, dumphash in zip(dirs, [ dump1hash, dump2hash ]):
+                self.assertEqual(dumphash, dumpling.FileUtils._hash(os.path.join(dir, 'core')))
+                self.assertEqual(sharedhash, dumpling.FileUtils._hash(os.path.join(dir, 'lib', 'libshared.so')))
+                self.assertTrue(os.path.isfile(os.path.join(dir, 'manifest.json')))
+        finally:
+            for path in paths:
+                dumpling.FileUtils._try_remove(path)
+
+class test_dumpling_spool(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+        self.spooldir = tempfile.mkdtemp()
+        self.orphanage = dumpling.UploadSpool.s_orphanage
+
+    def tearDown(self):
+        dumpling.UploadSpool.s_orphanage = self.orphanage
+        self.service.stop()
+        shutil.rmtree(self.spooldir, ignore_errors=True)
+
+    def _upload_config(self, dumppath, incpaths):
+        return dumpling.DumplingConfig({ 'command': 'upload', 'dumppath': dumppath, 'incpaths': incpaths, 'displayname': 'crash', 'user': 'user', 'triage': 'none', 'properties': [ ('key', 'value') ], 'propfile': None })
+
+    def test_spool_unreachable_upload(self):
+        dumppath = self.rand_file()
+        incpath = self.rand_file()
+
+        try:
+            #nothing listens on the port of a stopped service
+            self.service.stop()
+            dumpsvc = dumpling.DumplingService(self.service.url, retries=0)
+            spool = dumpling.UploadSpool(self.spooldir)
+            cmdproc = dumpling.CommandProcessor(dumpling.FileTransferManager(dumpsvc), dumpsvc, spool)
+
+            cmdproc.Upload(self._upload_config(dumppath, [ incpath ]))
+
+            entries = spool._load_entries()
+            self.assertEqual(1, len(entries))
+            entry = entries[0][1]
+            self.assertEqual(dumpling.FileUtils._hash(dumppath), entry['dump']['hash'])
+            self.assertEqual([ incpath ], [ f['localpath'] for f in entry['files'] ])
+            self.assertEqual({ 'key': 'value' }, entry['properties'])
+            self.assertEqual(2, len(os.listdir(os.path.join(self.spooldir, 'blobs'))))
+
+            #a drain while the service is still unreachable keeps the entry and backs off
+            self.assertEqual(1, spool.Drain(dumpling.FileTransferManager(dumpsvc), dumpsvc))
+            entry = spool._load_entries()[0][1]
+            self.assertEqual(1, entry['attempts'])
+            self.assertTrue(entry['nextattempt'] > time.time())
+
+            #the drain command fails while uploads remain spooled
+            self.assertEqual(1, dumpling._process_command(dumpling.DumplingConfig({ 'command': 'drain' }), cmdproc))
+        finally:
+            dumpling.FileUtils._try_remove(dumppath)
+            dumpling.FileUtils._try_remove(incpath)
+
+    def test_spool_without_paths(self):
+        spool = dumpling.UploadSpool(self.spooldir)
+        dumpsvc = dumpling.DumplingService(self.service.url)
+        cmdproc = dumpling.CommandProcessor(dumpling.FileTransferManager(dumpsvc), dumpsvc, spool)
+        config = self._upload_config(None, None)
+        config.spool = True
+
+        self.assertEqual(1, cmdproc.Upload(config))
+        self.assertEqual([ ], spool._load_entries())
+
+    def test_spool_includes_of_uploaded_dump(self):
+        dumppath = self.rand_file()
+        incpath = self.rand_file()
+
+        try:
+            dumphash = dumpling.FileUtils._hash(dumppath)
+            inchash = dumpling.FileUtils._hash(incpath)
+            #the dump is uploaded but the service becomes unreachable before the included file is
+            self.service.failhashes.add(inchash)
+            dumpsvc = dumpling.DumplingService(self.service.url, retries=0)
+            spool = dumpling.UploadSpool(self.spooldir)
+            cmdproc = dumpling.CommandProcessor(dumpling.FileTransferManager(dumpsvc), dumpsvc, spool)
+
+            cmdproc.Upload(self._upload_config(dumppath, [ incpath ]))
+
+            #only the included file is spooled, the dump isn't copied into the spool again
+            entries = spool._load_entries()
+            self.assertEqual(1, len(entries))
+            entry = entries[0][1]
+            self.assertIsNone(entry['dump'])
+            self.assertEqual(dumphash, entry['dumpid'])
+            self.assertEqual([ inchash ], os.listdir(os.path.join(self.spooldir, 'blobs')))
+
+            self.service.failhashes.clear()
+            self.assertEqual(0, spool.Drain(dumpling.FileTransferManager(dumpsvc), dumpsvc))
+            self.assertEqual({ dumppath: dumphash, incpath: inchash }, self.service.dumpartifacts[dumphash])
+            self.assertEqual({ 'key': 'value' }, self.service.properties[dumphash])
+        finally:
+            dumpling.FileUtils._try_remove(dumppath)
+            dumpling.FileUtils._try_remove(incpath)
+
+    def test_drain_dedup(self):
+        dumppaths = [ self.rand_file() for i in range(2) ]
+        sharedpath = self.rand_file()
+
+        try:
+            dumphashes = [ dumpling.FileUtils._hash(p) for p in dumppaths ]
+            sharedhash = dumpling.FileUtils._hash(sharedpath)
+            spool = dumpling.UploadSpool(self.spooldir)
+            for dumppath in dumppaths:
+                spool.Add(dumppath, 'user', 'crash', [ sharedpath ], { 'key': 'value' })
+            #the same dump spooled twice is only uploaded once
+            spool.Add(dumppaths[0], 'user', 'crash', [ ], { })
+            for path in dumppaths + [ sharedpath ]:
+                os.remove(path)
+            self.assertEqual(3, len(os.listdir(os.path.join(self.spooldir, 'blobs'))))
+
+            dumpling.UploadSpool.s_orphanage = 0
+            dumpsvc = dumpling.DumplingService(self.service.url)
+            filequeue = dumpling.FileTransferManager(dumpsvc)
+            self.assertEqual(0, dumpling._process_command(dumpling.DumplingConfig({ 'command': 'drain' }), dumpling.CommandProcessor(filequeue, dumpsvc, spool)))
+            #the local paths of the spooled copies aren't kept once they're uploaded
+            self.assertEqual({ }, filequeue._localpaths)
+
+            #the artifacts are linked to the dumps by their original paths rather than their spooled copies
+            self.assertEqual(sorted(dumphashes), sorted(self.service.dumpartifacts.keys()))
+            for dumppath, dumphash in zip(dumppaths, dumphashes):
+                self.assertEqual({ dumppath: dumphash, sharedpath: sharedhash }, self.service.dumpartifacts[dumphash])
+                self.assertEqual({ 'key': 'value' }, self.service.properties[dumphash])
+            self.assertEqual(dict.fromkeys(dumphashes + [ sharedhash ], 1), dict(self.service.artifactposts))
+            self.assertEqual([ ], os.listdir(os.path.join(self.spooldir, 'blobs')))
+        finally:
+            for path in dumppaths + [ sharedpath ]:
+                dumpling.FileUtils._try_remove(path)
+
+class test_dumpling_daemon(dumpling_testcase):
+    def setUp(self):
+        self.service = standin_service()
+        self.tempdir = tempfile.mkdtemp()
+        self.configpath = os.path.join(self.tempdir, 'dumpling.config.json')
+        with open(self.configpath, 'w') as f:
+            json.dump({ 'url': self.service.url, 'installpath': self.tempdir, 'cachesize': 0 }, f)
+        self.socketpath = os.path.join(self.tempdir, 'dumpling.sock')
+        os.environ['DUMPLING_SOCKET'] = self.socketpath
+
+    def tearDown(self):
+        del os.environ['DUMPLING_SOCKET']
+        self.service.stop()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def test_forward_without_daemon(self):
+        self.assertIsNone(dumpling._forward_to_daemon([ 'download', '--hash', '0' * 40 ]))
+
+    def test_find_command(self):
+        self.assertEqual('upload', dumpling._find_command([ '--url', 'http://x', 'upload', '--dumppath', 'core', '--incpaths', 'a', 'b' ]))
+        self.assertEqual('drain', dumpling._find_command([ '--verbose', 'drain' ]))
+        self.assertIsNone(dumpling._find_command([ '--retries', 'many', 'upload' ]))
+        self.assertIsNone(dumpling._find_command([ '-h' ]))
+
+    def test_malformed_request(self):
+        daemon = dumpling.DumplingDaemon(self.socketpath)
+        thread = threading.Thread(target=daemon.Serve)
+        thread.start()
+
+        try:
+            while not os.path.exists(self.socketpath):
+                time.sleep(.01)
+            for request in [ 'not json', json.dumps({ 'cwd': self.tempdir }), json.dumps({ 'argv': 'drain', 'cwd': self.tempdir }), json.dumps([ 'drain' ]) ]:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.socketpath)
+                    sock.sendall(request + '\n')
+                    messages = [ json.loads(line) for line in sock.makefile('r') ]
+                finally:
+                    sock.close()
+                self.assertIn('malformed', messages[0]['stderr'])
+                self.assertEqual({ 'exit': 1 }, messages[-1])
+        finally:
+            daemon.Shutdown()
+            thread.join()
+
+    def test_forward_to_daemon(self):
+        origpath = self.rand_file()
+        zippedpath = origpath + '.gzip'
+        daemon = dumpling.DumplingDaemon(self.socketpath)
+        thread = threading.Thread(target=daemon.Serve)
+        thread.start()
+
+        try:
+            hash = dumpling.FileUtils._hash_and_compress(origpath, zippedpath)
+            with open(zippedpath, 'rb') as f:
+                self.service.artifacts[hash] = f.read()
+            while not os.path.exists(self.socketpath):
+                time.sleep(.01)
+
+            #relative paths are resolved in the working directory of the client
+            cwd = os.getcwd()
+            os.chdir(self.tempdir)
+            try:
+                argv = [ 'download', '--squelch', '--configpath', self.configpath, '--hash', hash, '--downpath', 'downloaded' ]
+                self.assertEqual(0, dumpling._forward_to_daemon(argv))
+                self.assertEqual(0, dumpling._forward_to_daemon(argv))
+                self.assertEqual(1, len(daemon._processors))
+                self.assertEqual(hash, dumpling.FileUtils._hash('downloaded'))
+
+                self.assertEqual(1, dumpling._forward_to_daemon([ 'download', '--squelch', '--configpath', self.configpath, '--hash', '0' * 40, '--downpath', 'missing' ]))
+                self.assertIsNone(dumpling._forward_to_daemon(argv + [ '--nodaemon' ]))
+            finally:
+                os.chdir(cwd)
+        finally:
+            daemon.Shutdown()
+            thread.join()
+            dumpling.FileUtils._try_remove(origpath)
+            dumpling.FileUtils._try_remove(zippedpath)
+
+        self.assertFalse(os.path.exists(self.socketpath))
+
+class test_dumpling_triagescheduler(dumpling_testcase):
+    #a stand-in for lldb which runs the commands passed as arguments and then those read from stdin.  analyze writes an
+    #output named by the dump of the current target, the dump contains how long analyze runs before the output is 
+    #written, or fail to write no output, or crash to exit the debugger
+    FAKE_DEBUGGER = '\n'.join([ 
+        'import json, os, sys, time',
+        'def commands():',
+        '    for cmd in sys.argv[2::2]:',
+        '        yield cmd',
+        '    for line in iter(sys.stdin.readline, ""):',
+        '        yield line.strip()',
+        'for cmd in commands():',
+        '    if cmd.startswith("target create"):',
+        '        behavior = open(cmd.split()[-1]).read()',
+        '    elif cmd.startswith("analyze"):',
+        '        time.sleep(float(behavior.split()[-1]))',
+        '        if behavior.startswith("crash"):',
+        '            os._exit(1)',
+        '        if not behavior.startswith("fail"):',
+        '            json.dump({ "FAILURE_HASH": behavior, "PID": os.getpid() }, open(cmd.split()[4], "w"))',
+        '    elif cmd.startswith("script "):',
+        '        exec(cmd[len("script "):])',
+        '    elif cmd == "exit":',
+        '        break' ])
+
+    def setUp(self):
+        self.service = standin_service()
+        self.tempdir = tempfile.mkdtemp()
+        for tool in [ 'analysis.py', 'triage.ini' ]:
+            open(os.path.join(self.tempdir, tool), 'w').close()
+        self.dbgpath = os.path.join(self.tempdir, 'lldb')
+        with open(self.dbgpath, 'w') as f:
+            f.write('#!%s\n%s\n'%(sys.executable, self.FAKE_DEBUGGER))
+        os.chmod(self.dbgpath, 0o755)
+        self.dumpsvc = dumpling.DumplingService(self.service.url)
+
+    def tearDown(self):
+        self.service.stop()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def _dumps(self, behaviors):
+        dumps = [ ]
+        for i, behavior in enumerate(behaviors):
+            path = os.path.join(self.tempdir, 'core%s'%(i))
+            with open(path, 'w') as f:
+                f.write(behavior)
+            dumps.append(('dump%s'%(i), path))
+        return dumps
+
+    def test_parallel(self):
+        scheduler = dumpling.TriageScheduler(self.dumpsvc, self.dbgpath, self.tempdir, maxprocs=4)
+        start = time.time()
+        results = scheduler.Run(self._dumps([ 'sleep 1' ] * 4))
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual([ 'triaged' ] * 4, results.values())
+        for i in range(4):
+            self.assertEqual('sleep 1', self.service.properties['dump%s'%(i)]['FAILURE_HASH'])
+
+    def test_memory_admission(self):
+        #the debuggers are run one at a time when there's only memory for one
+        scheduler = dumpling.TriageScheduler(self.dumpsvc, self.dbgpath, self.tempdir, maxprocs=3, maxmemory=1)
+        start = time.time()
+        results = scheduler.Run(self._dumps([ 'sleep 0.5' ] * 3))
+        self.assertGreaterEqual(time.time() - start, 1.5)
+        self.assertEqual([ 'triaged' ] * 3, results.values())
+
+    def test_timeout_and_failures(self):
+        scheduler = dumpling.TriageScheduler(self.dumpsvc, self.dbgpath, self.tempdir, maxprocs=4, timeout=1)
+        dumps = self._dumps([ 'sleep 30', 'fail 0', 'sleep 0' ]) + [ ('missing', os.path.join(self.tempdir, 'missing')) ]
+        start = time.time()
+        results = scheduler.Run(dumps)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual({ 'dump0': 'timeout', 'dump1': 'failed', 'dump2': 'triaged', 'missing': 'failed' }, dict(results))
+        self.assertEqual([ 'dump2' ], self.service.properties.keys())
+
+    def test_persistent_workers(self):
+        scheduler = dumpling.TriageScheduler(self.dumpsvc, self.dbgpath, self.tempdir, maxprocs=2, persistent=True)
+        results = scheduler.Run(self._dumps([ 'sleep 0' ] * 6))
+        self.assertEqual([ 'triaged' ] * 6, results.values())
+        pids = set(self.service.properties['dump%s'%(i)]['PID'] for i in range(6))
+        self.assertLessEqual(len(pids), 2)
+
+        #workers are replaced after triaging s_maxjobs dumps
+        maxjobs = dumpling._TriageWorker.s_maxjobs
+        dumpling._TriageWorker.s_maxjobs = 2
+        try:
+            scheduler = dumpling.TriageScheduler(self.dumpsvc, self.dbgpath, self.tempdir, maxprocs=1, persistent=True)
+            results = scheduler.Run(self._dumps([ 'sleep 0' ] * 4))
+        finally:
+            dumpling._TriageWorker.s_maxjobs = maxjobs
+        self.assertEqual([ 'triaged' ] * 4, results.values())
+        pids = [ self.service.properties['dump%s'%(i)]['PID'] for i in range(4) ]
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[0], pids[2])
+
+    def test_persistent_failures(self):
+        #a worker is replaced once it has been killed or crashed, a failed analysis doesn't replace it
+        scheduler = dumpling.TriageScheduler(self.dumpsvc, self.dbgpath, self.tempdir, maxprocs=1, timeout=1, persistent=True)
+        results = scheduler.Run(self._dumps([ 'sleep 30', 'crash 0', 'fail 0', 'sleep 0', 'sleep 0' ]))
+        self.assertEqual([ 'timeout', 'failed', 'failed', 'triaged', 'triaged' ], results.values())
+        self.assertEqual(self.service.properties['dump3']['PID'], self.service.properties['dump4']['PID'])
+
+    def test_triage_args(self):
+        configpath = os.path.join(self.tempdir, 'dumpling.config.json')
+        config = dumpling._parse_args([ 'triage', '--configpath', configpath, '--dumps', 'dump0=core0', 'dump1=core1', '--parallel', '2' ])
+        self.assertEqual([ [ 'dump0', 'core0' ], [ 'dump1', 'core1' ] ], config.dumps)
+        self.assertEqual(2, config.triageprocs)
+        self.assertEqual(1800, config.triagetimeout)
+
 class test_dumpling_filetransfer(dumpling_testcase):
     def test_upload_download_artifact(self):
         origpath = self.rand_file()
@@ -13,6 +13,7 @@ using Newtonsoft.Json;
 using Newtonsoft.Json.Linq;
 using System;
 using System.Collections.Generic;
+using System.Data.Entity;
 using System.Data.Entity.Infrastructure;
 using System.Data.Entity.Migrations;
 using System.Data.Entity.Validation;
@@ -235,6 +236,25 @@ namespace dumpling.web.Controllers
             return hash;
         }
 
+        //returns the subset of the specified hashes which are not yet stored by the service, allowing clients to skip
+        //compressing and uploading artifacts which have already been uploaded
+        [Route("api/artifacts/missing")]
+        [HttpPost]
+        public async Task<string[]> GetMissingArtifacts([FromBody] string[] hashes, CancellationToken cancelToken)
+        {
+            using (var opTracker = new TrackedOperation("GetMissingArtifacts"))
+            {
+                var requested = (hashes ?? new string[0]).Where(h => h != null).Select(h => h.ToLowerInvariant()).Distinct().ToArray();
+
+                using (var dumplingDb = new DumplingDb())
+                {
+                    var stored = await dumplingDb.Artifacts.Where(a => requested.Contains(a.Hash) && a.Url != null).Select(a => a.Hash).ToListAsync(cancelToken);
+
+                    return requested.Except(stored.Select(h => h.ToLowerInvariant())).ToArray();
+                }
+            }
+        }
+
         [Route("api/artifacts/{hash}")]
         [HttpGet]
         public async Task<HttpResponseMessage> DownloadArtifact(string hash, CancellationToken cancelToken)
@@ -444,6 +464,14 @@ namespace dumpling.web.Controllers
                 throw new HttpResponseException(Request.CreateErrorResponse(HttpStatusCode.BadRequest, "The specified hash is improperly formatted"));
             }
 
+            //artifacts are stored gzip compressed, the none codec is gzip without compression so it can be stored as is
+            var codec = Request.GetQueryNameValuePairs().Where(kvp => kvp.Key == "codec").Select(kvp => kvp.Value).FirstOrDefault();
+
+            if (codec != null && codec != "gzip" && codec != "none")
+            {
+                throw new HttpResponseException(Request.CreateErrorResponse(HttpStatusCode.BadRequest, "The specified codec is not supported"));
+            }
+
             using (DumplingDb dumplingDb = new DumplingDb())
             {
                 var artifact = await AddArtifactToDbAsync(dumplingDb, hash, localPath, cancelToken);